@@ -27,6 +27,7 @@ import csv
 from delphi.epidata.client.delphi_epidata import Epidata
 from delphi.nowcast.fusion import covariance
 from delphi.nowcast.fusion.nowcast import Nowcast
+from delphi.nowcast.fusion.us_fusion import StatespaceCache, UsFusion
 from delphi.nowcast.util.flu_data_source import FluDataSource
 from delphi.operations import secrets
 from delphi.utils.epiweek import range_epiweeks
@@ -175,6 +176,8 @@ class NowcastExperiment:
       'bd0': covariance.BlendDiagonal0,
       'bd1': covariance.BlendDiagonal1,
       'bd2': covariance.BlendDiagonal2,
+      'lw': covariance.LedoitWolf,
+      'oas': covariance.OracleApproximating,
     }[cov_name]
     return sensors, locations, weeks, cov_impl
 
@@ -260,13 +263,24 @@ def get_argument_parser():
       help='abscission experiment (hi-res sensors), with this resolution')
   parser.add_argument(
       '--covariance',
-      choices=('bd0', 'bd1', 'bd2'),
+      choices=('bd0', 'bd1', 'bd2', 'lw', 'oas'),
       help='covariance experiment, using this algorithm')
   parser.add_argument(
       '--vanilla',
       default=None,
       action='store_true',
       help='a control; unmodified operational nowcasting')
+  parser.add_argument(
+      '--statespace-cache',
+      help='directory in which to persist statespace across runs')
+  parser.add_argument(
+      '--covariance-cache',
+      help='directory in which to persist shrinkage parameters across runs')
+  parser.add_argument(
+      '--covariance-cache-size',
+      type=int,
+      default=64,
+      help='maximum size, in MiB, of the covariance cache (default: 64)')
   return parser
 
 
@@ -286,4 +300,13 @@ def main(*args):
 
 
 if __name__ == '__main__':
-  main(*validate_args(get_argument_parser().parse_args()))
+  args = get_argument_parser().parse_args()
+  if args.statespace_cache:
+    UsFusion.statespace_cache = StatespaceCache(args.statespace_cache)
+  if args.covariance_cache:
+    max_size = args.covariance_cache_size * 2 ** 20
+    Nowcast.covariance_cache = covariance.CovarianceCache(
+        args.covariance_cache, max_size)
+  main(*validate_args(args))
+  if Nowcast.covariance_cache is not None:
+    print('covariance cache: %s' % Nowcast.covariance_cache.get_stats())
@@ -9,6 +9,9 @@ missing values.
 
 # standard library
 import abc
+import hashlib
+import os
+import pickle
 
 # third party
 import numpy as np
@@ -16,7 +19,22 @@ import scipy.linalg
 import scipy.stats
 
 # first party
+from delphi.nowcast.fusion.opt_1d import MemoizedObjective
+from delphi.nowcast.fusion.opt_1d import find_bracket
 from delphi.nowcast.fusion.opt_1d import maximize
+from delphi.nowcast.fusion.opt_1d import maximize_batch
+
+
+# when warm-starting, the initial distance from the prior shrinkage parameter
+# to either end of the search interval
+WARM_START_WIDTH = 1
+
+# the search for the shrinkage parameter stops once the interval containing the
+# maximum is narrow enough, either in absolute terms or relative to the
+# parameter, or once the likelihood has been evaluated a fixed number of times
+ALPHA_TOLERANCE = 1
+ALPHA_REL_TOLERANCE = 0.02
+MAX_LIKELIHOOD_EVALUATIONS = 24
 
 
 def nancov(X):
@@ -69,6 +87,180 @@ def log_likelihood(cov, data):
     return -np.inf
 
 
+class NancovAccumulator:
+  """
+  Accumulates the numerator and denominator of `nancov` as rows of data are
+  added and removed, so that a growing (or sliding) window of data doesn't
+  have to be summarized from scratch.
+
+  Each row contributes a rank-one term to both the numerator and the
+  denominator, so adding or removing a row costs O(P^2), regardless of the
+  number of rows. Statistics for any subset of columns are simply submatrices.
+  Rows without any observations are ignored, so the number of observations is
+  the number of rows with at least one observation.
+  """
+
+  def __init__(self, num_columns):
+    """
+    input:
+      num_columns: the number of variables (P)
+    """
+    self.cov_num = np.zeros((num_columns, num_columns))
+    self.cov_den = np.zeros((num_columns, num_columns))
+    self.num_obs = 0
+
+  def update(self, X, sign):
+    """Add (sign 1) or remove (sign -1) rows of the data matrix."""
+    X = X[np.any(np.isfinite(X), axis=1), :]
+    cov_num, cov_den = nancov(X)
+    self.cov_num += sign * cov_num
+    self.cov_den += sign * cov_den
+    self.num_obs += sign * X.shape[0]
+
+  def append(self, X):
+    """Add rows of the data matrix (N x P), which may contain nans."""
+    self.update(X, 1)
+
+  def remove(self, X):
+    """Remove rows of the data matrix which were previously added."""
+    self.update(X, -1)
+    if self.num_obs < 0:
+      raise Exception('removed more rows than were added')
+
+  def get_nancov(self, columns=None):
+    """
+    Return the numerator and denominator, like `nancov`, of all rows added so
+    far, for the given columns (a list of indices or boolean vector) or, by
+    default, all columns.
+    """
+    if columns is None:
+      return self.cov_num.copy(), self.cov_den.copy()
+    index = np.ix_(columns, columns)
+    return self.cov_num[index], self.cov_den[index]
+
+
+class ScatterLikelihood:
+  """
+  Evaluates the log-likelihood of a fixed data matrix, like `log_likelihood`,
+  for any number of covariance matrices.
+
+  The likelihood depends on the data only through the number of observations
+  and the scatter matrix, `data^T data`. A factor of the scatter matrix is
+  computed once, so that each evaluation costs a single Cholesky decomposition
+  of the covariance matrix and a triangular solve, regardless of the number of
+  observations. The Cholesky decomposition also serves as the test for
+  positive definiteness.
+  """
+
+  # like scipy.stats.multivariate_normal, reject near-singular covariance
+  SINGULAR_TOLERANCE = 1e6 * np.finfo(np.float64).eps
+
+  def __init__(self, data=None, num_obs=None, scatter=None):
+    """
+    Either the data, or the number of observations and the scatter matrix,
+    must be given.
+
+    input:
+      data (optional): data matrix (N x P) (N observations, P variables)
+      num_obs (optional): the number of observations (N)
+      scatter (optional): the scatter matrix, `data^T data` (P x P), for
+        example the numerator of `nancov`
+    """
+
+    # a factor, F, such that `F F^T = data^T data`, with at most P columns
+    if data is not None:
+      self.num_obs, num_var = data.shape
+      if self.num_obs > num_var:
+        self.factor = np.linalg.qr(data, mode='r').T
+      else:
+        self.factor = np.array(data.T)
+    elif scatter is not None and num_obs is not None:
+      self.num_obs, num_var = num_obs, scatter.shape[0]
+      values, vectors = np.linalg.eigh(scatter)
+      self.factor = vectors * np.sqrt(np.maximum(values, 0))
+    else:
+      raise Exception('need either data or scatter')
+
+    self.constant = self.num_obs * num_var * np.log(2 * np.pi)
+
+  def get_log_likelihood(self, cov):
+    """
+    Return the log-likelihood of the data, given the covariance matrix. The
+    mean is assumed to be zero.
+
+    input:
+      cov: covariance matrix (P x P) (P variables)
+
+    output:
+      log-likelihood in the range (-np.inf, 0), or negative infinity if the
+      covariance matrix is not firmly positive definite
+    """
+
+    try:
+      L = scipy.linalg.cholesky(cov, lower=True)
+    except (ValueError, np.linalg.LinAlgError):
+      # not positive definite, or not finite
+      return -np.inf
+
+    # reject near-singular covariance, with a relative tolerance
+    scale = np.max(np.diag(cov))
+    pivots = np.square(np.diag(L))
+    if np.min(pivots) <= ScatterLikelihood.SINGULAR_TOLERANCE * scale:
+      return -np.inf
+
+    # log determinant, and the sum of Mahalanobis distances of all
+    # observations, which is `trace(cov^-1 data^T data)`
+    log_det = 2 * np.sum(np.log(np.diag(L)))
+    V = scipy.linalg.solve_triangular(L, self.factor, lower=True)
+    distance = np.sum(np.square(V))
+    return -(self.constant + self.num_obs * log_det + distance) / 2
+
+  def get_log_likelihood_batch(self, covs):
+    """
+    Return the log-likelihood of the data, like `get_log_likelihood`, given
+    each of a stack of covariance matrices. All matrices are factored together
+    in a single vectorized call.
+
+    input:
+      covs: stack of covariance matrices (K x P x P)
+
+    output:
+      vector of log-likelihoods (K)
+    """
+
+    covs = np.asarray(covs, dtype=float)
+    try:
+      if not np.all(np.isfinite(covs)):
+        raise ValueError('covariance is not finite')
+      L = np.linalg.cholesky(covs)
+    except (ValueError, np.linalg.LinAlgError):
+      # at least one matrix is not positive definite, so split the stack in
+      # half to isolate it
+      if len(covs) == 1:
+        return np.array([-np.inf])
+      half = len(covs) // 2
+      return np.concatenate((
+        self.get_log_likelihood_batch(covs[:half]),
+        self.get_log_likelihood_batch(covs[half:]),
+      ))
+
+    # reject near-singular covariance, with a relative tolerance
+    diagonals = np.diagonal(L, axis1=1, axis2=2)
+    scales = np.max(np.diagonal(covs, axis1=1, axis2=2), axis=1)
+    pivots = np.square(diagonals)
+    tolerance = ScatterLikelihood.SINGULAR_TOLERANCE * scales
+    singular = np.min(pivots, axis=1) <= tolerance
+
+    # log determinants and the sums of Mahalanobis distances
+    log_det = 2 * np.sum(np.log(diagonals), axis=1)
+    factors = np.broadcast_to(self.factor, (len(covs),) + self.factor.shape)
+    V = np.linalg.solve(L, factors)
+    distance = np.sum(np.square(V), axis=(1, 2))
+    result = -(self.constant + self.num_obs * log_det + distance) / 2
+    result[singular] = -np.inf
+    return result
+
+
 class ShrinkageMethod(metaclass=abc.ABCMeta):
   """
   An abstract class representing a method for shrinking a covariance matrix.
@@ -85,6 +277,18 @@ class ShrinkageMethod(metaclass=abc.ABCMeta):
   def get_cov(self, alpha):
     raise NotImplementedError()
 
+  def get_cov_batch(self, alphas):
+    """Return a stack of covariance matrices, one for each alpha."""
+    return np.array([self.get_cov(alpha) for alpha in alphas])
+
+  def get_closed_form_alpha(self):
+    """
+    Return the shrinkage parameter, if it can be determined directly from the
+    empirical covariance matrix, or otherwise None (the default), in which
+    case it's found by maximizing likelihood.
+    """
+    return None
+
 
 class DenominatorModifier(ShrinkageMethod):
   """
@@ -103,6 +307,11 @@ class DenominatorModifier(ShrinkageMethod):
     self.num_obs = num_obs
     self.needed_obs = max(num_obs, (n + 1) * n / 2)
 
+  def get_cov_batch(self, alphas):
+    # `get_cov` is elementwise, so it broadcasts over a stack of alphas
+    alphas = np.reshape(np.asarray(alphas, dtype=float), (-1, 1, 1))
+    return self.get_cov(alphas)
+
 
 class BlendDiagonal0(DenominatorModifier):
   """Multiply the offdiagonal entries of the denominator by a constant."""
@@ -147,6 +356,205 @@ class BlendDiagonal2(DenominatorModifier):
     return self.cov_num / (self.cov_den_diag + (1 - a) * x + a * y)
 
 
+class LowRankPlusDiagonal(DenominatorModifier):
+  """
+  A factor model: the covariance is a diagonal matrix plus a matrix of low
+  rank. Offdiagonal entries are approximated by the leading eigenvectors of the
+  empirical covariance matrix and are blended toward zero, with the variance of
+  each variable held fixed.
+
+  The covariance is represented as `diag(d) + G G^T`, where `G` has `rank`
+  columns. The factored form supports likelihood evaluation and sensor fusion
+  in time linear in the number of variables (see `low_rank_log_likelihood` and
+  `fusion.fuse_low_rank`).
+  """
+
+  # the number of columns of the low rank factor; subclasses may override this
+  rank = 4
+
+  def __init__(self, cov_num, cov_den, num_obs):
+    super().__init__(cov_num, cov_den, num_obs)
+
+    # eigendecomposition of the empirical covariance matrix
+    cov = cov_num / np.maximum(cov_den, 1)
+    values, vectors = np.linalg.eigh(cov)
+    rank = min(self.rank, cov.shape[0] - 1, np.sum(values > 0))
+    order = np.argsort(values)[::-1][:rank]
+
+    # the variance of each variable, and the low rank factor
+    self.variance = np.diag(cov)
+    self.factor = vectors[:, order] * np.sqrt(values[order])
+    self.factor_variance = np.sum(np.square(self.factor), axis=1)
+
+  def get_alpha_bounds(self):
+    return [0, self.needed_obs]
+
+  def get_factors(self, alpha):
+    """
+    Return the covariance matrix in factored form.
+
+    output:
+      - the diagonal part, `d` (P)
+      - the low rank factor, `G` (P x rank)
+    """
+    a = 1 - alpha / self.needed_obs
+    return self.variance - a * self.factor_variance, self.factor * np.sqrt(a)
+
+  def get_cov(self, alpha):
+    d, G = self.get_factors(alpha)
+    return np.diag(d) + np.dot(G, G.T)
+
+  def get_cov_batch(self, alphas):
+    # blend the fixed variance and the low rank part for each alpha
+    alphas = np.reshape(np.asarray(alphas, dtype=float), (-1, 1, 1))
+    a = 1 - alphas / self.needed_obs
+    low_rank = np.dot(self.factor, self.factor.T)
+    diagonal = np.diag(self.variance) - np.diag(self.factor_variance) * a
+    return diagonal + low_rank * a
+
+
+class ClosedFormShrinkage(DenominatorModifier):
+  """
+  An abstract subclass of DenominatorModifier representing methods that blend
+  the empirical covariance matrix toward its diagonal, with an intensity that
+  is computed analytically rather than by maximizing likelihood. This trades a
+  small loss in likelihood for a single pass over the data.
+
+  The shrinkage parameter is the fraction by which offdiagonal entries are
+  shrunk toward zero, which is equivalent to dividing offdiagonal entries of
+  the denominator by its complement. Regardless of the analytic intensity, the
+  parameter is at least large enough to make the covariance positive definite.
+  """
+
+  # the smallest eigenvalue of the shrunk correlation matrix
+  min_eigenvalue = 1e-6
+
+  def __init__(self, cov_num, cov_den, num_obs):
+    super().__init__(cov_num, cov_den, num_obs)
+
+    # the empirical covariance, where pairs of variables without any common
+    # observations are taken to be uncorrelated
+    self.overlap = (cov_den > 0) & (self.offdiag > 0)
+    self.cov = cov_num / np.maximum(cov_den, 1)
+
+    # the empirical correlation matrix
+    scale = 1 / np.sqrt(np.maximum(np.diag(self.cov), np.finfo(float).tiny))
+    self.corr = self.cov * np.outer(scale, scale)
+    np.fill_diagonal(self.corr, 1)
+
+  def get_alpha_bounds(self):
+    return [0, 1]
+
+  def get_cov(self, alpha):
+    return self.cov * (1 - alpha * self.offdiag)
+
+  def get_min_alpha(self):
+    """Return the smallest shrinkage parameter that is positive definite."""
+    # shrinkage moves each eigenvalue of the correlation matrix toward 1
+    low = np.linalg.eigvalsh(self.corr)[0]
+    if low >= self.min_eigenvalue:
+      return 0
+    return (self.min_eigenvalue - low) / (1 - low)
+
+  @abc.abstractmethod
+  def get_intensity(self):
+    """Return the analytic shrinkage intensity, between 0 and 1."""
+    raise NotImplementedError()
+
+  def get_closed_form_alpha(self):
+    intensity = min(max(self.get_intensity(), 0), 1)
+    return max(intensity, self.get_min_alpha())
+
+
+class LedoitWolf(ClosedFormShrinkage):
+  """
+  Shrink toward the diagonal with the intensity of Ledoit and Wolf, which
+  minimizes expected squared error. The sampling variance of each covariance
+  is estimated assuming normality, from the number of observations of that
+  pair of variables.
+  """
+
+  def __init__(self, cov_num, cov_den, num_obs):
+    super().__init__(cov_num, cov_den, num_obs)
+
+  def get_intensity(self):
+    cov = self.cov[self.overlap]
+    if not np.any(cov):
+      return 1
+    variance = np.outer(np.diag(self.cov), np.diag(self.cov))[self.overlap]
+    error = (variance + np.square(cov)) / self.cov_den[self.overlap]
+    return np.sum(error) / np.sum(np.square(cov))
+
+
+class OracleApproximating(ClosedFormShrinkage):
+  """
+  Shrink the correlation matrix toward the identity with the intensity of the
+  oracle approximating shrinkage (OAS) estimator of Chen et al., which assumes
+  normality. Missing values are accounted for by taking the number of
+  observations to be the average number per pair of variables.
+  """
+
+  def __init__(self, cov_num, cov_den, num_obs):
+    super().__init__(cov_num, cov_den, num_obs)
+
+  def get_intensity(self):
+    p = self.cov.shape[0]
+    corr = self.corr[self.overlap]
+    if not np.any(corr):
+      return 1
+    n = np.mean(self.cov_den[self.overlap])
+    # the traces of the correlation matrix and its square
+    tr, tr2 = p, p + np.sum(np.square(corr))
+    numerator = (1 - 2 / p) * tr2 + tr ** 2
+    denominator = (n + 1 - 2 / p) * (tr2 - tr ** 2 / p)
+    return numerator / denominator
+
+
+def low_rank_log_likelihood(d, G, data):
+  """
+  Return the log-likelihood of data, like `log_likelihood`, given a covariance
+  matrix in the form `diag(d) + G G^T`.
+
+  The Woodbury identity and the matrix determinant lemma are used, so the full
+  covariance matrix is neither formed nor inverted.
+
+  input:
+    d: diagonal part of the covariance matrix (P)
+    G: low rank factor of the covariance matrix (P x K)
+    data: data matrix (N x P) (N observations)
+
+  output:
+    log-likelihood in the range (-np.inf, 0)
+  """
+
+  # the covariance matrix is not positive definite unless the diagonal is
+  if np.min(d) <= 0:
+    return -np.inf
+
+  # log determinant and Mahalanobis distances of all observations, given only
+  # the diagonal part
+  log_det = np.sum(np.log(d))
+  distance = np.sum(np.square(data) / d)
+
+  # the low rank correction, via the capacitance matrix, `I + G^T D^-1 G`
+  # (there is nothing to correct if the factor has no columns)
+  if G.shape[1] > 0:
+    DiG = G / d[:, None]
+    M = np.eye(G.shape[1]) + np.dot(G.T, DiG)
+    try:
+      L = np.linalg.cholesky(M)
+    except np.linalg.LinAlgError:
+      return -np.inf
+    V = scipy.linalg.solve_triangular(L, np.dot(data, DiG).T, lower=True)
+    log_det += 2 * np.sum(np.log(np.diag(L)))
+    distance -= np.sum(np.square(V))
+
+  # return the sum of the log-likelihood of all observations
+  num_obs, num_var = data.shape
+  constant = num_var * np.log(2 * np.pi)
+  return -(num_obs * (constant + log_det) + distance) / 2
+
+
 def posdef_max_likelihood_objective(X, shrinkage):
   """
   Return an objective function with which to find an optimal shrinkage value.
@@ -162,17 +570,190 @@ def posdef_max_likelihood_objective(X, shrinkage):
     an objective function suitable the mle_cov function
   """
 
-  # replace missing values (nans) with zeros
-  X0 = np.nan_to_num(X)
+  # replace missing values (nans) with zeros, and summarize the data
+  likelihood = ScatterLikelihood(np.nan_to_num(X))
 
   # define an objective function, given the data
-  objective = lambda alpha: log_likelihood(shrinkage.get_cov(alpha), X0)
+  get_ll = likelihood.get_log_likelihood
+  objective = lambda alpha: get_ll(shrinkage.get_cov(alpha))
 
   # return the objective function
   return objective
 
 
-def mle_cov(X, shrinkage_class):
+def maximize_alpha(
+    shrinkage,
+    objective,
+    prior_alpha=None,
+    batch_objective=None,
+    batch_size=None):
+  """
+  Return the shrinkage parameter which maximizes the given objective. By
+  default, all possible parameters are searched. Given a prior parameter (for
+  example, the optimum from the previous week), the search instead starts with
+  a narrow interval around it, which is widened only as needed. Either way,
+  the likelihood is evaluated at most `MAX_LIKELIHOOD_EVALUATIONS` times, plus
+  any evaluations needed to widen the interval.
+
+  Optionally, parameters are proposed and evaluated in batches (see
+  `opt_1d.maximize_batch`).
+
+  input:
+    shrinkage: an instance of abstract class ShrinkageMethod
+    objective: a function which takes a shrinkage parameter and returns a
+      log-likelihood
+    prior_alpha (optional): an initial guess of the shrinkage parameter
+    batch_objective (optional): a function which takes a vector of shrinkage
+      parameters and returns a vector of log-likelihoods
+    batch_size (optional): the number of parameters per batch; required with
+      `batch_objective`
+
+  output:
+    the shrinkage parameter with maximum likelihood
+  """
+
+  low, high = shrinkage.get_alpha_bounds()
+
+  # remember values, so that the bracket endpoints aren't evaluated twice
+  objective = MemoizedObjective(objective)
+  if prior_alpha is not None:
+    low, high = find_bracket(
+        low, high, prior_alpha, WARM_START_WIDTH, objective)
+  max_evaluations = objective.evaluations + MAX_LIKELIHOOD_EVALUATIONS
+
+  if batch_objective is not None:
+    stop = lambda n_obj, d_alpha, max_ll: (
+        d_alpha <= ALPHA_TOLERANCE or n_obj >= MAX_LIKELIHOOD_EVALUATIONS)
+    alpha, ll = maximize_batch(low, high, batch_objective, stop, batch_size)
+  else:
+    # the likelihood varies with the parameter on a roughly logarithmic scale
+    alpha, ll = maximize(
+        low,
+        high,
+        objective,
+        tolerance=ALPHA_TOLERANCE,
+        rel_tolerance=ALPHA_REL_TOLERANCE,
+        max_evaluations=max_evaluations,
+        log_scale=True)
+  return alpha
+
+
+def maximize_likelihood(
+    shrinkage, likelihood, prior_alpha=None, batch_size=None):
+  """
+  Return the shrinkage parameter which maximizes the likelihood of the data.
+
+  input:
+    shrinkage: an instance of abstract class ShrinkageMethod
+    likelihood: a ScatterLikelihood, summarizing the data
+    prior_alpha (optional): an initial guess of the shrinkage parameter (see
+      `maximize_alpha`)
+    batch_size (optional): if given, the number of shrinkage parameters whose
+      covariance matrices are stacked and evaluated together
+
+  output:
+    the shrinkage parameter with maximum likelihood
+  """
+
+  get_ll = likelihood.get_log_likelihood
+  objective = lambda alpha: get_ll(shrinkage.get_cov(alpha))
+  batch_objective = None
+  if batch_size is not None:
+    get_lls = likelihood.get_log_likelihood_batch
+    batch_objective = lambda alphas: get_lls(shrinkage.get_cov_batch(alphas))
+  return maximize_alpha(
+      shrinkage, objective, prior_alpha, batch_objective, batch_size)
+
+
+def fit_shrinkage(X, shrinkage_class, prior_alpha=None, batch_size=None):
+  """
+  Find the shrinkage parameter that maximizes the likelihood of the data (see
+  `mle_cov`).
+
+  input:
+    X: data matrix (N x P) (N observations, P variables)
+    shrinkage_class: a concrete subclass of ShrinkageMethod
+    prior_alpha (optional): an initial guess of the shrinkage parameter (see
+      `maximize_alpha`)
+    batch_size (optional): the number of shrinkage parameters evaluated
+      together (see `maximize_likelihood`)
+
+  output:
+    a tuple consisting of:
+      - the instance of `shrinkage_class`, fit to the data
+      - the shrinkage parameter with maximum likelihood
+  """
+
+  # sanity check
+  if X.shape[0] < 2:
+    raise Exception('need at least two observations to estimate covariance')
+
+  # get the numerator and denominator of the empirical covariance matrix
+  cov_num, cov_den = nancov(X)
+
+  # instantiate the shrinkage method, which may not need a search at all
+  shrinkage = shrinkage_class(cov_num, cov_den, X.shape[0])
+  alpha = shrinkage.get_closed_form_alpha()
+  if alpha is not None:
+    return shrinkage, alpha
+
+  # summarize the data, with missing values (nans) replaced by zeros
+  likelihood = ScatterLikelihood(np.nan_to_num(X))
+
+  # let the optimizer find a good shrinkage parameter
+  alpha = maximize_likelihood(shrinkage, likelihood, prior_alpha, batch_size)
+  return shrinkage, alpha
+
+
+def fit_shrinkage_from_nancov(
+    cov_num,
+    cov_den,
+    num_obs,
+    shrinkage_class,
+    prior_alpha=None,
+    batch_size=None):
+  """
+  Find the shrinkage parameter that maximizes the likelihood of the data, like
+  `fit_shrinkage`, given the output of `nancov` (for example, from a
+  `NancovAccumulator`) rather than the data itself. The numerator of `nancov`
+  is the scatter matrix of the data with nans replaced by zeros, which is all
+  that the likelihood depends on.
+
+  input:
+    cov_num: numerator of the empirical covariance matrix (P x P)
+    cov_den: denominator of the empirical covariance matrix (P x P)
+    num_obs: the number of observations (N)
+    shrinkage_class: a concrete subclass of ShrinkageMethod
+    prior_alpha (optional): an initial guess of the shrinkage parameter (see
+      `maximize_alpha`)
+    batch_size (optional): the number of shrinkage parameters evaluated
+      together (see `maximize_likelihood`)
+
+  output:
+    a tuple consisting of:
+      - the instance of `shrinkage_class`, fit to the data
+      - the shrinkage parameter with maximum likelihood
+  """
+
+  # sanity check
+  if num_obs < 2:
+    raise Exception('need at least two observations to estimate covariance')
+
+  # instantiate the shrinkage method, which may not need a search at all
+  shrinkage = shrinkage_class(cov_num, cov_den, num_obs)
+  alpha = shrinkage.get_closed_form_alpha()
+  if alpha is not None:
+    return shrinkage, alpha
+
+  # summarize the data
+  likelihood = ScatterLikelihood(num_obs=num_obs, scatter=cov_num)
+
+  # let the optimizer find a good shrinkage parameter
+  alpha = maximize_likelihood(shrinkage, likelihood, prior_alpha, batch_size)
+  return shrinkage, alpha
+
+
+def mle_cov(X, shrinkage_class, prior_alpha=None, batch_size=None):
   """
   Find the covariance matrix that maximizes the likelihood of a multivariate
   normal disribution, given observed data. It is assumed that the data is
@@ -185,28 +766,259 @@ def mle_cov(X, shrinkage_class):
   input:
     X: data matrix (N x P) (N observations, P variables)
     shrinkage_class: a concrete subclass of ShrinkageMethod
+    prior_alpha (optional): an initial guess of the shrinkage parameter (see
+      `maximize_alpha`)
+    batch_size (optional): the number of shrinkage parameters evaluated
+      together (see `maximize_likelihood`)
 
   output:
     the shrunk covariance matrix with maximum likelihood (P x P)
   """
 
+  shrinkage, alpha = fit_shrinkage(
+      X, shrinkage_class, prior_alpha, batch_size)
+
+  # return the shrunk covariance matrix with maximum likelihood
+  return shrinkage.get_cov(alpha)
+
+
+def fit_low_rank_shrinkage(X, shrinkage_class, prior_alpha=None):
+  """
+  Find the shrinkage parameter that maximizes the likelihood of the data, like
+  `fit_shrinkage`, but using the factored likelihood (see `mle_low_rank_cov`).
+
+  input:
+    X: data matrix (N x P) (N observations, P variables)
+    shrinkage_class: a subclass of LowRankPlusDiagonal
+    prior_alpha (optional): an initial guess of the shrinkage parameter (see
+      `maximize_alpha`)
+
+  output:
+    a tuple consisting of:
+      - the instance of `shrinkage_class`, fit to the data
+      - the shrinkage parameter with maximum likelihood
+  """
+
   # sanity check
   if X.shape[0] < 2:
     raise Exception('need at least two observations to estimate covariance')
 
-  # get the numerator and denominator of the empirical covariance matrix
-  cov_num, cov_den = nancov(X)
-
   # instantiate the shrinkage method
+  cov_num, cov_den = nancov(X)
   shrinkage = shrinkage_class(cov_num, cov_den, X.shape[0])
 
-  # obtain an objective function
-  low, high = shrinkage.get_alpha_bounds()
-  objective = posdef_max_likelihood_objective(X, shrinkage)
-  stop = lambda n_obj, d_alpha, max_ll: d_alpha <= 1
+  # find a good shrinkage parameter, using the factored likelihood
+  X0 = np.nan_to_num(X)
+  objective = lambda a: low_rank_log_likelihood(*shrinkage.get_factors(a), X0)
+  alpha = maximize_alpha(shrinkage, objective, prior_alpha)
+  return shrinkage, alpha
 
-  # let the optimizer find a good shrinkage parameter
-  alpha, ll = maximize(low, high, objective, stop)
 
-  # return the shrunk covariance matrix with maximum likelihood
-  return shrinkage.get_cov(alpha)
+def mle_low_rank_cov(X, shrinkage_class, prior_alpha=None):
+  """
+  Find the covariance matrix that maximizes the likelihood of a multivariate
+  normal disribution, like `mle_cov`, but return it in factored form. This is
+  only applicable to shrinkage methods with a low rank representation, like
+  `LowRankPlusDiagonal`.
+
+  input:
+    X: data matrix (N x P) (N observations, P variables)
+    shrinkage_class: a subclass of LowRankPlusDiagonal
+    prior_alpha (optional): an initial guess of the shrinkage parameter (see
+      `maximize_alpha`)
+
+  output:
+    a tuple consisting of:
+      - the diagonal part of the covariance matrix (P)
+      - the low rank factor of the covariance matrix (P x K)
+  """
+
+  shrinkage, alpha = fit_low_rank_shrinkage(X, shrinkage_class, prior_alpha)
+
+  # return the factors of the shrunk covariance matrix with maximum likelihood
+  return shrinkage.get_factors(alpha)
+
+
+class CovarianceCache:
+  """
+  Memoizes the maximum likelihood shrinkage parameter by content: a hash of
+  the sufficient statistics of the noise (see `nancov`), the identities of its
+  columns, and the shrinkage method. Given the shrinkage parameter, the
+  covariance matrix itself is cheap to reconstruct, so only the (expensive)
+  search for it is skipped. If a directory is given, shrinkage parameters are
+  also stored on disk, so that re-running an experiment, or a variant of it
+  which shares some inputs, can reuse them.
+
+  Keys depend on the exact bytes of the statistics, so statistics which are
+  accumulated incrementally (see `NancovAccumulator`) may not match those
+  computed from scratch, even for the same data.
+
+  On disk, shrinkage parameters are grouped into buckets by the first two
+  characters of their key, so that the store holds at most a few hundred
+  files, each a pickled dictionary from key to shrinkage parameter. The files
+  are limited in total size, with the least recently used buckets removed
+  first. When warm-starting (see `maximize_alpha`), a stored shrinkage
+  parameter is whichever one was found first, so results may differ slightly
+  (within the tolerance of the optimizer) from those without a cache.
+  """
+
+  # bump whenever covariance estimation changes, invalidating files on disk
+  VERSION = 4
+
+  # the prefix of all files in the store, regardless of version
+  PREFIX = 'covariance_v'
+
+  # once over its size limit, the store is shrunk to this fraction of the
+  # limit, so that the directory is scanned only occasionally
+  LOW_WATER_MARK = 0.8
+
+  def __init__(self, directory=None, max_size=2 ** 26):
+    """
+    input:
+      directory (optional): where to store shrinkage parameters, or None to
+        keep them in memory only
+      max_size (optional): the maximum total size, in bytes, of the files in
+        `directory`
+    """
+    self.directory = directory
+    self.max_size = max_size
+    self.alphas = {}
+    self.size = None
+    self.hits = 0
+    self.loads = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get_stats(self):
+    """Return the number of memory hits, disk hits, misses, and evictions."""
+    return {
+      'hits': self.hits,
+      'loads': self.loads,
+      'misses': self.misses,
+      'evictions': self.evictions,
+    }
+
+  @staticmethod
+  def get_key(cov_num, cov_den, num_obs, columns, shrinkage_class):
+    """
+    Return a digest of the numerator and denominator of `nancov` of the data,
+    the number of observations, the identities of the columns (e.g. (sensor,
+    location) pairs), and the shrinkage method. Together, these determine the
+    likelihood, and hence the shrinkage parameter, exactly.
+    """
+    cov_num = np.ascontiguousarray(cov_num, dtype=float)
+    cov_den = np.ascontiguousarray(cov_den, dtype=float)
+    method = '%s.%s' % (shrinkage_class.__module__, shrinkage_class.__name__)
+    header = (
+      CovarianceCache.VERSION,
+      method,
+      tuple(columns),
+      int(num_obs),
+      cov_num.shape,
+    )
+    digest = hashlib.sha1(repr(header).encode('utf-8'))
+    digest.update(cov_num.tobytes())
+    digest.update(cov_den.tobytes())
+    return digest.hexdigest()
+
+  def get_filename(self, key):
+    """Return the name of the bucket file which holds the given key."""
+    name = '%s%d_%s.pickle' % (
+        CovarianceCache.PREFIX, CovarianceCache.VERSION, key[:2])
+    return os.path.join(self.directory, name)
+
+  @staticmethod
+  def read_bucket(filename):
+    """Return the contents of a bucket file, or an empty dictionary."""
+    try:
+      with open(filename, 'rb') as f:
+        return pickle.load(f)
+    except FileNotFoundError:
+      # the file is missing, possibly evicted by another process
+      return {}
+
+  def load(self, key):
+    """Return the stored shrinkage parameter, or None if it's missing."""
+    if self.directory is None:
+      return None
+    filename = self.get_filename(key)
+    alpha = CovarianceCache.read_bucket(filename).get(key)
+    if alpha is not None:
+      # mark the bucket as recently used
+      try:
+        os.utime(filename)
+      except FileNotFoundError:
+        pass
+    return alpha
+
+  def save(self, key, alpha):
+    if self.directory is None:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    if self.size is None:
+      self.evict()
+    filename = self.get_filename(key)
+    # re-read the bucket to keep entries written by other processes
+    bucket = CovarianceCache.read_bucket(filename)
+    bucket[key] = alpha
+    try:
+      old_size = os.path.getsize(filename)
+    except FileNotFoundError:
+      old_size = 0
+    # write to a temporary file first so that readers never see partial files
+    temp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp, 'wb') as f:
+      pickle.dump(bucket, f)
+    self.size += os.path.getsize(temp) - old_size
+    os.replace(temp, filename)
+    if self.size > self.max_size:
+      self.evict()
+
+  def evict(self):
+    """
+    If the store is over its size limit, remove the least recently used
+    buckets until it is within the low water mark. Other processes may share
+    the store, so the size is recounted.
+    """
+    files = []
+    for name in os.listdir(self.directory):
+      if not (name.startswith(CovarianceCache.PREFIX) and
+              name.endswith('.pickle')):
+        continue
+      filename = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(filename)
+      except FileNotFoundError:
+        continue
+      files.append((stat.st_mtime, name, stat.st_size))
+    self.size = sum(size for (mtime, name, size) in files)
+    if self.size <= self.max_size:
+      return
+    target = self.max_size * CovarianceCache.LOW_WATER_MARK
+    for mtime, name, size in sorted(files):
+      if self.size <= target:
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+        self.evictions += 1
+      except FileNotFoundError:
+        pass
+      self.size -= size
+
+  def get(self, key):
+    """Return the shrinkage parameter for the given key, or None."""
+    if key in self.alphas:
+      self.hits += 1
+      return self.alphas[key]
+    alpha = self.load(key)
+    if alpha is None:
+      self.misses += 1
+    else:
+      self.loads += 1
+      self.alphas[key] = alpha
+    return alpha
+
+  def put(self, key, alpha):
+    """Store the shrinkage parameter for the given key."""
+    self.alphas[key] = alpha
+    self.save(key, alpha)
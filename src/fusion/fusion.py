@@ -4,7 +4,9 @@
 ===============
 
 An implementation of the sensor fusion kernel and supporting methods. All
-inputs and outputs are assumed to be of type numpy.ndarray.
+inputs and outputs are assumed to be of type numpy.ndarray, except that the
+matrices H and W, which map from state space, may also be scipy.sparse
+matrices.
 
 See also:
   Farrow DC. "Modeling the Past, Present, and Future of Influenza" (Doctoral
@@ -13,9 +15,20 @@ See also:
 
 # standard library
 from fractions import Fraction
+import functools
+import math
 
 # third party
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+
+
+def as_dense(X):
+  """Return the given matrix as a numpy.ndarray, converting if sparse."""
+  if scipy.sparse.issparse(X):
+    return X.toarray()
+  return X
 
 
 def fuse(z, R, H):
@@ -33,15 +46,142 @@ def fuse(z, R, H):
     - the covariance of the system state distribution (S x S)
   """
 
-  # precompute common product
-  RiH = np.dot(np.linalg.inv(R), H)
-
-  # return the system state distribution
-  P = np.linalg.inv(np.dot(H.T, RiH))
-  x = np.dot(np.dot(z, RiH), P)
+  # fuse in factored form, then expand the posterior covariance
+  x, C = fuse_factored(z, R, H)
+  P = scipy.linalg.cho_solve((C, True), np.eye(C.shape[0]))
   return (x, P)
 
 
+def fuse_factored(z, R, H):
+  """
+  Fuse measurement distribution into state distribution, like `fuse`, except
+  that the covariance of the system state is returned in factored form.
+
+  The posterior precision, `H^T R^-1 H`, is returned as its lower Cholesky
+  factor, `C`, such that the state covariance is `(C C^T)^-1`. No matrix is
+  explicitly inverted; `R` is factored once, and everything else is obtained by
+  triangular solves against the two factors.
+
+  input:
+    z: row vector of sensor measurements (1 x I)
+    R: sensor noise covariance matrix (I x I), positive definite
+    H: matrix mapping from state space to measurement space (I x S)
+
+  output:
+    - the mean of the system state distribution (1 x S)
+    - lower Cholesky factor of the system state precision matrix (S x S)
+  """
+
+  # whiten inputs and measurements: with R = L L^T, let A = L^-1 H
+  L = scipy.linalg.cholesky(R, lower=True)
+  A = scipy.linalg.solve_triangular(L, as_dense(H), lower=True)
+  b = scipy.linalg.solve_triangular(L, np.transpose(z), lower=True)
+
+  # the posterior precision is A^T A, and the posterior mean solves
+  # (A^T A) x^T = A^T b
+  C = scipy.linalg.cholesky(np.dot(A.T, A), lower=True)
+  x = scipy.linalg.cho_solve((C, True), np.dot(A.T, b))
+  return (np.transpose(x), C)
+
+
+class InformationAccumulator:
+  """
+  Accumulates sensor measurements in information form, so that sensors can be
+  added and removed incrementally.
+
+  The system state distribution is summarized by the precision matrix,
+  `J = H^T R^-1 H`, and the information vector, `h = H^T R^-1 z^T`. When
+  sensors are divided into blocks with independent noise (i.e. `R` is block
+  diagonal), both are sums of per-block terms. Absorbing or retracting a block
+  is then a small update, and the posterior, which is the same as that of
+  `fuse`, is computed only when requested.
+
+  Each block is identified by a key, which is used to retract it later.
+  Absorbing a block with an existing key replaces the previous block.
+  """
+
+  def __init__(self, num_states):
+    """
+    input:
+      num_states: the dimension of the statespace (S)
+    """
+    self.num_states = num_states
+    self.J = np.zeros((num_states, num_states))
+    self.h = np.zeros(num_states)
+    self.blocks = {}
+
+  def absorb(self, key, z, R, H):
+    """
+    Add a block of sensor measurements.
+
+    input:
+      key: a hashable identifier for this block
+      z: vector of sensor measurements (I)
+      R: sensor noise covariance matrix (I x I), positive definite
+      H: matrix mapping from state space to measurement space (I x S)
+    """
+
+    if H.shape[1] != self.num_states:
+      raise Exception('statespace dimensions do not match')
+    if key in self.blocks:
+      self.retract(key)
+
+    # solve against the Cholesky factor of R, rather than inverting it
+    factor = scipy.linalg.cho_factor(R, lower=True)
+    RiH = scipy.linalg.cho_solve(factor, as_dense(H))
+    J = H.T.dot(RiH)
+    h = np.dot(np.ravel(z), RiH)
+
+    self.J += J
+    self.h += h
+    self.blocks[key] = (J, h)
+
+  def retract(self, key):
+    """
+    Remove a block of sensor measurements which was previously absorbed.
+
+    input:
+      key: the identifier of the block to remove
+    """
+
+    if key not in self.blocks:
+      raise Exception('unknown block', key)
+    J, h = self.blocks.pop(key)
+    self.J -= J
+    self.h -= h
+
+  def get_keys(self):
+    """Return a list of the keys of all absorbed blocks."""
+    return list(self.blocks.keys())
+
+  def get_posterior_factored(self):
+    """
+    Return the system state distribution in factored form (see
+    `fuse_factored`).
+
+    output:
+      - the mean of the system state distribution (S)
+      - lower Cholesky factor of the system state precision matrix (S x S)
+    """
+
+    C = scipy.linalg.cholesky(self.J, lower=True)
+    x = scipy.linalg.cho_solve((C, True), self.h)
+    return (x, C)
+
+  def get_posterior(self):
+    """
+    Return the system state distribution (see `fuse`).
+
+    output:
+      - the mean of the system state distribution (S)
+      - the covariance of the system state distribution (S x S)
+    """
+
+    x, C = self.get_posterior_factored()
+    P = scipy.linalg.cho_solve((C, True), np.eye(self.num_states))
+    return (x, P)
+
+
 def extract(x, P, W):
   """
   Extract output distribution from state distribution, given a linear mapping
@@ -60,12 +200,171 @@ def extract(x, P, W):
     - the covariance of the output distribution (O x O)
   """
 
-  # return the output distribution
-  S = np.dot(np.dot(W, P), W.T)
-  y = np.dot(x, W.T)
+  # return the output distribution (W is on the left of each product so that
+  # it may be sparse)
+  S = W.dot(np.transpose(W.dot(P.T)))
+  y = np.transpose(W.dot(np.transpose(x)))
   return (y, S)
 
 
+def extract_variance(x, C, W):
+  """
+  Extract output distribution from state distribution, like `extract`, except
+  that only the variance of each output variable is computed.
+
+  With the state precision factored as `C C^T`, the output covariance is
+  `V^T V`, where `V = C^-1 W^T`. Its diagonal is the column-wise sum of squares
+  of `V`, so the full output covariance matrix is never formed.
+
+  input:
+    x: row vector of state mean (1 x S)
+    C: lower Cholesky factor of the state precision matrix (S x S), as returned
+      by `fuse_factored`
+    W: matrix mapping from state space to output space (O x S)
+
+  output:
+    - the mean of the output distribution (1 x O)
+    - the variance of each output variable (O)
+  """
+
+  # return the output mean and variance
+  V = scipy.linalg.solve_triangular(C, as_dense(W).T, lower=True)
+  y = np.transpose(W.dot(np.transpose(x)))
+  return (y, np.sum(np.square(V), axis=0))
+
+
+def fuse_low_rank(z, d, G, H):
+  """
+  Fuse measurement distribution into state distribution, like `fuse_factored`,
+  except that the sensor noise covariance matrix is given as a diagonal matrix
+  plus a matrix of low rank, `R = diag(d) + G G^T`.
+
+  By the Woodbury identity, `R^-1 = D^-1 - D^-1 G M^-1 G^T D^-1`, where
+  `M = I + G^T D^-1 G` is only K x K. As a result, the cost is linear, rather
+  than cubic, in the number of sensors.
+
+  input:
+    z: row vector of sensor measurements (1 x I)
+    d: diagonal part of the sensor noise covariance matrix (I), positive
+    G: low rank factor of the sensor noise covariance matrix (I x K)
+    H: matrix mapping from state space to measurement space (I x S)
+
+  output:
+    - the mean of the system state distribution (1 x S)
+    - lower Cholesky factor of the system state precision matrix (S x S)
+  """
+
+  # the diagonal part, applied to H and z (H is on the left of each product so
+  # that it may be sparse)
+  DiH = scipy.sparse.diags(1 / d).dot(H)
+  Diz = np.transpose(np.asarray(z) / d)
+
+  # the posterior precision is H^T R^-1 H, and the posterior mean solves
+  # (H^T R^-1 H) x^T = H^T R^-1 z^T
+  J = as_dense(H.T.dot(DiH))
+  h = H.T.dot(Diz)
+
+  # the low rank correction, via the factor of the capacitance matrix (there
+  # is nothing to correct if the factor has no columns)
+  if G.shape[1] > 0:
+    DiG = G / d[:, None]
+    M = np.eye(G.shape[1]) + np.dot(G.T, DiG)
+    L = scipy.linalg.cholesky(M, lower=True)
+    GtDiH = np.transpose(DiH.T.dot(G))
+    A = scipy.linalg.solve_triangular(L, GtDiH, lower=True)
+    b = scipy.linalg.solve_triangular(L, np.dot(G.T, Diz), lower=True)
+    J = J - np.dot(A.T, A)
+    h = h - np.dot(A.T, b)
+
+  C = scipy.linalg.cholesky(J, lower=True)
+  x = scipy.linalg.cho_solve((C, True), h)
+  return (np.transpose(x), C)
+
+
+def solve_triangular_batch(L, B, trans=0):
+  """
+  Solve many lower triangular systems, like `scipy.linalg.solve_triangular`,
+  one per element of the leading axis. The systems are solved together in a
+  single stacked `np.linalg.solve`, which, for the small matrices used here,
+  is much faster than a Python loop over `scipy.linalg.solve_triangular`.
+
+  input:
+    L: stacked lower triangular matrices (N x M x M)
+    B: stacked right-hand sides (N x M x K)
+    trans (optional): 0 to solve `L X = B`, or 1 to solve `L^T X = B`
+
+  output:
+    the stacked solutions (N x M x K)
+  """
+  if trans:
+    L = np.transpose(L, (0, 2, 1))
+  return np.linalg.solve(L, B)
+
+
+def fuse_batch(Z, R, H):
+  """
+  Fuse many independent measurement distributions at once, given a single
+  linear mapping from state space to measurement space. This is equivalent to
+  calling `fuse_factored` once per row of `Z`, but the factorizations for all
+  rows are done in a single batch.
+
+  As in `fuse_factored`, each covariance matrix in `R` is Cholesky factored
+  once, and everything else is obtained by triangular solves against the two
+  factors; no matrix is explicitly inverted.
+
+  input:
+    Z: matrix of sensor measurements, one row per batch element (N x I)
+    R: stacked sensor noise covariance matrices (N x I x I), positive definite
+    H: matrix mapping from state space to measurement space (I x S)
+
+  output:
+    - the means of the system state distributions (N x S)
+    - stacked lower Cholesky factors of the system state precision matrices
+      (N x S x S)
+  """
+
+  # whiten inputs and measurements: with R = L L^T, let A = L^-1 H and
+  # b = L^-1 z^T, for every batch element
+  H = as_dense(H)
+  num_rows, num_inputs = Z.shape
+  L = np.linalg.cholesky(R)
+  Hs = np.broadcast_to(H, (num_rows,) + H.shape)
+  Ab = solve_triangular_batch(L, np.concatenate((Hs, Z[:, :, None]), axis=2))
+  A, b = Ab[:, :, :-1], Ab[:, :, -1:]
+
+  # the posterior precision is A^T A, and the posterior mean solves
+  # (A^T A) x^T = A^T b, by substitution against its factor, C C^T
+  At = np.transpose(A, (0, 2, 1))
+  C = np.linalg.cholesky(np.matmul(At, A))
+  y = solve_triangular_batch(C, np.matmul(At, b))
+  X = solve_triangular_batch(C, y, trans=1)
+  return (X[:, :, 0], C)
+
+
+def extract_variance_batch(X, C, W):
+  """
+  Extract many output distributions at once, given a single linear mapping
+  from state space to output space. This is equivalent to calling
+  `extract_variance` once per row of `X`.
+
+  input:
+    X: matrix of state means, one row per batch element (N x S)
+    C: stacked lower Cholesky factors of the state precision matrices
+      (N x S x S), as returned by `fuse_batch`
+    W: matrix mapping from state space to output space (O x S)
+
+  output:
+    - the means of the output distributions (N x O)
+    - the variance of each output variable (N x O)
+  """
+
+  # return the output means and variances
+  Wt = as_dense(W).T
+  V = solve_triangular_batch(C, np.broadcast_to(Wt, (C.shape[0],) + Wt.shape))
+  Y = np.dot(X, Wt)
+  return (Y, np.sum(np.square(V), axis=1))
+
+
 def eliminate(X):
   """
   Compute the canonical reduced row echelon form of the given matrix. The
@@ -219,3 +518,299 @@ def determine_statespace(H0, W0):
 
   # return H, W, and the indices of the rows of W0 that make up W
   return H, W, actual_rows
+
+
+def determine_statespace_float(H0, W0, tolerance=1e-9):
+  """
+  Return matrices mapping from latent statespace to input space and output
+  space, like `determine_statespace`, but using floating-point arithmetic.
+
+  The subspace spanned by the inputs is found with a singular value
+  decomposition of H0, and its dimension is the number of singular values
+  greater than `tolerance` relative to the largest. The subspace basis is
+  orthonormal, so H and W will generally differ from those returned by
+  `determine_statespace`, but they are equivalent in that they lead to the same
+  fused outputs (see `is_equivalent_statespace`). An output is considered to be
+  fully determined when the norm of the part of its row that lies outside of
+  the subspace is no more than `tolerance` relative to the norm of the row.
+
+  This is much faster than exact elimination for large numbers of locations,
+  at the cost of choosing a tolerance.
+
+  inputs:
+    H0: map from full statespace to inputs (I x S)
+    W0: map from full statespace to outputs (O x S)
+    tolerance (optional): the relative tolerance used to determine rank and
+      to determine which outputs are within the subspace
+
+  outputs:
+    - the matrix H, mapping subspace to inputs (I x S')
+    - the matrix W, mapping subspace to outputs (O' x S')
+    - list of row indices of W0 that make up W (O')
+  """
+
+  H0 = np.array(as_dense(H0), dtype=float)
+  W0 = np.array(as_dense(W0), dtype=float)
+
+  # find an orthonormal basis for the subspace spanned by the inputs
+  U, s, Vt = np.linalg.svd(H0, full_matrices=False)
+  rank = np.sum(s > tolerance * s[0]) if len(s) > 0 else 0
+  V = Vt[:rank, :].T
+
+  # only keep rows of W0 which are (numerically) within the subspace
+  W_actual = np.dot(W0, V)
+  residual = np.linalg.norm(W0 - np.dot(W_actual, V.T), axis=1)
+  norm = np.linalg.norm(W0, axis=1)
+  actual_rows = np.flatnonzero(residual <= tolerance * norm)
+
+  # return H, W, and the indices of the rows of W0 that make up W
+  return np.dot(H0, V), W_actual[actual_rows, :], actual_rows
+
+
+def is_equivalent_statespace(H1, W1, H2, W2, tolerance=1e-6):
+  """
+  Return whether two pairs of statespace matrices, for the same inputs and
+  outputs, are equivalent.
+
+  Statespaces are equivalent when they have the same dimension and they map
+  inputs to outputs in the same way. The second condition is checked by
+  comparing `W H^+`, which doesn't depend on the choice of basis.
+
+  inputs:
+    H1, W1: the first pair of matrices H and W
+    H2, W2: the second pair of matrices H and W
+    tolerance (optional): the absolute tolerance used to compare matrices
+
+  output:
+    True if the statespaces are equivalent, otherwise False
+  """
+
+  to_float = lambda X: np.array(as_dense(X), dtype=float)
+  H1, W1, H2, W2 = map(to_float, (H1, W1, H2, W2))
+  if H1.shape != H2.shape or W1.shape != W2.shape:
+    return False
+  WHp1 = np.dot(W1, np.linalg.pinv(H1))
+  WHp2 = np.dot(W2, np.linalg.pinv(H2))
+  return bool(np.allclose(WHp1, WHp2, rtol=0, atol=tolerance))
+
+
+def scale_to_integers(X):
+  """
+  Scale each row of the given matrix of Fractions (or integers) by the least
+  common multiple of its denominators, so that all elements become integers.
+
+  input:
+    X: the input matrix
+
+  output:
+    - a matrix of Python integers (dtype object), such that row `i` is equal to
+      row `i` of `X` multiplied by the `i`-th scale
+    - a vector of Python integer scales (dtype object), one per row
+  """
+
+  lcm = lambda a, b: a * b // math.gcd(a, b)
+  get_denominator = lambda x: Fraction(x).denominator
+  num_r, num_c = X.shape
+  scales = np.empty(num_r, dtype=object)
+  Y = np.empty((num_r, num_c), dtype=object)
+  for r in range(num_r):
+    scales[r] = functools.reduce(lcm, map(get_denominator, X[r, :]), 1)
+    Y[r, :] = [int(x * scales[r]) for x in X[r, :]]
+  return Y, scales
+
+
+def eliminate_fraction_free(X):
+  """
+  Compute the canonical reduced row echelon form of the given integer matrix,
+  without introducing fractions. The matrix is modified in-place.
+
+  This is Gauss-Jordan elimination by gcd-normalized cross-multiplication (not
+  Bareiss elimination): each step eliminates one column from all other rows at
+  once by cross-multiplying with the pivot row, and each changed row is then
+  divided by the greatest common divisor of its elements, which keeps the
+  integers small. Arithmetic is exact, on arbitrary precision Python integers
+  in arrays of dtype object, so numpy applies each operation elementwise in
+  Python rather than in vectorized machine arithmetic. It is faster than
+  `eliminate` because there are no Fractions to normalize after every
+  operation.
+
+  When elimination is complete, all pivots are scaled to a common integer `d`,
+  and the reduced row echelon form is `X / d`. This is the same matrix that
+  `eliminate` would compute from Fractions.
+
+  input:
+    X: the input matrix, with elements of type int and dtype object
+
+  output:
+    - the matrix in scaled reduced row echelon form
+    - the common pivot, `d`, by which the matrix is scaled
+  """
+
+  # helper function to divide the given rows by their greatest common divisor
+  def make_primitive(rows):
+    divisors = np.gcd.reduce(X[rows, :], axis=1)
+    divisors[divisors == 0] = 1
+    X[rows, :] //= divisors[:, None]
+
+  # dimensions
+  num_r, num_c = X.shape
+  make_primitive(np.arange(num_r))
+
+  # forward elimination and backward substitution, together
+  r, pivots = 0, []
+  for c in range(num_c):
+    if r == num_r:
+      break
+    nonzero = np.flatnonzero(X[r:, c] != 0)
+    if len(nonzero) == 0:
+      continue
+    i = r + nonzero[0]
+    if i != r:
+      temp = X[i, :].copy()
+      X[i, :] = X[r, :]
+      X[r, :] = temp
+    rows = np.flatnonzero(X[:, c] != 0)
+    rows = rows[rows != r]
+    if len(rows) > 0:
+      products = np.multiply.outer(X[rows, c], X[r, :])
+      X[rows, :] = X[r, c] * X[rows, :] - products
+      make_primitive(rows)
+    pivots.append(c)
+    r += 1
+
+  # scale all pivots to their least common multiple
+  lcm = lambda a, b: a * b // math.gcd(a, b)
+  d = functools.reduce(lcm, [abs(X[i, c]) for (i, c) in enumerate(pivots)], 1)
+  for (i, c) in enumerate(pivots):
+    X[i, :] *= d // X[i, c]
+
+  # return the result
+  return X, d
+
+
+class StatespaceBasis:
+  """
+  An exact basis for the subspace spanned by the rows of an integer matrix,
+  which can be extended with more rows without starting over.
+
+  The basis is kept in the scaled reduced row echelon form of
+  `eliminate_fraction_free`: rows of `B / d`, where each pivot column is zero
+  in all rows but one. Since that form is canonical, it doesn't matter in what
+  order, or in how many steps, rows are added. Instances are not modified once
+  constructed, so they can be shared.
+  """
+
+  def __init__(self, num_columns, B=None, d=1):
+    """
+    input:
+      num_columns: the dimension of the full space (S)
+      B (optional): basis rows, in scaled reduced row echelon form, with
+        elements of type int and dtype object; empty by default
+      d (optional): the common pivot by which `B` is scaled
+    """
+    if B is None:
+      B = np.zeros((0, num_columns), dtype=object)
+    self.B = B
+    self.d = d
+    self.columns = [int(np.flatnonzero(row != 0)[0]) for row in B]
+
+  def get_residual(self, X):
+    """
+    Return `X * d` minus the linear combination of basis vectors given by the
+    elements of `X` in the pivot columns. A row of the result is zero exactly
+    when the corresponding row of `X` is within the subspace.
+    """
+    residual = X * self.d
+    if self.columns:
+      residual -= np.dot(X[:, self.columns], self.B)
+    return residual
+
+  def contains(self, X):
+    """Return a boolean vector indicating which rows of X are in the span."""
+    return np.all(self.get_residual(X) == 0, axis=1)
+
+  def extend(self, X):
+    """
+    Return the basis of the subspace spanned by the rows of both this basis
+    and the given integer matrix (dtype object). If the subspace is unchanged,
+    because every new row is already in the span, this basis is returned
+    as-is, without any elimination.
+    """
+    residual = self.get_residual(X)
+    residual = residual[np.any(residual != 0, axis=1), :]
+    if residual.shape[0] == 0:
+      return self
+    B, d = eliminate_fraction_free(np.vstack((self.B, residual)))
+    B = B[np.any(B != 0, axis=1), :]
+    return StatespaceBasis(self.B.shape[1], B, d)
+
+
+def find_statespace(H0, W0):
+  """
+  Find the latent statespace for the given integer matrices, exactly, without
+  computing H and W themselves.
+
+  With the reduced row echelon form of H0 as the basis of statespace (as in
+  `determine_statespace`), each basis vector is zero in the pivot columns of
+  all other basis vectors. As a result, the coefficients of any vector within
+  the subspace are simply its elements in the pivot columns, so H and W are the
+  pivot columns of H0 and of the fully determined rows of W0.
+
+  Scaling the rows of either input (e.g. by population, in place of
+  population weights) doesn't change the result.
+
+  inputs:
+    H0: map from full statespace to inputs (I x S), with elements of type int
+      and dtype object
+    W0: map from full statespace to outputs (O x S), with elements of type int
+      and dtype object
+
+  outputs:
+    - list of column indices of H0 and W0 that make up statespace (S')
+    - list of row indices of W0 that are within statespace (O')
+  """
+
+  # find a basis for the subspace spanned by the inputs, then find the outputs
+  # that are within the subspace
+  basis = StatespaceBasis(H0.shape[1]).extend(H0)
+  actual_rows = np.flatnonzero(basis.contains(W0))
+
+  # return the statespace columns and the determined output rows
+  return basis.columns, actual_rows
+
+
+def determine_statespace_fraction_free(H0, W0):
+  """
+  Return matrices mapping from latent statespace to input space and output
+  space, exactly like `determine_statespace`, but using fraction-free integer
+  arithmetic internally.
+
+  Rows of the inputs are scaled to integers, and statespace is found with
+  `find_statespace`. H and W are then selected from the inputs, without any
+  matrix products. Since reduced row echelon form is canonical, the results are
+  identical to those of `determine_statespace`, element for element.
+
+  inputs:
+    H0: map from full statespace to inputs (I x S)
+    W0: map from full statespace to outputs (O x S)
+
+  outputs:
+    - the matrix H, mapping subspace to inputs (I x S')
+    - the matrix W, mapping subspace to outputs (O' x S')
+    - list of row indices of W0 that make up W (O')
+
+  notes:
+    - S' <= S and O' <= O
+    - inputs should be matrices of Fractions or integers; outputs have the same
+      element type as the inputs
+  """
+
+  # find statespace using integer arithmetic
+  H0i, H0_scales = scale_to_integers(H0)
+  W0i, W0_scales = scale_to_integers(W0)
+  columns, actual_rows = find_statespace(H0i, W0i)
+
+  # select H, W, and the indices of the rows of W0 that make up W
+  H = H0[:, columns]
+  W = W0[actual_rows, :][:, columns]
+  return H, W, actual_rows
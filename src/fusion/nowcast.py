@@ -56,6 +56,14 @@ class DataSource(abc.ABC):
 class Nowcast:
   """Produces nowcasts with a given data source and shrinkage strategy."""
 
+  # the maximum number of weeks fused together in a single batch, which bounds
+  # the memory used by stacked covariance matrices
+  MAX_BATCH_SIZE = 52
+
+  # memoizes shrinkage parameters by noise content, or None to always search;
+  # replace with an instance of `covariance.CovarianceCache` to enable
+  covariance_cache = None
+
   """
   Creates a new Nowcast instance with the given configuration.
 
@@ -64,15 +72,25 @@ class Nowcast:
     shrinkage (optional): a subclass of covariance.ShrinkageMethod
     min_observations (optional): the minimum number of observations required
       for any given (sensor, location) pair
+    output_locations (optional): a tuple of locations to nowcast, or None
+      (the default) to nowcast all possible locations
+    warm_start (optional): whether the search for each week's shrinkage
+      parameter starts from that of the previous week with the same inputs;
+      this is faster, but results may differ slightly from those of nowcasting
+      each week separately, so it's off by default
   """
   def __init__(
       self,
       data_source,
       shrinkage=covariance.BlendDiagonal2,
-      min_observations=5):
+      min_observations=5,
+      output_locations=None,
+      warm_start=False):
     self.data_source = data_source
     self.shrinkage = shrinkage
     self.min_observations = min_observations
+    self.output_locations = output_locations
+    self.warm_start = warm_start
 
   @staticmethod
   def get_season(epiweek):
@@ -82,6 +100,108 @@ class Nowcast:
       year -= 1
     return year
 
+  @staticmethod
+  def select_outputs(W, output_locations, selected_locations):
+    """
+    Return the rows of W, and the corresponding output locations, which are
+    among the selected locations. Output order is unchanged. If no locations
+    are selected (i.e. `selected_locations` is None), all outputs are returned.
+    """
+    if selected_locations is None:
+      return W, output_locations
+    selected_locations = set(selected_locations)
+    rows = [
+      i for (i, loc) in enumerate(output_locations)
+      if loc in selected_locations
+    ]
+    return W[rows, :], [output_locations[i] for i in rows]
+
+  @staticmethod
+  def fuse(noise, reading, shrinkage, H, input_columns=None):
+    """
+    Estimate sensor noise covariance and fuse sensor readings into a system
+    state distribution.
+
+    Shrinkage methods with a low rank representation (i.e. subclasses of
+    covariance.LowRankPlusDiagonal) are kept in factored form throughout.
+
+    inputs:
+      noise: matrix of past sensor noise (sensor readings minus truth)
+      reading: vector of current sensor readings
+      shrinkage: a subclass of covariance.ShrinkageMethod
+      H: matrix mapping from state space to measurement space
+      input_columns (optional): a list identifying the columns of `noise`
+        (see `fit_shrinkage`); if not given, the covariance cache isn't used
+
+    outputs:
+      - the mean of the system state distribution
+      - lower Cholesky factor of the system state precision matrix
+    """
+    method, alpha = Nowcast.fit_shrinkage(input_columns, noise, shrinkage)
+    if issubclass(shrinkage, covariance.LowRankPlusDiagonal):
+      d, G = method.get_factors(alpha)
+      return fusion.fuse_low_rank(reading, d, G, H)
+    return fusion.fuse_factored(reading, method.get_cov(alpha), H)
+
+  @staticmethod
+  def fit_shrinkage(
+      input_columns,
+      noise,
+      shrinkage,
+      prior_alpha=None,
+      statistics=None):
+    """
+    Fit the shrinkage method to the noise, skipping the search for the
+    shrinkage parameter if the same inputs and noise have been seen before (see
+    `Nowcast.covariance_cache`).
+
+    With the cache, entries are keyed on the numerator and denominator of
+    `covariance.nancov` of the noise, which determine the likelihood exactly.
+    These are given by `statistics`, if available, so that the noise itself
+    isn't read again; otherwise, they're computed from the noise.
+
+    inputs:
+      input_columns: a list identifying the columns of `noise`, for example
+        (sensor, location) pairs, or None to bypass the cache
+      noise: matrix of past sensor noise
+      shrinkage: a subclass of covariance.ShrinkageMethod
+      prior_alpha (optional): an initial guess of the shrinkage parameter
+      statistics (optional): a tuple of the numerator and denominator of
+        `covariance.nancov` of the noise, and the number of observations
+
+    outputs:
+      - the instance of `shrinkage`, fit to the noise
+      - the shrinkage parameter with maximum likelihood
+    """
+
+    low_rank = issubclass(shrinkage, covariance.LowRankPlusDiagonal)
+
+    # reuse a known shrinkage parameter, if possible
+    cache = Nowcast.covariance_cache
+    if input_columns is None:
+      cache = None
+    if cache is not None:
+      if statistics is None:
+        statistics = covariance.nancov(noise) + (noise.shape[0],)
+      key = cache.get_key(*statistics, input_columns, shrinkage)
+      alpha = cache.get(key)
+      if alpha is not None:
+        return shrinkage(*statistics), alpha
+
+    # otherwise, search for it
+    if low_rank:
+      method, alpha = covariance.fit_low_rank_shrinkage(
+          noise, shrinkage, prior_alpha)
+    elif statistics is not None:
+      method, alpha = covariance.fit_shrinkage_from_nancov(
+          *statistics, shrinkage, prior_alpha)
+    else:
+      method, alpha = covariance.fit_shrinkage(noise, shrinkage, prior_alpha)
+
+    if cache is not None:
+      cache.put(key, alpha)
+    return method, alpha
+
   @staticmethod
   def compute_nowcast(
       input_locations,
@@ -89,7 +209,9 @@ class Nowcast:
       reading,
       shrinkage,
       season=None,
-      exclude_locations=()):
+      exclude_locations=(),
+      output_locations=None,
+      input_columns=None):
     """
     Computes a nowcast via sensor fusion.
 
@@ -105,25 +227,130 @@ class Nowcast:
       exclude_locations (optional): a tuple of atomic locations that should be
         excluded from statespace (i.e. because num_providers is known to be
         zero)
+      output_locations (optional): a tuple of locations to nowcast; only the
+        posterior of these locations is computed; by default, all possible
+        locations are nowcasted
+      input_columns (optional): a list of (sensor, location) pairs,
+        corresponding to columns of `noise`, which identify the inputs in the
+        covariance cache (see `fit_shrinkage`); by default, the inputs are
+        identified by `input_locations` alone
 
     outputs:
       - The nowcast for this week; a tuple of (location, (w)ILI, stdev) tuples.
+        Requested output locations which can't be determined from the inputs
+        are omitted.
     """
 
-    # determine statespace and estimate covariance
-    H, W, output_locations = UsFusion.determine_statespace(
-        input_locations, season=season, exclude_locations=exclude_locations)
-    R = covariance.mle_cov(noise, shrinkage)
+    # determine statespace, and keep only the requested outputs
+    H, W, all_outputs = UsFusion.determine_statespace(
+        input_locations,
+        season=season,
+        exclude_locations=exclude_locations,
+        sparse=True)
+    W, outputs = Nowcast.select_outputs(W, all_outputs, output_locations)
+
+    # estimate covariance and apply the sensor fusion kernel, keeping only the
+    # output variance
+    if input_columns is None:
+      input_columns = input_locations
+    x, C = Nowcast.fuse(noise, reading, shrinkage, H, input_columns)
+    y, variance = fusion.extract_variance(x, C, W)
+    stdev = np.sqrt(variance)
 
-    # apply the sensor fusion kernel
-    x, P = fusion.fuse(reading, R, H)
-    y, S = fusion.extract(x, P, W)
+    # return the nowcast for this week
+    return tuple(zip(outputs, y, stdev))
 
-    # extract standard deviation vector from posterior covariance
-    stdev = np.sqrt(np.diag(S))
+  @staticmethod
+  def compute_nowcast_batch(
+      input_locations,
+      noises,
+      readings,
+      shrinkage,
+      season=None,
+      exclude_locations=(),
+      output_locations=None,
+      warm_start=False,
+      noise_statistics=None,
+      input_columns=None):
+    """
+    Computes nowcasts via sensor fusion for several weeks which share the same
+    inputs, and therefore the same statespace.
 
-    # return the nowcast for this week
-    return tuple(zip(output_locations, y, stdev))
+    This is equivalent to calling `compute_nowcast` once per week, except that
+    the statespace is determined once, and the sensor fusion kernel is applied
+    to all weeks in a single batch.
+
+    Optionally, the search for each week's shrinkage parameter can start from
+    that of the previous week. Consecutive weeks have nearly the same noise, so
+    this needs far fewer likelihood evaluations, but the result may differ
+    slightly from that of `compute_nowcast`.
+
+    inputs:
+      input_locations: a list of locations, corresponding to columns of each
+        matrix in `noises` and each vector in `readings`
+      noises: a list of matrices of past sensor noise, one per week
+      readings: a list of vectors of current sensor readings, one per week
+      shrinkage: a subclass of covariance.ShrinkageMethod
+      season (optional): the first year of the season that contains the
+        epiweeks being nowcasted
+      exclude_locations (optional): a tuple of atomic locations that should be
+        excluded from statespace
+      output_locations (optional): a tuple of locations to nowcast; by
+        default, all possible locations are nowcasted
+      warm_start (optional): whether to start each week's search for the
+        shrinkage parameter from the previous week's optimum; weeks are assumed
+        to be in chronological order
+      noise_statistics (optional): a list of tuples, one per week, of the
+        numerator and denominator of `covariance.nancov` of the noise, and the
+        number of observations (see `covariance.NancovAccumulator`); if given,
+        covariance is estimated from these rather than from `noises`, except
+        with low rank shrinkage methods
+      input_columns (optional): a list, one per week, of (sensor, location)
+        pairs corresponding to columns of each matrix in `noises`, which
+        identify the inputs in the covariance cache (see `fit_shrinkage`); by
+        default, the inputs are identified by `input_locations` alone
+
+    outputs:
+      - A list of nowcasts, one per week. Each nowcast is a tuple of
+        (location, (w)ILI, stdev) tuples.
+    """
+
+    # determine statespace, and keep only the requested outputs
+    H, W, all_outputs = UsFusion.determine_statespace(
+        input_locations,
+        season=season,
+        exclude_locations=exclude_locations,
+        sparse=True)
+    W, outputs = Nowcast.select_outputs(W, all_outputs, output_locations)
+
+    # estimate covariance for each week, possibly starting from the shrinkage
+    # parameter of the previous week
+    low_rank = issubclass(shrinkage, covariance.LowRankPlusDiagonal)
+    methods, alpha = [], None
+    for index, noise in enumerate(noises):
+      prior_alpha = alpha if warm_start else None
+      statistics, columns = None, input_locations
+      if noise_statistics is not None:
+        statistics = noise_statistics[index]
+      if input_columns is not None:
+        columns = input_columns[index]
+      method, alpha = Nowcast.fit_shrinkage(
+          columns, noise, shrinkage, prior_alpha, statistics)
+      methods.append((method, alpha))
+
+    if low_rank:
+      # the factored kernel is already cheap, so apply it to each week
+      fuse = lambda m, r: fusion.fuse_low_rank(r, *m[0].get_factors(m[1]), H)
+      X, C = map(np.array, zip(*map(fuse, methods, readings)))
+    else:
+      # fuse all weeks at once
+      R = np.array([method.get_cov(alpha) for (method, alpha) in methods])
+      X, C = fusion.fuse_batch(np.array(readings), R, H)
+    Y, variance = fusion.extract_variance_batch(X, C, W)
+    stdev = np.sqrt(variance)
+
+    # return the nowcast for each week
+    return [tuple(zip(outputs, y, s)) for (y, s) in zip(Y, stdev)]
 
   def get_sensor_data_for_all_weeks(self, test_weeks):
     """
@@ -220,13 +447,39 @@ class Nowcast:
         - a vector of sensor readings for nowcasting
     """
 
-    # select training data in the past relative to this week
-    train_weeks = self.data_source.get_weeks()[:sensor_noise.shape[0]]
-    past_weeks = np.array(train_weeks) < week
-    noise = sensor_noise[past_weeks, :]
+    # find the rows and columns of training data to use
+    keep_rows, keep_columns = self.select_sensor_data_for_week(
+        inputs, sensor_noise, week, week_reading, exclude_locations)
+
+    # the list of locations corresponding to non-empty columns
+    selected_inputs = list(itertools.compress(inputs, keep_columns))
+    input_locations = tuple(loc for (name, loc) in selected_inputs)
 
-    # select all rows with at least one observation
-    noise_present = np.isfinite(noise)
+    # remove rows and columns not selected above
+    noise = sensor_noise[keep_rows, :][:, keep_columns]
+    week_reading = week_reading[keep_columns]
+
+    # return column definitions and data
+    return input_locations, noise, week_reading
+
+  def select_sensor_data_for_week(
+      self, inputs, sensor_noise, week, week_reading, exclude_locations=()):
+    """
+    Return the rows and columns of training data which are used for the given
+    week (see `get_sensor_data_for_week`), without copying any data.
+
+    output:
+      a tuple consisting of:
+        - a boolean vector selecting rows of `sensor_noise`
+        - a boolean vector selecting columns of `sensor_noise`, and elements
+          of `week_reading`
+    """
+
+    # select training data in the past relative to this week, in all rows
+    # with at least one observation
+    train_weeks = self.data_source.get_weeks()[:sensor_noise.shape[0]]
+    past_weeks = np.array(train_weeks, dtype=int) < week
+    noise_present = np.isfinite(sensor_noise) & past_weeks[:, None]
     keep_rows = np.any(noise_present, axis=1)
 
     # select all columns with at least N observations
@@ -238,16 +491,87 @@ class Nowcast:
     keep_locs = [loc not in exclude_locations for (name, loc) in inputs]
     keep_columns = np.logical_and(keep_columns, keep_locs)
 
-    # the list of locations corresponding to non-empty columns
-    selected_inputs = list(itertools.compress(inputs, keep_columns))
-    input_locations = tuple(loc for (name, loc) in selected_inputs)
+    # return the selection
+    return keep_rows, keep_columns
 
-    # remove rows and columns not selected above
-    noise = noise[keep_rows, :][:, keep_columns]
-    week_reading = week_reading[keep_columns]
+  def group_weeks_by_statespace(self, test_weeks):
+    """
+    Return training and testing data for the given weeks, grouped by the
+    arguments that determine statespace.
 
-    # return column definitions and data
-    return input_locations, noise, week_reading
+    input:
+      test_weeks: a list of epiweeks for which nowcasts should be generated
+
+    output:
+      a dict mapping from a tuple of (input locations, season, excluded
+      locations) to a list of (index, noise, reading, statistics, columns)
+      tuples, where index is the position of the week in `test_weeks`,
+      statistics is a tuple of the numerator and denominator of
+      `covariance.nancov` of the noise, and the number of observations, and
+      columns is a tuple of (sensor, location) pairs corresponding to columns
+      of the noise
+    """
+
+    # collect all training and testing data up-front
+    inputs, noise, readings = self.get_sensor_data_for_all_weeks(test_weeks)
+
+    # training data grows by about a row per week, so summarize it
+    # incrementally rather than from scratch each week
+    accumulator = covariance.NancovAccumulator(noise.shape[1])
+    added_rows = np.zeros(noise.shape[0], dtype=bool)
+
+    # get training and testing data "as of" each week, and group together
+    # weeks which share the same statespace
+    groups = {}
+    for index, (week, week_reading) in enumerate(zip(test_weeks, readings)):
+
+      # possibly exclude non-reporting locations (retrospective nowcasts only)
+      exclude_locations = tuple(self.data_source.get_missing_locations(week))
+
+      # update the summary of training data, and select this week's columns
+      rows, columns = self.select_sensor_data_for_week(
+          inputs, noise, week, week_reading, exclude_locations)
+      accumulator.append(noise[rows & ~added_rows, :])
+      accumulator.remove(noise[added_rows & ~rows, :])
+      added_rows = rows
+      statistics = accumulator.get_nancov(columns) + (accumulator.num_obs,)
+
+      week_inputs, week_noise, week_reading = self.get_sensor_data_for_week(
+          inputs, noise, week, week_reading, exclude_locations)
+
+      season = Nowcast.get_season(week)
+      key = (week_inputs, season, exclude_locations)
+      week_columns = tuple(itertools.compress(inputs, columns))
+      entry = (index, week_noise, week_reading, statistics, week_columns)
+      groups.setdefault(key, []).append(entry)
+
+    # return the groups
+    return groups
+
+  def precompute_statespaces(self, test_weeks):
+    """
+    Determine, and thereby cache, the statespace of each of the given weeks
+    without nowcasting. This is intended to warm up a persistent statespace
+    cache (see `UsFusion.statespace_cache`) in advance of nowcasting.
+
+    input:
+      test_weeks: a list of epiweeks for which nowcasts will be generated
+
+    output:
+      the number of distinct statespaces, including any without inputs
+    """
+
+    groups = self.group_weeks_by_statespace(test_weeks)
+    for week_inputs, season, exclude_locations in groups.keys():
+      if not week_inputs:
+        # there is no training data, so there is nothing to precompute
+        continue
+      UsFusion.determine_statespace(
+          week_inputs,
+          season=season,
+          exclude_locations=exclude_locations,
+          sparse=True)
+    return len(groups)
 
   def batch_nowcast(self, test_weeks):
     """
@@ -260,7 +584,8 @@ class Nowcast:
 
     Despite retraining, batched nowcasting (i.e. calling with multiple test
     weeks) is more efficient than repeated calls because some data structures
-    are shared across iterations.
+    are shared across iterations, and because weeks with the same inputs are
+    fused together in batches.
 
     input:
       test_weeks: a list of epiweeks for which nowcasts should be generated
@@ -283,32 +608,34 @@ class Nowcast:
         'with algorithm %s' % cov_impl
     )
 
-    # collect all training and testing data up-front
-    inputs, noise, readings = self.get_sensor_data_for_all_weeks(test_weeks)
-
-    # nowcast each week separately
-    weekly_nowcasts = []
-    for week, week_reading in zip(test_weeks, readings):
-
-      # possibly exclude non-reporting locations (retrospective nowcasts only)
-      exclude_locations = self.data_source.get_missing_locations(week)
-
-      # get training and testing data "as of" the current week
-      week_inputs, week_noise, week_reading = self.get_sensor_data_for_week(
-          inputs, noise, week, week_reading, exclude_locations)
-
-      # generate the nowcast in all possible locations for this week
-      season = Nowcast.get_season(week)
-      nowcast = Nowcast.compute_nowcast(
-          week_inputs,
-          week_noise,
-          week_reading,
-          self.shrinkage,
-          season=season,
-          exclude_locations=exclude_locations)
-      weekly_nowcasts.append(nowcast)
-
-      # show progress
+    # get training and testing data, grouped by statespace
+    groups = self.group_weeks_by_statespace(test_weeks)
+
+    # generate nowcasts in all possible locations, one batch at a time
+    weekly_nowcasts = [None] * len(test_weeks)
+    for (week_inputs, season, exclude_locations), group in groups.items():
+      for start in range(0, len(group), Nowcast.MAX_BATCH_SIZE):
+        batch = group[start:start + Nowcast.MAX_BATCH_SIZE]
+        indices, week_noises, week_readings, statistics, columns = zip(*batch)
+        nowcasts = Nowcast.compute_nowcast_batch(
+            week_inputs,
+            week_noises,
+            week_readings,
+            self.shrinkage,
+            season=season,
+            exclude_locations=exclude_locations,
+            output_locations=self.output_locations,
+            warm_start=self.warm_start,
+            noise_statistics=statistics,
+            input_columns=columns)
+        for index, nowcast in zip(indices, nowcasts):
+          weekly_nowcasts[index] = nowcast
+
+    # show progress
+    for week, nowcast in zip(test_weeks, weekly_nowcasts):
+      if not nowcast:
+        print('[%d] no requested locations can be nowcasted' % week)
+        continue
       row = nowcast[0]
       args = (week, row[0], row[1], row[2])
       print('[%d] %s: %.3f (%.3f)' % args)
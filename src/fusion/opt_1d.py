@@ -9,27 +9,86 @@ The function to optimize doesn't have to be convex, but it is assumed that it
 has a single maximum and is monotonically decreasing away from that maximum in
 both directions.
 
+The search stops once the interval containing the maximum is narrow enough, in
+absolute or relative terms, or once a fixed number of points have been
+evaluated, so that the worst-case cost of each search is known in advance.
+
 More general optimization problems can be solved using, for example, the
 Nelder-Mead algorithm.
 
 See also: neldermead.py
 """
 
+# standard library
+import math
+
+# third party
+import numpy as np
+
+
+class MemoizedObjective:
+  """
+  Wraps an objective function, remembering its value at each point, so that
+  no point is evaluated more than once, and counting evaluations. The same
+  instance may be shared by several searches (for example, `find_bracket`
+  followed by `maximize`) over the same function.
+  """
+
+  def __init__(self, objective):
+    self.objective = objective
+    self.values = {}
+    self.evaluations = 0
+    self.hits = 0
+
+  def __call__(self, point):
+    if point in self.values:
+      self.hits += 1
+      return self.values[point]
+    self.evaluations += 1
+    value = self.values[point] = self.objective(point)
+    return value
+
+  def get_stats(self):
+    """Return the number of evaluations and of repeated points."""
+    return {'evaluations': self.evaluations, 'hits': self.hits}
 
-def maximize(low, high, objective, stop):
+
+def maximize(
+    low,
+    high,
+    objective,
+    stop=None,
+    tolerance=None,
+    rel_tolerance=None,
+    max_evaluations=None,
+    log_scale=False):
   """
   Find the scalar argument which maximizes the objective function. The search
   space is bounded to the closed interval [low, high].
 
+  The search stops as soon as any of the given stopping criteria are met, at
+  least one of which is required. Points are never evaluated more than once.
+  To count evaluations, pass an instance of `MemoizedObjective`, in which case
+  any evaluations it has already made count toward `max_evaluations`.
+
   input:
     low: the lower bound of the search interval
     high: the upper bound of the search interval
     objective: an objective function, which takes and returns a scalar
-    stop: a function which returns whether the search should be stopped, given
-        the following parameters:
-      - number of times the objective function has been called
+    stop (optional): a function which returns whether the search should be
+        stopped, given the following parameters:
+      - number of times the objective function has been evaluated
       - width of the current search interval
       - the maximum value of the objective function so far
+    tolerance (optional): stop when the width of the search interval is at
+      most this
+    rel_tolerance (optional): stop when the width of the search interval is
+      at most this fraction of the magnitude of the best argument so far
+    max_evaluations (optional): stop before the objective function would be
+      evaluated more than this many times; at least 4
+    log_scale (optional): whether to search over `log(1 + x - low)` rather
+      than `x`, so that the resolution of the search is proportional to the
+      distance from the lower bound
 
   output:
     a tuple consisting of:
@@ -44,41 +103,190 @@ def maximize(low, high, objective, stop):
   # equal to the remaining values. Its point -- the argmin -- is iteratively
   # updated. If the argmax is not on the boundary, then the argmin is updated
   # to bisect the two argmax points. Otherwise, the two argmin points are
-  # updated to trisect the two argmax points. Iteration continues until the
-  # stop function returns truth.
+  # updated to trisect the two argmax points. Iteration continues until a
+  # stopping criterion is met.
+
+  criteria = (stop, tolerance, rel_tolerance, max_evaluations)
+  if all(criterion is None for criterion in criteria):
+    raise Exception('at least one stopping criterion is required')
+  if max_evaluations is not None and max_evaluations < 4:
+    raise Exception('at least four evaluations are required')
+  if not isinstance(objective, MemoizedObjective):
+    objective = MemoizedObjective(objective)
+
+  # map between the search space and the argument of the objective function,
+  # keeping the bounds exact
+  if log_scale:
+    x_low, x_high, top = low, high, math.log1p(high - low)
+    unscale = lambda u: x_high if u == top else x_low + math.expm1(u)
+    low, high = 0, top
+  else:
+    unscale = lambda u: u
+  evaluate = lambda u: objective(unscale(u))
 
   diff = high - low
   a, b, c, d = low, low + 1 / 3 * diff, low + 2 / 3 * diff, high
-  w, x, y, z = [objective(i) for i in (a, b, c, d)]
+  w, x, y, z = [evaluate(i) for i in (a, b, c, d)]
   argmax = lambda: max(enumerate([w, x, y, z]), key=lambda k: k[1])[0]
-  n = 4
   i = argmax()
-  while not stop(n, d - a, [w, x, y, z][i]):
+  while True:
+    # check each stopping criterion
+    best = unscale([a, b, c, d][i])
+    width = unscale(d) - unscale(a)
+    n = objective.evaluations
+    if stop is not None and stop(n, width, [w, x, y, z][i]):
+      break
+    if tolerance is not None and width <= tolerance:
+      break
+    if rel_tolerance is not None and width <= rel_tolerance * abs(best):
+      break
+    if not a < b < c < d:
+      # the interval can't be divided any further
+      break
+    cost = 2 if i in (0, 3) else 1
+    if max_evaluations is not None and n + cost > max_evaluations:
+      break
+
+    # update the points
     if i == 0:
       diff = b - a
       b, c, d = a + 1 / 3 * diff, a + 2 / 3 * diff, b
-      x, y, z = objective(b), objective(c), x
-      n += 2
+      x, y, z = evaluate(b), evaluate(c), x
     elif i == 3:
       diff = d - c
       a, b, c = c, c + 1 / 3 * diff, c + 2 / 3 * diff
-      w, x, y = y, objective(b), objective(c)
-      n += 2
+      w, x, y = y, evaluate(b), evaluate(c)
     elif i == 1:
       if c - b > b - a:
         c, d = (b + c) / 2, c
-        y, z = objective(c), y
+        y, z = evaluate(c), y
       else:
         b, c, d = (a + b) / 2, b, c
-        x, y, z = objective(b), x, y
-      n += 1
+        x, y, z = evaluate(b), x, y
     else:
       if d - c > c - b:
         a, b, c = b, c, (c + d) / 2
-        w, x, y = x, y, objective(c)
+        w, x, y = x, y, evaluate(c)
       else:
         a, b = b, (b + c) / 2
-        w, x = x, objective(b)
-      n += 1
+        w, x = x, evaluate(b)
     i = argmax()
-  return ([a, b, c, d][i], [w, x, y, z][i])
+  return (unscale([a, b, c, d][i]), [w, x, y, z][i])
+
+
+def maximize_batch(low, high, batch_objective, stop, batch_size):
+  """
+  Find the scalar argument which maximizes the objective function, like
+  `maximize`, but propose points in batches. This is appropriate when the
+  objective function can evaluate many points in a single, vectorized call
+  much faster than it can evaluate them one at a time.
+
+  Initially, `batch_size` points are evenly spaced within the search interval.
+  On each subsequent iteration, the interval shrinks to the neighbors of the
+  best point so far, and `batch_size` new points are evenly spaced on either
+  side of the best point. The interval shrinks by a factor of about
+  `batch_size / 2 + 1` per call to the objective function.
+
+  input:
+    low: the lower bound of the search interval
+    high: the upper bound of the search interval
+    batch_objective: an objective function, which takes a numpy.ndarray of
+      arguments and returns a numpy.ndarray of values
+    stop: a function which returns whether the search should be stopped (see
+      `maximize`)
+    batch_size: the number of points evaluated per call to the objective
+      function, not including the bounds, which are evaluated on the first
+      call; at least 2
+
+  output:
+    a tuple consisting of:
+      - the argument which maximizes the objective function
+      - the maximum value of the objective function
+  """
+
+  if batch_size < 2:
+    raise Exception('batch size must be at least 2')
+
+  # evaluate the bounds and the first batch of points together
+  points = np.linspace(low, high, batch_size + 2)
+  values = np.asarray(batch_objective(points), dtype=float)
+  n = len(points)
+  i = int(np.argmax(values))
+
+  while not stop(n, points[-1] - points[0], values[i]):
+    # zoom in on the neighbors of the best point, evaluating new points on
+    # either side of it (or only inward, if it's on the boundary)
+    j, k = max(i - 1, 0), min(i + 1, len(points) - 1)
+    if j == i:
+      num_left = 0
+    elif k == i:
+      num_left = batch_size
+    else:
+      num_left = batch_size // 2
+    num_right = batch_size - num_left
+    left = np.linspace(points[j], points[i], num_left + 2)[1:-1]
+    right = np.linspace(points[i], points[k], num_right + 2)[1:-1]
+    new_values = batch_objective(np.concatenate((left, right)))
+    new_values = np.asarray(new_values, dtype=float)
+    n += batch_size
+
+    # keep the best point and its neighbors, with their known values
+    points_list = [left, [points[i]], right]
+    values_list = [new_values[:num_left], [values[i]], new_values[num_left:]]
+    if j != i:
+      points_list.insert(0, [points[j]])
+      values_list.insert(0, [values[j]])
+    if k != i:
+      points_list.append([points[k]])
+      values_list.append([values[k]])
+    points = np.concatenate(points_list)
+    values = np.concatenate(values_list)
+    i = int(np.argmax(values))
+
+  return (points[i], values[i])
+
+
+def find_bracket(low, high, guess, width, objective):
+  """
+  Find an interval around a guess which contains the maximum of the objective
+  function, within the closed interval [low, high]. The search starts with the
+  interval [guess - width, guess + width] and moves uphill, doubling the step
+  each time, only as needed.
+
+  When a good guess is available (for example, the result of a previous,
+  similar optimization), the returned interval can be much narrower than the
+  full interval, so that `maximize` needs far fewer calls to the objective
+  function.
+
+  input:
+    low: the lower bound of the search space
+    high: the upper bound of the search space
+    guess: the point at which to start the search
+    width: the initial distance from the guess to either end of the interval
+    objective: an objective function, which takes and returns a scalar
+
+  output:
+    a tuple consisting of the lower and upper bounds of an interval containing
+    the maximum
+  """
+
+  b = min(max(guess, low), high)
+  a, c = max(low, b - width), min(high, b + width)
+  x, y, z = objective(a), objective(b), objective(c)
+
+  # a flat objective (e.g. negative infinity everywhere) gives no direction
+  if x == y == z:
+    return low, high
+
+  # move the interval uphill until the middle point is the highest
+  while True:
+    if x > y and x >= z and a > low:
+      width *= 2
+      a, b, c = max(low, a - width), a, b
+      x, y, z = objective(a), x, y
+    elif z > y and z > x and c < high:
+      width *= 2
+      a, b, c = b, c, min(high, c + width)
+      x, y, z = y, z, objective(c)
+    else:
+      return a, c
@@ -16,11 +16,15 @@ output space.
 """
 
 # standard library
+import collections
 from fractions import Fraction
-import functools
+import hashlib
+import os
+import pickle
 
 # third party
 import numpy as np
+import scipy.sparse
 
 # first party
 import delphi.nowcast.fusion.fusion as fusion
@@ -28,40 +32,295 @@ from delphi.utils.geo.locations import Locations
 from delphi.utils.geo.populations import get_population
 
 
+class StatespaceCache:
+  """
+  Memoizes statespace by input locations, season, excluded atoms, and options.
+  The same few patterns of inputs recur week after week, so exact elimination
+  rarely needs to be repeated. If a directory is given, statespaces are also
+  stored on disk so that they can be shared across runs, and so that they can
+  be computed in advance (see `Nowcast.precompute_statespaces`).
+
+  Statespaces without a season are not stored on disk, since they depend on
+  the most recent population estimates, which change over time.
+
+  Only a limited number of statespaces are kept in memory, with the least
+  recently used forgotten first. Files on disk are never removed.
+  """
+
+  # bump whenever statespace determination changes, invalidating files on disk
+  VERSION = 1
+
+  def __init__(self, directory=None, max_entries=16):
+    """
+    input:
+      directory (optional): where to store statespaces, or None to keep them
+        in memory only
+      max_entries (optional): the maximum number of statespaces kept in memory
+    """
+    self.directory = directory
+    self.max_entries = max_entries
+    self.statespaces = collections.OrderedDict()
+    self.hits = 0
+    self.loads = 0
+    self.misses = 0
+
+  def get_stats(self):
+    """Return the number of memory hits, disk hits, and misses."""
+    return {'hits': self.hits, 'loads': self.loads, 'misses': self.misses}
+
+  def get_filename(self, key):
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    name = 'statespace_v%d_%s.pickle' % (StatespaceCache.VERSION, digest)
+    return os.path.join(self.directory, name)
+
+  def is_persistent(self, key):
+    return self.directory is not None and key[1] is not None
+
+  def load(self, key):
+    """Return the stored statespace, or None if it's missing."""
+    if not self.is_persistent(key):
+      return None
+    filename = self.get_filename(key)
+    if not os.path.isfile(filename):
+      return None
+    with open(filename, 'rb') as f:
+      stored_key, statespace = pickle.load(f)
+    # guard against hash collisions
+    if stored_key != key:
+      return None
+    return statespace
+
+  def save(self, key, statespace):
+    if not self.is_persistent(key):
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    filename = self.get_filename(key)
+    # write to a temporary file first so that readers never see partial files
+    temp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp, 'wb') as f:
+      pickle.dump((key, statespace), f)
+    os.replace(temp, filename)
+
+  def get(self, key, compute):
+    """
+    Return the statespace for the given key, calling `compute` to determine
+    it if it isn't already known. The key is a tuple of (input locations,
+    season, excluded atoms, ...).
+    """
+    if key in self.statespaces:
+      self.hits += 1
+      self.statespaces.move_to_end(key)
+      return self.statespaces[key]
+    statespace = self.load(key)
+    if statespace is None:
+      self.misses += 1
+      statespace = compute()
+      self.save(key, statespace)
+    else:
+      self.loads += 1
+    self.statespaces[key] = statespace
+    while len(self.statespaces) > self.max_entries:
+      self.statespaces.popitem(last=False)
+    return statespace
+
+
+class IncrementalStatespace:
+  """
+  Finds exact statespace by updating the decomposition of a previously seen
+  set of input locations, rather than eliminating from scratch.
+
+  From one week to the next, inputs usually differ by only a location or two,
+  for example when a territory starts reporting. Decompositions (see
+  `fusion.StatespaceBasis`) are kept for recent sets of inputs, and the
+  largest known subset of the requested inputs is extended with the rows of
+  the remaining locations. New rows which are already within the span cost
+  only a matrix product, and output locations which were already within
+  statespace are not checked again.
+
+  Removing a location can shrink statespace, which can't be undone in place.
+  If no subset of the inputs has been seen, as is the case when locations are
+  only removed, statespace is found from scratch.
+  """
+
+  # the number of decompositions kept for each season and set of exclusions
+  MAX_DECOMPOSITIONS = 64
+
+  def __init__(self):
+    self.decompositions = {}
+    self.reused = 0
+    self.extended = 0
+    self.full = 0
+
+  def get_stats(self):
+    """Return the number of exact reuses, extensions, and full recomputes."""
+    return {'reused': self.reused, 'extended': self.extended, 'full': self.full}
+
+  def find_statespace(
+      self, input_locations, season, exclude_locations, locations, P):
+    """
+    Return statespace like `fusion.find_statespace`.
+
+    inputs:
+      input_locations: a tuple of sensor locations
+      season: the season (year), or None, as in `determine_statespace`
+      exclude_locations: a tuple of excluded atoms
+      locations: list of all locations, corresponding to rows of P
+      P: integer population matrix of all locations, either sparse or dense,
+        with columns corresponding to the atoms which aren't excluded; only
+        the rows that are eliminated or checked are converted to dense rows
+        of Python integers (dtype object)
+
+    outputs:
+      - list of column indices of P that make up statespace (S')
+      - list of row indices of P that are within statespace (O')
+    """
+
+    if not set(input_locations) <= set(locations):
+      raise Exception('inputs are not among the given locations')
+
+    # exact elimination needs arbitrary precision integers
+    get_rows = lambda rows: fusion.as_dense(P[rows, :]).astype(object)
+
+    context = (season, tuple(exclude_locations))
+    decompositions = self.decompositions.setdefault(context, {})
+    inputs = frozenset(input_locations)
+
+    if inputs in decompositions:
+      self.reused += 1
+      basis, determined = decompositions[inputs]
+    else:
+      # start from the largest known subset of the inputs, if any
+      subsets = [known for known in decompositions if known <= inputs]
+      if subsets:
+        self.extended += 1
+        known = max(subsets, key=len)
+        basis, determined = decompositions[known]
+      else:
+        self.full += 1
+        known = frozenset()
+        basis = fusion.StatespaceBasis(P.shape[1])
+        determined = np.zeros(len(locations), dtype=bool)
+
+      # add the new locations, and check outputs only if the span grew
+      rows = [i for (i, loc) in enumerate(locations) if loc in inputs - known]
+      new_basis = basis.extend(get_rows(rows))
+      if new_basis is not basis:
+        undetermined = np.flatnonzero(~determined)
+        determined = determined.copy()
+        determined[undetermined] = new_basis.contains(get_rows(undetermined))
+      basis = new_basis
+
+      # remember the result, forgetting the oldest if there are too many
+      if len(decompositions) >= IncrementalStatespace.MAX_DECOMPOSITIONS:
+        del decompositions[next(iter(decompositions))]
+      decompositions[inputs] = (basis, determined)
+
+    return basis.columns, np.flatnonzero(determined)
+
+
 class UsFusion:
   """Prepares for sensor fusion of signals based on US regions and states."""
 
   __known_statespace = {}
 
+  # methods for determining statespace:
+  #   - exact: exact arithmetic (see `fusion.determine_statespace`)
+  #   - float: floating-point arithmetic with a numerical tolerance
+  #   - verify: float, but checked against exact; an Exception is raised if the
+  #     two disagree
+  METHODS = ('exact', 'float', 'verify')
+
+  # statespace is memoized, optionally on disk; replace to configure
+  statespace_cache = StatespaceCache()
+
+  # exact statespace is found incrementally from similar inputs
+  incremental_statespace = IncrementalStatespace()
+
+  # precomputed map from (location, atom) to membership, indexed by
+  # `Locations.region_map` keys and by `Locations.atom_list`
+  membership = None
+
+  # table of atom populations by season, filled in as needed
+  atom_populations = {}
+
   @staticmethod
-  def get_weight_row(location, season, atoms):
+  def get_membership_matrix(locations, atoms):
     """
-    Return a list of the population weights of all atoms, with respect to the
-    given location. Atoms not within the location will have a weight of zero.
-    The returned weights will sum to one.
+    Return a boolean matrix, where rows correspond to the given locations,
+    columns correspond to the given atomic locations, and an element is true
+    when the atom is within the location.
     """
 
-    # check each atom individually
-    total_population = 0
-    atom_populations = []
+    # precompute membership of all atoms in all locations, once
+    if UsFusion.membership is None:
+      all_locations = list(Locations.region_map.keys())
+      all_atoms = list(Locations.atom_list)
+      is_member = np.zeros((len(all_locations), len(all_atoms)), dtype=bool)
+      atom_index = dict((atom, i) for (i, atom) in enumerate(all_atoms))
+      for row, location in enumerate(all_locations):
+        for atom in Locations.region_map[location]:
+          if atom in atom_index:
+            is_member[row, atom_index[atom]] = True
+      location_index = dict((loc, i) for (i, loc) in enumerate(all_locations))
+      UsFusion.membership = (location_index, atom_index, is_member)
+
+    # select the given locations and atoms
+    location_index, atom_index, is_member = UsFusion.membership
+    rows = [location_index[location] for location in locations]
+    cols = [atom_index[atom] for atom in atoms]
+    return is_member[rows, :][:, cols]
+
+  @staticmethod
+  def get_atom_populations(season, atoms):
+    """
+    Return a vector of the populations of the given atoms, in the given season
+    or, by default, in the most recent season.
+    """
+
+    table = UsFusion.atom_populations.setdefault(season, {})
     for atom in atoms:
-      if atom in Locations.region_map[location]:
+      if atom not in table:
         if season:
-          population = get_population(atom, season)
+          table[atom] = get_population(atom, season)
         else:
-          population = get_population(atom)
-      else:
-        population = 0
-      total_population += population
-      atom_populations.append(population)
+          table[atom] = get_population(atom)
+    return np.array([table[atom] for atom in atoms], dtype=np.int64)
+
+  @staticmethod
+  def get_population_array(locations, season, atoms):
+    """
+    Return a dense matrix of integer populations, where rows correspond to the
+    given locations and columns correspond to the given atomic locations. Atoms
+    not within the location have a population of zero.
+    """
+
+    # only look up populations of atoms which are within some location, since
+    # not all atoms have populations in all seasons
+    is_member = UsFusion.get_membership_matrix(locations, atoms)
+    needed = np.flatnonzero(np.any(is_member, axis=0))
+    populations = np.zeros(len(atoms), dtype=np.int64)
+    populations[needed] = UsFusion.get_atom_populations(
+        season, [atoms[i] for i in needed])
+    P = is_member * populations[None, :]
 
     # sanity check
-    if total_population == 0:
+    empty = np.flatnonzero(np.all(P == 0, axis=1))
+    if len(empty) > 0:
+      location = locations[empty[0]]
       raise Exception(('location has no constituent atoms', location))
 
-    # return list of fractional populations
-    get_fraction = lambda pop: Fraction(pop, total_population)
-    return list(map(get_fraction, atom_populations))
+    # return the matrix
+    return P
+
+  @staticmethod
+  def get_weight_row(location, season, atoms):
+    """
+    Return a list of the population weights of all atoms, with respect to the
+    given location. Atoms not within the location will have a weight of zero.
+    The returned weights will sum to one.
+    """
+
+    return list(UsFusion.get_weight_matrix([location], season, atoms)[0, :])
 
   @staticmethod
   def get_weight_matrix(locations, season, atoms):
@@ -70,23 +329,69 @@ class UsFusion:
     and columns correspond to the given atomic locations.
     """
 
-    # stack rows for each location and return the matrix
-    get_row = lambda loc: UsFusion.get_weight_row(loc, season, atoms)
-    return np.array(list(map(get_row, locations)))
+    # divide each row of populations by its total, exactly; most atoms aren't
+    # within most locations, so only nonzero populations need a `Fraction`
+    P = UsFusion.get_population_array(locations, season, atoms)
+    totals = np.sum(P, axis=1)
+    rows, cols = np.nonzero(P)
+    weights = np.full(P.shape, Fraction(0), dtype=object)
+    divide = np.frompyfunc(Fraction, 2, 1)
+    weights[rows, cols] = divide(
+        P[rows, cols].astype(object), totals[rows].astype(object))
+    return weights
+
+  @staticmethod
+  def get_population_matrix(locations, season, atoms):
+    """
+    Return a sparse matrix of populations, where rows correspond to the given
+    locations and columns correspond to the given atomic locations. Atoms not
+    within the location are not stored.
+
+    Dividing each row by its sum gives the same weights as `get_weight_matrix`.
+    """
+
+    P = UsFusion.get_population_array(locations, season, atoms)
+    return scipy.sparse.csr_matrix(P)
+
+  @staticmethod
+  def get_weights_from_populations(populations):
+    """
+    Return a sparse matrix of weights, given a sparse matrix of populations
+    (see `get_population_matrix`). Each row of weights sums to one.
+
+    Each weight is computed by a single division, so it is exactly the float
+    nearest to the corresponding `Fraction` from `get_weight_row`.
+    """
+
+    totals = np.asarray(populations.sum(axis=1), dtype=float).ravel()
+    weights = populations.astype(float)
+    weights.data /= np.repeat(totals, np.diff(weights.indptr))
+    return weights
+
+  @staticmethod
+  def get_sparse_weight_matrix(locations, season, atoms):
+    """
+    Return a sparse matrix of weights, like `get_weight_matrix`, except that
+    elements are floats and zeros are not stored.
+    """
+
+    populations = UsFusion.get_population_matrix(locations, season, atoms)
+    return UsFusion.get_weights_from_populations(populations)
 
   @staticmethod
-  @functools.lru_cache(maxsize=16)
   def determine_statespace(
       input_locations,
       season=None,
-      exclude_locations=()):
+      exclude_locations=(),
+      method='exact',
+      sparse=False):
     """
     Return matrices mapping from latent statespace to input space and output
     space. These are the matrices H and W, respectively, used in the sensor
     fusion kernel. A list of output locations corresponding to the rows of W is
     also returned.
 
-    Results are cached for better performance.
+    Results are cached for better performance (see `statespace_cache`).
 
     inputs:
       input_locations: a tuple of sensor locations
@@ -98,6 +403,13 @@ class UsFusion:
         statespace. This is generally only helpful for retrospective nowcasts
         where it is known that some state or territory was not reporting and,
         therefore, was not included in regional or national wILI.
+      method (optional): How statespace is determined; one of `METHODS`. The
+        float method scales to many more locations, but the result depends on
+        a numerical tolerance. The verify method uses the float method and
+        checks the result against the exact method.
+      sparse (optional): Whether to return H and W as scipy.sparse matrices.
+        The exact method selects statespace from the columns of the sparse
+        population weight matrices, so its results remain sparse.
 
     outputs:
       - the matrix H, mapping subspace to inputs
@@ -105,9 +417,26 @@ class UsFusion:
       - tuple of output locations, corresponding to rows of W
     """
 
-    # quick sanity check
+    # quick sanity checks
     if set(exclude_locations) & set(input_locations):
       raise Exception('input contains excluded locations')
+    if method not in UsFusion.METHODS:
+      raise Exception('unknown method: %s' % method)
+
+    # return the cached statespace, computing it if necessary
+    input_locations = tuple(input_locations)
+    exclude_locations = tuple(exclude_locations)
+    key = (input_locations, season, exclude_locations, method, sparse)
+    compute = lambda: UsFusion.compute_statespace(*key)
+    return UsFusion.statespace_cache.get(key, compute)
+
+  @staticmethod
+  def compute_statespace(
+      input_locations, season, exclude_locations, method, sparse):
+    """
+    Return matrices mapping from latent statespace to input space and output
+    space, without caching. See `determine_statespace`.
+    """
 
     # function to filter out excluded atoms
     atom_filter = lambda a: a not in exclude_locations
@@ -119,19 +448,46 @@ class UsFusion:
     atoms = list(filter(atom_filter, Locations.atom_list))
 
     # precursors of the H and W matrices, assuming that statespace is US atoms
-    get_matrix = lambda locs: UsFusion.get_weight_matrix(locs, season, atoms)
-    H0 = get_matrix(input_locations)
-    W0 = get_matrix(all_locations)
+    get_pop = lambda locs: UsFusion.get_population_matrix(locs, season, atoms)
+    H0_pop = get_pop(input_locations)
+    W0_pop = get_pop(all_locations)
+    H0 = UsFusion.get_weights_from_populations(H0_pop)
+    W0 = UsFusion.get_weights_from_populations(W0_pop)
+
+    # function to find the exact statespace, using integer populations
+    def get_exact_statespace():
+      columns, rows = UsFusion.incremental_statespace.find_statespace(
+          input_locations,
+          season,
+          exclude_locations,
+          all_locations,
+          W0_pop)
+      return H0[:, columns], W0[rows, :][:, columns], rows
 
     # optimization for the typical case where all US atoms are represented
     if set(input_locations) >= set(atoms):
       # statespace is all US atoms, so H and W are already correct
       H, W, output_locations = H0, W0, all_locations
-    else:
+    elif method == 'exact':
       # determine optimal H and W matrices
-      H, W, selected_rows = fusion.determine_statespace(H0, W0)
+      H, W, selected_rows = get_exact_statespace()
+      # select the output locations
+      output_locations = [all_locations[i] for i in selected_rows]
+    else:
+      # determine equivalent H and W matrices numerically
+      H, W, selected_rows = fusion.determine_statespace_float(H0, W0)
+      if method == 'verify':
+        H1, W1, rows1 = get_exact_statespace()
+        if list(rows1) != list(selected_rows):
+          raise Exception('float and exact outputs differ', input_locations)
+        if not fusion.is_equivalent_statespace(H, W, H1, W1):
+          raise Exception('float and exact maps differ', input_locations)
       # select the output locations
       output_locations = [all_locations[i] for i in selected_rows]
 
-    # convert fractions to floats and return the result
-    return H.astype(np.float), W.astype(np.float), output_locations
+    # return the result, either sparse or dense
+    if sparse:
+      H, W = scipy.sparse.csr_matrix(H), scipy.sparse.csr_matrix(W)
+    else:
+      H, W = fusion.as_dense(H), fusion.as_dense(W)
+    return H, W, output_locations
@@ -12,6 +12,7 @@ import argparse
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
 from delphi.nowcast.fusion.nowcast import Nowcast
+from delphi.nowcast.fusion.us_fusion import StatespaceCache, UsFusion
 from delphi.nowcast.util.flu_data_source import FluDataSource
 from delphi.nowcast.util.nowcasts_table import NowcastsTable
 from delphi.utils.epiweek import add_epiweeks, range_epiweeks
@@ -73,6 +74,26 @@ class NowcastUpdate:
       # update the timestamp
       db.set_last_update_time()
 
+  def warmup(self, first_week, last_week):
+    """
+    Precompute the statespace of each week in the given range, which defaults
+    to all weeks with data, without nowcasting.
+    """
+
+    # default to all weeks, including the first week without ilinet data
+    if not last_week:
+      weeks = self.data_source.get_weeks()
+      first_week, last_week = min(weeks), add_epiweeks(max(weeks), 1)
+    print('precomputing statespace for %d--%d' % (first_week, last_week))
+
+    # prefetch bulk data
+    self.data_source.prefetch(last_week)
+
+    # determine statespace on all weeks
+    weeks = list(range_epiweeks(first_week, last_week, inclusive=True))
+    num = Nowcast(self.data_source).precompute_statespaces(weeks)
+    print('%d statespaces, %s' % (num, UsFusion.statespace_cache.get_stats()))
+
 
 def get_argument_parser():
   """Define command line arguments and usage."""
@@ -89,6 +110,13 @@ def get_argument_parser():
       '--test',
       action='store_true',
       help='generate a nowcast but do not write it to the database')
+  parser.add_argument(
+      '--statespace-cache',
+      help='directory in which to persist statespace across runs')
+  parser.add_argument(
+      '--warmup',
+      action='store_true',
+      help='precompute statespace (all weeks by default); do not nowcast')
   return parser
 
 
@@ -106,5 +134,17 @@ def main(first, last, test):
   NowcastUpdate.new_instance(test).update(first, last)
 
 
+def warmup(first, last):
+  """Precompute statespace from the command line."""
+  NowcastUpdate.new_instance(True).warmup(first, last)
+
+
 if __name__ == '__main__':
-  main(*validate_args(get_argument_parser().parse_args()))
+  args = get_argument_parser().parse_args()
+  if args.statespace_cache:
+    UsFusion.statespace_cache = StatespaceCache(args.statespace_cache)
+  first, last, test = validate_args(args)
+  if args.warmup:
+    warmup(first, last)
+  else:
+    main(first, last, test)
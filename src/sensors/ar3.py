@@ -29,6 +29,7 @@ import numpy as np
 
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
+from delphi.nowcast.sensors import incremental_regression
 import delphi.operations.secrets as secrets
 import delphi.utils.epiweek as EW
 
@@ -123,6 +124,14 @@ class AR3:
     X = self._get_features(epiweek, valid=valid)
     return float(AR3.dot(X, self.model)[0, 0])
 
+  def predict_range(self, first, last, valid=True):
+    """
+    Predict each epiweek in the inclusive range [first, last], training
+    incrementally (see incremental_regression.py).
+    """
+    return incremental_regression.predict_range(
+        self, first, last, self._get_features, 8, valid=valid)
+
 
 if __name__ == '__main__':
   # args and usage
@@ -29,6 +29,13 @@ See also:
 === Changelog ===
 =================
 
+2026-10-18
+  * deterministic, budgeted optimizer instead of time-limited NelderMead
+  * score the (shift, scale) grid in a single vectorized pass
+  + predict_range, rebuilding the Archetype only when a season completes
+  + cache Archetypes by region and training seasons, optionally on disk
+  * build partial trajectories from wILI issues downloaded once per season
+  + ARCHBatch, scoring the grid search of many regions in a single pass
 2016-04-11
   * allow predictions using invalid (stable) data
   - don't produce predictions during the off-season
@@ -38,23 +45,100 @@ See also:
 
 # standard library
 import argparse
+import os
 
 # third party
 import numpy as np
-from undefx.undef_analysis.neldermead import NelderMead
 
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
 from delphi.nowcast.sensors.archetype import Archetype
+from delphi.nowcast.sensors.local_optimizer import NelderMead
 import delphi.utils.epiweek as EW
 
 
+class ArchetypeCache:
+  """
+  Memoizes Archetypes by region and training seasons. The set of completed
+  seasons only changes once per year, so the same Archetype can be reused for
+  every week of a season. If a directory is given, Archetypes are also stored
+  on disk so that they can be shared across runs.
+  """
+
+  # bump whenever Archetype construction changes, invalidating files on disk
+  VERSION = 2
+
+  def __init__(self, directory=None):
+    self.directory = directory
+    self.archetypes = {}
+
+  @staticmethod
+  def is_current(version, model, curves):
+    """Return whether a cached Archetype can still be used for these curves."""
+    if version != ArchetypeCache.VERSION:
+      return False
+    # the Archetype is stale if training data has since been revised
+    stored = model.curves
+    return len(stored) == len(curves) and np.allclose(stored, curves)
+
+  def get_filename(self, region, years):
+    args = (ArchetypeCache.VERSION, region, '_'.join(map(str, years)))
+    name = 'archetype_v%d_%s_%s.pickle' % args
+    return os.path.join(self.directory, name)
+
+  def load(self, region, years, curves):
+    """Return the stored Archetype, or None if it's missing or stale."""
+    if self.directory is None:
+      return None
+    filename = self.get_filename(region, years)
+    if not os.path.isfile(filename):
+      return None
+    model = Archetype.load(filename)
+    if not ArchetypeCache.is_current(ArchetypeCache.VERSION, model, curves):
+      return None
+    return model
+
+  def save(self, region, years, model):
+    if self.directory is None:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    filename = self.get_filename(region, years)
+    # write to a temporary file first so that readers never see partial files
+    temp = '%s.%d.tmp' % (filename, os.getpid())
+    model.save(temp)
+    os.replace(temp, filename)
+
+  def get(self, region, years, curves):
+    """Return the Archetype for the given region and training seasons."""
+    key = (region, tuple(years))
+    if key in self.archetypes:
+      # in-memory entries are validated the same way as files on disk
+      version, model = self.archetypes[key]
+      if ArchetypeCache.is_current(version, model, curves):
+        return model
+    model = self.load(region, years, curves)
+    if model is None:
+      model = Archetype(curves)
+      self.save(region, years, model)
+    self.archetypes[key] = (ArchetypeCache.VERSION, model)
+    return model
+
+
 class ARCH:
 
-  def __init__(self, region):
+  # shared by all instances; may be replaced with a disk-backed cache
+  archetype_cache = ArchetypeCache()
+
+  def __init__(self, region, optimizer=None):
     self.region = region
+    if optimizer is None:
+      optimizer = NelderMead(
+          max_iterations=1024, max_evaluations=4096, vectorized=True)
+    self.optimizer = optimizer
     weeks = Epidata.range(200330, 202330)
     rows = Epidata.check(Epidata.fluview(self.region, weeks))
+    self.stable = dict((row['epiweek'], row['wili']) for row in rows)
+    self.vintages = {}
     self.seasons = {}
     for row in rows:
       ew, wili = row['epiweek'], row['wili']
@@ -78,80 +162,140 @@ class ARCH:
     self.years = sorted(list(self.seasons.keys()))
     self.curves = dict([(y, curve(y)) for y in self.years])
 
+  def _get_season_data(self, year):
+    """
+    Return the epiweeks of the season starting in the given year, stable wILI
+    on those weeks, and a map from each issue in the season to the wILI that
+    was published in that issue. Issues are downloaded only once per season,
+    unless the download fails, in which case it's retried on the next call.
+    """
+    if year not in self.vintages:
+      ew1 = EW.join_epiweek(year, 30)
+      ew2 = EW.add_epiweeks(EW.join_epiweek(year + 1, 30), -1)
+      epiweeks = list(EW.range_epiweeks(ew1, ew2, inclusive=True))
+      ew2i = dict((ew, i) for (i, ew) in enumerate(epiweeks))
+      stable = np.array([self.stable.get(ew, np.nan) for ew in epiweeks])
+      weeks = Epidata.range(ew1, ew2)
+      response = Epidata.fluview(self.region, weeks, issues=weeks)
+      if response['result'] == -2:
+        # no issues were published (e.g. in census regions)
+        rows = []
+      else:
+        # other failures may be transient, so they're raised, not cached
+        rows = Epidata.check(response)
+      issues = {}
+      for row in rows:
+        ew, issue, value = row['epiweek'], row['issue'], row['wili']
+        if ew not in ew2i:
+          continue
+        if issue not in issues:
+          issues[issue] = np.full(len(epiweeks), np.nan)
+        issues[issue][ew2i[ew]] = value
+      self.vintages[year] = (epiweeks, stable, issues)
+    return self.vintages[year]
+
   def _get_partial_trajectory(self, epiweek, valid=True):
     y, w = EW.split_epiweek(epiweek)
     if w < 30:
       y -= 1
-    ew1 = EW.join_epiweek(y, 30)
-    ew2 = epiweek
-    limit = EW.add_epiweeks(ew2, -5)
-    weeks = Epidata.range(ew1, ew2)
-    stable = Epidata.check(Epidata.fluview(self.region, weeks))
-    try:
-      unstable = Epidata.check(Epidata.fluview(self.region, weeks, issues=ew2))
-    except:
-      unstable = []
-    wili = {}
-    for row in stable:
-      ew, value = row['epiweek'], row['wili']
-      if not valid or ew < limit:
-        wili[ew] = value
-    for row in unstable:
-      ew, value = row['epiweek'], row['wili']
-      wili[ew] = value
-    curve = []
-    for ew in EW.range_epiweeks(ew1, ew2, inclusive=True):
-      if ew not in wili:
-        if valid:
-          t = 'unstable'
-        else:
-          t = 'any'
-        raise Exception('wILI (%s) not available for week %d' % (t, ew))
-      curve.append(wili[ew])
-    n1 = EW.delta_epiweeks(ew1, ew2) + 1
-    n2 = len(curve)
-    if n1 != n2:
-      raise Exception('missing data (expected %d, found %d)' % (n1, n2))
+    epiweeks, stable, issues = self._get_season_data(y)
+    n = epiweeks.index(epiweek) + 1
+    curve = stable[:n].copy()
+    if valid:
+      # stable wILI is only valid for weeks at least 5 weeks before the issue
+      curve[max(n - 6, 0):] = np.nan
+    if epiweek in issues:
+      unstable = issues[epiweek][:n]
+      available = np.isfinite(unstable)
+      curve[available] = unstable[available]
+    missing = np.flatnonzero(np.isnan(curve))
+    if len(missing) > 0:
+      if valid:
+        t = 'unstable'
+      else:
+        t = 'any'
+      ew = epiweeks[missing[0]]
+      raise Exception('wILI (%s) not available for week %d' % (t, ew))
     return curve
 
-  def _fit(self, curve):
+  @staticmethod
+  def _get_bins():
     # parameters
     min_shift, max_shift, n_shift = -10, +10, 32
     min_scale, max_scale, n_scale = 1 / 4, 4, 32
     # calculate parameter bins
     shifts = np.linspace(min_shift, max_shift, n_shift)
     scales = np.linspace(min_scale, max_scale, n_scale)
-    d_shift, d_scale = shifts[1] - shifts[0], scales[1] - scales[0]
-    bins = [[(t, s) for s in scales] for t in shifts]
-    samples = []
+    return shifts, scales
+
+  @staticmethod
+  def _get_target(model, curve):
     # extend partial trajectory
     i = len(curve)
-    test = np.array(curve + list(self.model.mean[i:]))
-    weights = 1 / np.sqrt(self.model.var)
+    test = np.concatenate((curve, model.mean[i:]))
+    weights = 1 / np.sqrt(model.var)
     weights[i - 5:i] *= 2
-    # objective function for best fit
-    def objective(params):
-      shift, scale = params
-      if not (-11 <= shift <= +11) or not (1 / 5 <= scale <= 5):
-        return 1e6
-      arch = self.model.instance(scale, shift, True)
-      score = np.mean(np.square(weights * (test - arch)))
-      return score
-    # get score of curve in center of each bin
-    grid = np.zeros((n_shift, n_scale))
-    for (t, shift) in enumerate(shifts):
-      for (s, scale) in enumerate(scales):
-        grid[t, s] = objective((shift, scale))
-    # convert scores to PMF
-    grid = np.exp(-grid)
-    grid /= np.sum(grid)
-    # find best bin index
-    best = np.unravel_index(np.argmax(grid), grid.shape)
+    return test, weights
+
+  @staticmethod
+  def _search_grid(models, curves):
+    """
+    Return the center of the best (shift, scale) bin for each pair of
+    Archetype and partial trajectory. The bins of all pairs are scored
+    together in a single vectorized pass. All trajectories must have the same
+    length (i.e. be as of the same week).
+    """
+    shifts, scales = ARCH._get_bins()
+    targets = [ARCH._get_target(m, c) for (m, c) in zip(models, curves)]
+    tests = np.array([test for (test, weights) in targets])
+    weights = np.array([weights for (test, weights) in targets])
+    # stack rotated Archetypes as a (regions x shifts x weeks) array
+    rotated = np.array([m.rotations(m.mean, shifts) for m in models])
+    baselines = np.array([m.baseline for m in models])[:, np.newaxis]
+    holidays = np.array([m.holiday for m in models])
+    size = rotated.shape[2]
+    # The weighted residual of each instance is `a - scale * c`, so the mean
+    # squared residual is a quadratic in scale. This avoids materializing every
+    # (region, shift, scale, week) instance.
+    a = weights * (tests - baselines / holidays)
+    c = (weights / holidays)[:, np.newaxis, :]
+    c = c * (rotated - baselines[:, :, np.newaxis])
+    aa = np.sum(np.square(a), axis=1)[:, np.newaxis, np.newaxis]
+    ac = np.einsum('rw,rtw->rt', a, c)[:, :, np.newaxis]
+    cc = np.sum(np.square(c), axis=2)[:, :, np.newaxis]
+    s = scales[np.newaxis, np.newaxis, :]
+    grids = (aa - 2 * s * ac + np.square(s) * cc) / size
+    guesses = []
+    for grid in grids:
+      # convert scores to PMF (shifted by the minimum to avoid underflow)
+      grid = np.exp(np.min(grid) - grid)
+      grid /= np.sum(grid)
+      # find best bin index
+      best = np.unravel_index(np.argmax(grid), grid.shape)
+      guesses.append((shifts[best[0]], scales[best[1]]))
+    return guesses
+
+  def _fit(self, curve, guess=None):
+    shifts, scales = ARCH._get_bins()
+    d_shift, d_scale = shifts[1] - shifts[0], scales[1] - scales[0]
+    test, weights = ARCH._get_target(self.model, curve)
+    # objective function for best fit, evaluated at many points at once
+    def batch_objective(points):
+      shift, scale = points[:, 0], points[:, 1]
+      rotated = self.model.rotations(self.model.mean, shift)
+      archs = self.model.scale(rotated, scale[:, np.newaxis])
+      archs /= self.model.holiday
+      scores = np.mean(np.square(weights * (test - archs)), axis=1)
+      in_bounds = (np.abs(shift) <= 11) & (1 / 5 <= scale) & (scale <= 5)
+      return np.where(in_bounds, scores, 1e6)
+    objective = lambda params: batch_objective(np.array([params]))[0]
+    # start from the best bin of the grid, unless already known
+    if guess is None:
+      guess = ARCH._search_grid([self.model], [curve])[0]
     # optimize parameters
-    guess = bins[best[0]][best[1]]
-    solver = NelderMead(objective, limit_iterations=1024, limit_time=0.5, silent=True)
-    simplex = solver.get_simplex(len(guess), guess, max([d_shift, d_scale]))
-    best = solver.run(simplex)._location
+    step = max([d_shift, d_scale])
+    best, value = self.optimizer.minimize(
+        objective, guess, step, batch_objective=batch_objective)
     # if the best fit is worse (edge case), use the original guess
     obj0, obj1 = objective(guess), objective(best)
     if np.isclose(obj0, obj1) or obj0 < obj1:
@@ -160,17 +304,22 @@ class ARCH:
     shift, scale = best
     return self.model.instance(scale, shift, True)
 
-  def train(self, epiweek):
-    curves = []
+  def _get_training_years(self, epiweek):
+    years = []
     for year in self.years:
       season_end = EW.join_epiweek(year + 1, 29)
       if epiweek >= season_end:
-        curves.append(self.curves[year])
-    self.model = Archetype(curves)
+        years.append(year)
+    return tuple(years)
+
+  def train(self, epiweek):
+    years = self._get_training_years(epiweek)
+    curves = [self.curves[year] for year in years]
+    self.model = ARCH.archetype_cache.get(self.region, years, curves)
     self.training_week = epiweek
     return curves, self.model
 
-  def predict(self, epiweek, train=True, valid=True):
+  def _get_curve(self, epiweek, train=True, valid=True):
     if train:
       self.train(epiweek)
     if self.training_week > epiweek:
@@ -182,17 +331,132 @@ class ARCH:
     #  return float(self.model.mean[-(30 - w)])
     if 20 <= w < 39:
       raise Exception('no prediction on weeks 21--39')
-    curve = self._get_partial_trajectory(epiweek, valid=valid)
+    return self._get_partial_trajectory(epiweek, valid=valid)
+
+  def predict(self, epiweek, train=True, valid=True):
+    curve = self._get_curve(epiweek, train=train, valid=valid)
     arch = self._fit(curve)
     return float(arch[len(curve)])
 
+  def predict_range(self, first, last, valid=True):
+    """
+    Predict each epiweek in the inclusive range [first, last].
+
+    This is equivalent to calling `predict` on each week, except that the
+    Archetype is only rebuilt when the set of completed training seasons
+    changes, which happens once per year.
+
+    input:
+      first: the first most recently published issue
+      last: the last most recently published issue
+      valid (optional): whether to require unstable wILI
+
+    output:
+      a tuple consisting of:
+        - an array of predictions, with nan on weeks that can't be predicted
+        - a list of reasons (Exceptions) for missing predictions, or None
+    """
+    epiweeks = list(EW.range_epiweeks(first, last, inclusive=True))
+    predictions = np.full(len(epiweeks), np.nan)
+    reasons = [None] * len(epiweeks)
+    trained_years = None
+    for (n, epiweek) in enumerate(epiweeks):
+      try:
+        years = self._get_training_years(epiweek)
+        if years != trained_years:
+          trained_years = None
+          self.train(epiweek)
+          trained_years = years
+        else:
+          self.training_week = epiweek
+        predictions[n] = self.predict(epiweek, train=False, valid=valid)
+      except Exception as ex:
+        reasons[n] = ex
+    return predictions, reasons
+
+
+class ARCHBatch:
+  """
+  ARCH in many regions at once. Each region keeps its own data and Archetype
+  (see ARCH), but on each week the (shift, scale) grid search of all regions
+  is scored together in a single vectorized pass.
+  """
+
+  def __init__(self, regions, optimizer=None):
+    self.regions = list(regions)
+    self.models = []
+    self.failures = {}
+    for (i, region) in enumerate(self.regions):
+      try:
+        self.models.append(ARCH(region, optimizer=optimizer))
+      except Exception as ex:
+        self.models.append(None)
+        self.failures[i] = ex
+
+  def predict(self, epiweek, train=True, valid=True):
+    """
+    Predict the given epiweek in all regions.
+
+    output:
+      a tuple consisting of:
+        - an array of predictions, with nan in regions that can't be predicted
+        - a list of reasons (Exceptions) for missing predictions, or None
+    """
+    predictions = np.full(len(self.regions), np.nan)
+    reasons = [self.failures.get(i) for i in range(len(self.regions))]
+    # get the partial trajectory in each region
+    fittable = []
+    for (i, arch) in enumerate(self.models):
+      if arch is None:
+        continue
+      try:
+        curve = arch._get_curve(epiweek, train=train, valid=valid)
+        fittable.append((i, curve))
+      except Exception as ex:
+        reasons[i] = ex
+    if not fittable:
+      return predictions, reasons
+    # search all grids at once, then refine each fit individually
+    models = [self.models[i].model for (i, curve) in fittable]
+    curves = [curve for (i, curve) in fittable]
+    guesses = ARCH._search_grid(models, curves)
+    for ((i, curve), guess) in zip(fittable, guesses):
+      try:
+        arch = self.models[i]._fit(curve, guess=guess)
+        predictions[i] = float(arch[len(curve)])
+      except Exception as ex:
+        reasons[i] = ex
+    return predictions, reasons
+
+  def predict_range(self, first, last, valid=True):
+    """
+    Predict each epiweek in the inclusive range [first, last] in all regions.
+
+    output:
+      a tuple consisting of:
+        - a matrix of predictions (weeks x regions), with nan where a week
+          can't be predicted
+        - a list of lists of reasons (Exceptions) for missing predictions, or
+          None
+    """
+    epiweeks = list(EW.range_epiweeks(first, last, inclusive=True))
+    predictions = np.full((len(epiweeks), len(self.regions)), np.nan)
+    reasons = []
+    for (n, epiweek) in enumerate(epiweeks):
+      predictions[n, :], week_reasons = self.predict(epiweek, valid=valid)
+      reasons.append(week_reasons)
+    return predictions, reasons
+
 
 if __name__ == '__main__':
   # args and usage
   parser = argparse.ArgumentParser()
   parser.add_argument('epiweek', type=int, help='most recently published epiweek (best 201030+)')
   parser.add_argument('region', type=str, help='region (nat, hhs, cen)')
+  parser.add_argument('--cache', type=str, help='directory of stored Archetypes')
   args = parser.parse_args()
+  if args.cache:
+    ARCH.archetype_cache = ArchetypeCache(args.cache)
 
   # options
   ew1, reg = args.epiweek, args.region
@@ -10,6 +10,12 @@ An empirical flu model.
 === Changelog ===
 =================
 
+2026-10-18
+  * Build from a (seasons x weeks) matrix with batched smoothing, rotation,
+    and holiday model objective
+  * Deterministic, budgeted optimizer instead of time-limited NelderMead
+  + Save and load to/from disk
+  + Batched rotations over many shifts
 2015-11-09
   * Fixed [add|remove]_holiday_week
 2015-10-30
@@ -25,35 +31,52 @@ An empirical flu model.
 
 # standard library
 from math import floor, ceil
+import pickle
 
 # third party
 import numpy as np
 import numpy.linalg as linalg
 import scipy.stats as stats
-from undefx.undef_analysis.neldermead import NelderMead
+
+# first party
+from delphi.nowcast.sensors.local_optimizer import NelderMead
 
 
 class Archetype:
 
-  def __init__(self, curves, week0=30, bandwidth=2, window=17, baseline=None):
+  def __init__(
+      self,
+      curves,
+      week0=30,
+      bandwidth=2,
+      window=17,
+      baseline=None,
+      optimizer=None):
     if window % 2 != 1:
       raise Exception('window length must be odd')
-    self.curves = [np.array(c) for c in curves]
+    if optimizer is None:
+      optimizer = NelderMead(
+          max_iterations=100,
+          max_evaluations=400,
+          tolerance=1e-3,
+          vectorized=True)
+    self.optimizer = optimizer
+    self.curves = np.array(curves, dtype=float)
     self.week0 = week0
     self.bandwidth = bandwidth
     norm = stats.norm(window // 2, bandwidth)
-    prob = lambda i: norm.cdf(i + 0.5) - norm.cdf(i - 0.5)
-    self.kernel = np.array([prob(i) for i in range(window)])
+    self.kernel = np.diff(norm.cdf(np.arange(window + 1) - 0.5))
     if not np.isclose(self.kernel[0], self.kernel[-1]):
       raise Exception('window must be symmetric')
     self.w2i = dict([(w, (52 + w - self.week0) % 52) for w in range(1, 53)])
     self.i2w = dict([(v, k) for (k, v) in self.w2i.items()])
     self.holiday = self.build_holiday_model()
-    self.curves_nh = [c * self.holiday for c in self.curves]
-    self.curves_nh_sm = [self.smooth(c) for c in self.curves_nh]
-    alignment = [25 - self.w2i[self.peakweek(c)] for c in self.curves_nh_sm]
-    self.curves_nh_al = [self.rotate(c, a) for (c, a) in zip(self.curves_nh, alignment)]
-    self.curves_nh_sm_al = [self.rotate(c, a) for (c, a) in zip(self.curves_nh_sm, alignment)]
+    # curves are rows of a (seasons x weeks) matrix
+    self.curves_nh = self.curves * self.holiday
+    self.curves_nh_sm = self.smooth(self.curves_nh)
+    alignment = 25 - np.argmax(self.curves_nh_sm, axis=1)
+    self.curves_nh_al = self.rotations(self.curves_nh, alignment)
+    self.curves_nh_sm_al = self.rotations(self.curves_nh_sm, alignment)
     self.smoothed_mean = np.mean(self.curves_nh_sm_al, axis=0)
     self.unsmoothed_mean = np.mean(self.curves_nh_al, axis=0)
     self.unaligned_unsmoothed_mean = np.mean(self.curves_nh, axis=0)
@@ -81,49 +104,69 @@ class Archetype:
       w1, w2 = n2 - n, n - n1
       return w1 * np.roll(curve, n1) + w2 * np.roll(curve, n2)
 
+  def rotations(self, curves, shifts):
+    """
+    Return `rotate(curve, n)` for each `n` in shifts, stacked as rows. Either a
+    single curve is rotated by every shift, or each row of a matrix of curves
+    is rotated by the corresponding shift.
+    """
+    curves, shifts = np.array(curves), np.array(shifts, dtype=float)
+    size = curves.shape[-1]
+    n1 = np.floor(shifts).astype(int)
+    w2 = (shifts - n1)[:, np.newaxis]
+    idx = (np.arange(size)[np.newaxis, :] - n1[:, np.newaxis]) % size
+    if curves.ndim == 1:
+      take = lambda i: curves[i]
+    else:
+      take = lambda i: np.take_along_axis(curves, i, axis=1)
+    return (1 - w2) * take(idx) + w2 * take((idx - 1) % size)
+
   def build_holiday_model(self):
     week0, week1 = 49, 2
     idx0, idx1 = self.w2i[week0], self.w2i[week1]
     if idx0 >= idx1:
       raise Exception('holiday period must be contiguous')
-    norm = lambda x: linalg.norm(x[idx0:idx1], 2)
-    peaks0, derivatives0, scores0 = [], [], []
-    for c0 in self.curves:
-      peaks0.append(self.peakheight(c0))
-      derivatives0.append(np.diff(c0, 2))
-      scores0.append(norm(derivatives0[-1]))
-    def objective(params):
-      holiday = np.array(params)
-      if max(holiday) > 1:
-        return 1e9
-      score = 0
-      for (c0, p0, d0, s0) in zip(self.curves, peaks0, derivatives0, scores0):
-        c1 = np.copy(c0)
-        for i in range(4):
-          c1[idx0 + 1 + i] *= holiday[i]
-        p1 = self.peakheight(c1)
-        d1 = np.diff(c1, 2)
-        s1 = norm(d1)
-        if not np.isclose(p0, p1):
-          s1 = s0
-        score += s1
-      return score
+    # only the holiday weeks and their neighbors affect the score
+    holiday_weeks = np.arange(idx0 + 1, idx0 + 5)
+    window = self.curves[:, idx0:idx1 + 2]
+    other_peaks = np.max(np.delete(self.curves, holiday_weeks, axis=1), axis=1)
+    peaks0 = np.max(self.curves, axis=1)
+    diff2 = lambda c: c[..., :-2] - 2 * c[..., 1:-1] + c[..., 2:]
+    norm = lambda d: np.sqrt(np.sum(np.square(d), axis=-1))
+    scores0 = norm(diff2(window))
+    def batch_objective(points):
+      # one row of holiday factors per point, each applied to all curves
+      holiday = np.array(points, dtype=float)
+      factors = np.ones((len(holiday), 1, window.shape[1]))
+      factors[:, 0, 1:5] = holiday
+      c1 = window * factors
+      p1 = np.maximum(other_peaks, np.max(c1[:, :, 1:5], axis=2))
+      s1 = norm(diff2(c1))
+      # (equivalent to `np.isclose`, without the overhead)
+      same_peak = np.abs(peaks0 - p1) <= 1e-8 + 1e-5 * np.abs(p1)
+      s1 = np.where(same_peak, s1, scores0)
+      score = np.sum(s1, axis=1)
+      return np.where(np.max(holiday, axis=1) > 1, 1e9, score)
+    objective = lambda params: batch_objective([params])[0]
     # optimize parameters
     guess = (1, 1, 1, 1)
-    solver = NelderMead(objective, limit_iterations=100, limit_value=1e-3, limit_time=0.5, silent=True)
-    simplex = solver.get_simplex(len(guess), guess, 0.1)
-    best = solver.run(simplex)._location
+    best, value = self.optimizer.minimize(
+        objective, guess, 0.1, batch_objective=batch_objective)
     obj0, obj1 = objective(guess), objective(best)
     if np.isclose(obj0, obj1) or obj0 < obj1:
       best = guess
     best = self.rotate(list(best) + [1] * (48), idx0 + 1)
     return best
 
-  def smooth(self, curve):
+  def smooth(self, curves):
+    """Circularly convolve the curve, or each row of curves, with the kernel."""
     extend = len(self.kernel) // 2
-    temp = list(curve)
-    temp = temp[-extend:] + temp + temp[:+extend]
-    return np.convolve(temp, self.kernel, 'valid')
+    curves = np.array(curves, dtype=float)
+    # gather the circular window around each week, then weight by the kernel
+    size, window = curves.shape[-1], len(self.kernel)
+    offsets = np.arange(window)[np.newaxis, :] - extend
+    idx = (np.arange(size)[:, np.newaxis] + offsets) % size
+    return np.dot(curves[..., idx], self.kernel)
     #return trendfilter(curve)
 
   def scale(self, curve, s):
@@ -145,23 +188,36 @@ class Archetype:
     curve = np.array(curve)
     curve_nh = curve * self.holiday
     curve_nh_sm = self.smooth(curve_nh)
-    def objective(params):
-      t, s = params
-      return linalg.norm(self.instance(s, t, False) - curve_nh, 2)
+    def batch_objective(points):
+      t, s = points[:, 0], points[:, 1]
+      curves = self.scale(self.rotations(self.mean, t), s[:, np.newaxis])
+      return linalg.norm(curves - curve_nh, 2, axis=1)
+    objective = lambda params: batch_objective(np.array([params]))[0]
     # optimize parameters
     shift0 = self.peakweek(curve_nh_sm) - self.peakweek(self.mean)
     scale0 = (self.peakheight(curve_nh) - self.baseline) / (self.peakheight(self.mean) - self.baseline)
     #scale0 = self.peakheight(curve_nh) / self.peakheight(self.mean)
     guess = (shift0, scale0)
-    solver = NelderMead(objective, limit_iterations=100, limit_value=1e-3, limit_time=0.5, silent=True)
-    simplex = solver.get_simplex(len(guess), guess, 0.1)
-    best = solver.run(simplex)._location
+    best, value = self.optimizer.minimize(
+        objective, guess, 0.1, batch_objective=batch_objective)
     obj0, obj1 = objective(guess), objective(best)
     if np.isclose(obj0, obj1) or obj0 < obj1:
       best = guess
     shift1, scale1 = best
     return self.instance(scale1, shift1, True)
 
+  def save(self, filename):
+    with open(filename, 'wb') as f:
+      pickle.dump(self, f)
+
+  @staticmethod
+  def load(filename):
+    with open(filename, 'rb') as f:
+      model = pickle.load(f)
+    if not isinstance(model, Archetype):
+      raise Exception('not an Archetype: %s' % filename)
+    return model
+
   @staticmethod
   def RMS(a, b):
     return np.sqrt(np.mean(np.square(a - b)))
@@ -0,0 +1,64 @@
+"""
+===============
+=== Purpose ===
+===============
+
+Backfill many weeks of an autoregressive sensor (see ar3.py and sar3.py) with
+incremental training. Each week's training set is the previous week's plus any
+rows that have since become stable, so rather than refitting from scratch,
+only the new rows are added to the normal equations.
+"""
+
+# third party
+import numpy as np
+
+# first party
+import delphi.utils.epiweek as EW
+
+
+def predict_range(sensor, first, last, get_features, num_features, valid=True):
+  """
+  Predict each epiweek in the inclusive range [first, last].
+
+  This is equivalent to calling `sensor.predict` on each week, except that the
+  model is trained incrementally.
+
+  input:
+    sensor: an AR3-like sensor, providing `ew2i`, `i2ew`, `weeks`, and `data`
+    first: the first most recently published issue
+    last: the last most recently published issue
+    get_features: a function that, given an epiweek and `valid`, returns the
+      (1 x num_features) feature matrix of that week
+    num_features: the number of features, including the intercept
+    valid (optional): whether to require unstable wILI
+
+  output:
+    a tuple consisting of:
+      - an array of predictions, with nan on weeks that can't be predicted
+      - a list of reasons (Exceptions) for missing predictions, or None
+  """
+  epiweeks = list(EW.range_epiweeks(first, last, inclusive=True))
+  predictions = np.full(len(epiweeks), np.nan)
+  reasons = [None] * len(epiweeks)
+  XtX = np.zeros((num_features, num_features))
+  XtY = np.zeros((num_features, 1))
+  i_next = sensor.weeks[2]
+  for (n, epiweek) in enumerate(epiweeks):
+    try:
+      if epiweek not in sensor.ew2i:
+        raise Exception('not predicting during the pandemic')
+      # add training rows which have become stable since the previous week
+      i2 = sensor.ew2i[epiweek] - 5
+      while i_next <= i2:
+        X = get_features(sensor.i2ew[i_next], valid=False)
+        Y = sensor.data[i_next + 1]['stable']
+        XtX += np.dot(X.T, X)
+        XtY += X.T * Y
+        i_next += 1
+      sensor.model = np.dot(np.linalg.inv(XtX), XtY)
+      sensor.training_week = epiweek
+      X = get_features(epiweek, valid=valid)
+      predictions[n] = float(np.dot(X, sensor.model)[0, 0])
+    except Exception as ex:
+      reasons[n] = ex
+  return predictions, reasons
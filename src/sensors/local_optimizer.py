@@ -0,0 +1,167 @@
+"""
+===============
+=== Purpose ===
+===============
+
+Derivative-free local optimization with deterministic budgets.
+
+Optimizers stop after a fixed number of iterations or objective evaluations,
+or when the objective has converged, but never after a wall-clock limit. As a
+result, the same inputs always produce the same outputs, regardless of machine
+load, and the worst-case cost of each call is known in advance.
+
+Optionally, points may be evaluated in batches. In that case, the objective
+function takes a matrix of points (one per row) and returns a vector of
+values, which amortizes per-call overhead when the objective is vectorized.
+
+See also:
+  - ../fusion/opt_1d.py: one-dimensional optimization over an interval
+"""
+
+# standard library
+import abc
+
+# third party
+import numpy as np
+
+
+class LocalOptimizer(metaclass=abc.ABCMeta):
+  """An abstract class representing a local minimization method."""
+
+  @abc.abstractmethod
+  def minimize(self, objective, guess, step, batch_objective=None):
+    """
+    Find a point near the initial guess which minimizes the objective.
+
+    input:
+      objective: a function which takes a point and returns a scalar
+      guess: the initial point
+      step: the initial search scale
+      batch_objective (optional): a function which takes a matrix of points,
+        one per row, and returns a vector of values; used instead of
+        `objective` by optimizers which evaluate points in batches
+
+    output:
+      a tuple consisting of:
+        - the best point found (as a numpy.ndarray)
+        - the value of the objective function at that point
+    """
+    raise NotImplementedError()
+
+
+class NelderMead(LocalOptimizer):
+  """
+  The Nelder-Mead simplex method with standard coefficients (reflection 1,
+  expansion 2, contraction 1/2, shrinkage 1/2).
+
+  In vectorized mode, the reflection, expansion, and both contraction points
+  are evaluated together in a single batch on each iteration, and shrunk
+  vertices are evaluated together as well. The search path is identical to
+  the non-vectorized mode; only the number of evaluations differs.
+  """
+
+  def __init__(
+      self,
+      max_iterations=1000,
+      max_evaluations=None,
+      tolerance=1e-8,
+      vectorized=False):
+    """
+    input:
+      max_iterations (optional): the maximum number of simplex updates
+      max_evaluations (optional): the maximum number of points evaluated, or
+        None for no limit beyond that implied by `max_iterations`
+      tolerance (optional): stop when the values of the objective at all
+        vertices of the simplex differ by no more than this amount
+      vectorized (optional): whether to evaluate points in batches
+    """
+    self.max_iterations = max_iterations
+    self.max_evaluations = max_evaluations
+    self.tolerance = tolerance
+    self.vectorized = vectorized
+
+  def minimize(self, objective, guess, step, batch_objective=None):
+    batched = self.vectorized and batch_objective is not None
+    num_evaluations = 0
+
+    # evaluate a list of points, keeping track of the total number evaluated
+    def evaluate(points):
+      nonlocal num_evaluations
+      num_evaluations += len(points)
+      if batched:
+        return np.array(batch_objective(np.array(points)), dtype=float)
+      return np.array([objective(p) for p in points], dtype=float)
+
+    # check whether another `k` evaluations are within budget
+    def affordable(k):
+      if self.max_evaluations is None:
+        return True
+      return num_evaluations + k <= self.max_evaluations
+
+    # the initial simplex extends one step from the guess along each axis
+    guess = np.array(guess, dtype=float)
+    n = len(guess)
+    simplex = np.vstack((guess, guess + step * np.eye(n)))
+    values = evaluate(simplex)
+
+    for iteration in range(self.max_iterations):
+      # sort vertices from best to worst, breaking ties deterministically
+      order = np.argsort(values, kind='stable')
+      simplex, values = simplex[order], values[order]
+      if values[-1] - values[0] <= self.tolerance:
+        break
+
+      # candidate points, relative to the centroid of all but the worst
+      centroid = np.mean(simplex[:-1], axis=0)
+      worst = simplex[-1]
+      reflection = centroid + (centroid - worst)
+      candidates = (
+        reflection,
+        centroid + 2 * (centroid - worst),
+        centroid + (reflection - centroid) / 2,
+        centroid + (worst - centroid) / 2,
+      )
+
+      if batched:
+        # speculatively evaluate all candidates at once
+        if not affordable(len(candidates)):
+          break
+        known = evaluate(candidates)
+        get_value = lambda i: known[i]
+      else:
+        # evaluate candidates only as needed (at most two per iteration)
+        if not affordable(2):
+          break
+        get_value = lambda i: evaluate([candidates[i]])[0]
+
+      # choose between reflection, expansion, contraction, and shrinkage
+      accept = None
+      f_r = get_value(0)
+      if values[0] <= f_r < values[-2]:
+        accept = 0, f_r
+      elif f_r < values[0]:
+        f_e = get_value(1)
+        accept = (1, f_e) if f_e < f_r else (0, f_r)
+      elif f_r < values[-1]:
+        f_oc = get_value(2)
+        if f_oc <= f_r:
+          accept = 2, f_oc
+      else:
+        f_ic = get_value(3)
+        if f_ic < values[-1]:
+          accept = 3, f_ic
+
+      if accept is not None:
+        # replace the worst vertex
+        i, value = accept
+        simplex[-1], values[-1] = candidates[i], value
+      else:
+        # move all other vertices halfway toward the best vertex
+        if not affordable(n):
+          break
+        simplex[1:] = simplex[0] + (simplex[1:] - simplex[0]) / 2
+        values[1:] = evaluate(simplex[1:])
+
+    # return the best vertex
+    best = np.argmin(values)
+    return simplex[best], values[best]
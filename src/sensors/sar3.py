@@ -28,6 +28,8 @@ See also:
 === Changelog ===
 =================
 
+2026-10-18
+  + predict_range with incremental training
 2016-04-11
   * allow predictions using invalid (stable) data
 2016-04-06
@@ -42,6 +44,7 @@ import numpy as np
 
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
+from delphi.nowcast.sensors import incremental_regression
 import delphi.operations.secrets as secrets
 import delphi.utils.epiweek as EW
 
@@ -136,6 +139,14 @@ class SAR3:
     X = self._get_features(epiweek, valid=valid)
     return float(SAR3.dot(X, self.model)[0, 0])
 
+  def predict_range(self, first, last, valid=True):
+    """
+    Predict each epiweek in the inclusive range [first, last], training
+    incrementally (see incremental_regression.py).
+    """
+    return incremental_regression.predict_range(
+        self, first, last, self._get_features, 10, valid=valid)
+
 
 if __name__ == '__main__':
   # args and usage
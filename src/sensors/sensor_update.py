@@ -43,7 +43,7 @@ import numpy as np
 
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
-from delphi.nowcast.sensors.arch import ARCH
+from delphi.nowcast.sensors.arch import ARCH, ARCHBatch, ArchetypeCache
 from delphi.nowcast.sensors.sar3 import SAR3
 from delphi.nowcast.sensors.ar3 import AR3
 from delphi.nowcast.util.sensors_table import SensorsTable
@@ -373,6 +373,31 @@ class SensorGetter:
       'quid': SensorGetter.get_quid,
     }
 
+  @staticmethod
+  def get_sensor_range_implementations():
+    """
+    Return a map from sensor names to implementations which predict a range of
+    weeks at once. Each takes a location, the first and last weeks (inclusive),
+    and validity, and returns a tuple of predictions and failure reasons.
+    """
+    return {
+      'sar3': SensorGetter.get_sar3_range,
+      'arch': SensorGetter.get_arch_range,
+      'ar3': SensorGetter.get_ar3_range,
+    }
+
+  @staticmethod
+  def get_sensor_bulk_implementations():
+    """
+    Return a map from sensor names to implementations which predict a range of
+    weeks in many locations at once. Each takes a list of locations, the first
+    and last weeks (inclusive), and validity, and returns a tuple of a (weeks x
+    locations) matrix of predictions and a nested list of failure reasons.
+    """
+    return {
+      'arch': SensorGetter.get_arch_bulk,
+    }
+
   @staticmethod
   def get_epic(location, epiweek, valid):
     fc = Epidata.check(Epidata.delphi('ec', epiweek))[0]
@@ -390,6 +415,22 @@ class SensorGetter:
   def get_ar3(location, epiweek, valid):
     return AR3(location).predict(epiweek, valid=valid)
 
+  @staticmethod
+  def get_sar3_range(location, first, last, valid):
+    return SAR3(location).predict_range(first, last, valid=valid)
+
+  @staticmethod
+  def get_arch_range(location, first, last, valid):
+    return ARCH(location).predict_range(first, last, valid=valid)
+
+  @staticmethod
+  def get_arch_bulk(locations, first, last, valid):
+    return ARCHBatch(locations).predict_range(first, last, valid=valid)
+
+  @staticmethod
+  def get_ar3_range(location, first, last, valid):
+    return AR3(location).predict_range(first, last, valid=valid)
+
   @staticmethod
   def get_ghtj(location, epiweek, valid):
     loc = 'US' if location == 'nat' else location
@@ -466,13 +507,25 @@ class SensorUpdate:
     """
     database = SensorsTable(test_mode=test_mode)
     implementations = SensorGetter.get_sensor_implementations()
-    return SensorUpdate(valid, database, implementations, Epidata)
-
-  def __init__(self, valid, database, implementations, epidata):
+    range_implementations = SensorGetter.get_sensor_range_implementations()
+    bulk_implementations = SensorGetter.get_sensor_bulk_implementations()
+    return SensorUpdate(
+        valid,
+        database,
+        implementations,
+        Epidata,
+        range_implementations,
+        bulk_implementations)
+
+  def __init__(
+      self, valid, database, implementations, epidata,
+      range_implementations=None, bulk_implementations=None):
     self.valid = valid
     self.database = database
     self.implementations = implementations
     self.epidata = epidata
+    self.range_implementations = range_implementations or {}
+    self.bulk_implementations = bulk_implementations or {}
 
   def update(self, sensors, first_week, last_week):
     """
@@ -489,26 +542,41 @@ class SensorUpdate:
 
       # update each sensor
       for (name, loc) in sensors:
+        locations = get_location_list(loc)
+
+        if name in self.bulk_implementations and len(locations) > 1:
+          # update all locations at once
+          self.update_bulk(database, first_week, last_week, name, locations)
+          continue
 
         # update each location
-        for location in get_location_list(loc):
+        for location in locations:
 
           # timing
-          ew1 = first_week
-          if ew1 is None:
-            ew1 = database.get_most_recent_epiweek(name, location)
-            if ew1 is None:
-              # If an existing sensor reading wasn't found in the database and
-              # no start week was given, just assume that readings should start
-              # at 2010w40.
-              ew1 = 201040
-              print('%s-%s not found, starting at %d' % (name, location, ew1))
+          ew1 = self.get_first_week(database, first_week, name, location)
 
           args = (name, location, ew1, last_week)
           print('Updating %s-%s from %d to %d.' % args)
+          if name in self.range_implementations and ew1 < last_week:
+            # backfill all weeks at once, sharing data and training
+            self.update_range(database, ew1, last_week, name, location)
+            continue
           for test_week in flu.range_epiweeks(ew1, last_week, inclusive=True):
             self.update_single(database, test_week, name, location)
 
+  def get_first_week(self, database, first_week, name, location):
+    """Return the first week on which to update the given sensor reading."""
+    if first_week is not None:
+      return first_week
+    ew1 = database.get_most_recent_epiweek(name, location)
+    if ew1 is None:
+      # If an existing sensor reading wasn't found in the database and no
+      # start week was given, just assume that readings should start at
+      # 2010w40.
+      ew1 = 201040
+      print('%s-%s not found, starting at %d' % (name, location, ew1))
+    return ew1
+
   def update_single(self, database, test_week, name, location):
     train_week = flu.add_epiweeks(test_week, -1)
     impl = self.implementations[name]
@@ -522,6 +590,61 @@ class SensorUpdate:
       database.insert(name, location, test_week, value)
     sys.stdout.flush()
 
+  def update_range(self, database, first_week, last_week, name, location):
+    train_weeks = (
+      flu.add_epiweeks(first_week, -1),
+      flu.add_epiweeks(last_week, -1),
+    )
+    test_weeks = flu.range_epiweeks(first_week, last_week, inclusive=True)
+    impl = self.range_implementations[name]
+    try:
+      values, reasons = impl(location, *train_weeks, self.valid)
+    except Exception as ex:
+      args = (name, location, first_week, last_week)
+      print(' failed: %4s %5s %d--%d' % args, ex)
+      values, reasons = [], []
+    for test_week, value, reason in zip(test_weeks, values, reasons):
+      if np.isfinite(value):
+        value = float(value)
+        print(' %4s %5s %d -> %.3f' % (name, location, test_week, value))
+        database.insert(name, location, test_week, value)
+      else:
+        print(' failed: %4s %5s %d' % (name, location, test_week), reason)
+    sys.stdout.flush()
+
+  def update_bulk(self, database, first_week, last_week, name, locations):
+    # each location may need to be updated starting on a different week
+    first_weeks = [
+      self.get_first_week(database, first_week, name, location)
+      for location in locations
+    ]
+    ew1 = min(first_weeks)
+    args = (name, len(locations), ew1, last_week)
+    print('Updating %s in %d locations from %d to %d.' % args)
+    if ew1 > last_week:
+      return
+    train_weeks = (flu.add_epiweeks(ew1, -1), flu.add_epiweeks(last_week, -1))
+    test_weeks = flu.range_epiweeks(ew1, last_week, inclusive=True)
+    impl = self.bulk_implementations[name]
+    try:
+      values, reasons = impl(locations, *train_weeks, self.valid)
+    except Exception as ex:
+      print(' failed: %4s %d--%d' % (name, ew1, last_week), ex)
+      values, reasons = [], []
+    for test_week, week_values, week_reasons in zip(
+        test_weeks, values, reasons):
+      rows = zip(locations, first_weeks, week_values, week_reasons)
+      for location, location_week, value, reason in rows:
+        if test_week < location_week:
+          continue
+        if np.isfinite(value):
+          value = float(value)
+          print(' %4s %5s %d -> %.3f' % (name, location, test_week, value))
+          database.insert(name, location, test_week, value)
+        else:
+          print(' failed: %4s %5s %d' % (name, location, test_week), reason)
+    sys.stdout.flush()
+
 
 def get_argument_parser():
   """Define command line arguments and usage."""
@@ -558,6 +681,10 @@ def get_argument_parser():
       default=False,
       action='store_true',
       help='do not fall back to stable wILI; require unstable wILI')
+  parser.add_argument(
+      '--archetype-cache',
+      type=str,
+      help='directory in which to store and reuse ARCH Archetypes')
   return parser
 
 
@@ -596,4 +723,7 @@ def main(names, first, last, valid, test):
 
 
 if __name__ == '__main__':
-  main(*validate_args(get_argument_parser().parse_args()))
+  args = get_argument_parser().parse_args()
+  if args.archetype_cache:
+    ARCH.archetype_cache = ArchetypeCache(args.archetype_cache)
+  main(*validate_args(args))
@@ -0,0 +1,37 @@
+"""
+===============
+=== Purpose ===
+===============
+
+Synthetic wILI for unit tests and examples. Nothing here is derived from real
+surveillance data.
+"""
+
+# third party
+import numpy as np
+
+
+def get_curves():
+  """Return a few synthetic seasons with peaks near the middle."""
+  weeks = np.arange(52)
+  peak = lambda offset: 1 + 5 * np.exp(-np.square((weeks - 25 - offset) / 5))
+  return [peak(offset) + 0.1 * np.cos(weeks) for offset in (-3, 0, 4, 2)]
+
+
+def get_fluview(epiweeks, missing=()):
+  """
+  Return a stand-in for `Epidata.fluview` which serves synthetic wILI on the
+  given epiweeks, as of lags 0, 1, and 2 (when `lag` is given) and as stable
+  wILI (lag 52, when it isn't). Rows for the (epiweek, lag) pairs in `missing`
+  are left out.
+  """
+  def fluview(region, weeks, lag=None, auth=None):
+    lag = 52 if lag is None else lag
+    rows = []
+    for (i, epiweek) in enumerate(epiweeks):
+      if (epiweek, lag) in missing:
+        continue
+      wili = 2 + np.sin(i / 8) + 0.3 * np.cos(i * 1.7) + 0.1 * min(lag, 3)
+      rows.append({'epiweek': epiweek, 'wili': wili, 'lag': lag})
+    return rows
+  return fluview
@@ -170,6 +170,9 @@ class UnitTests(unittest.TestCase):
     self.assertEqual(weeks, all_weeks[NowcastExperiment.MIN_OBSERVATIONS:])
     self.assertEqual(cov_impl, covariance.BlendDiagonal0)
 
+    params = self.experiment.get_covariance_parameters('lw')
+    self.assertEqual(params[-1], covariance.LedoitWolf)
+
   def test_get_vanilla_parameters(self):
     """Return parameters used in operational nowcasting."""
 
@@ -1,6 +1,8 @@
 """Unit tests for covariance.py."""
 
 # standard library
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
@@ -41,12 +43,75 @@ class UnitTests(unittest.TestCase):
     self.assertTrue(np.allclose(cov2n, cov2n.T))
     self.assertTrue(np.allclose(cov2d, cov2d.T))
 
+  def test_nancov_accumulator(self):
+    X = np.random.randn(30, 4)
+    X[X > 1] = np.nan
+    X[5, :] = np.nan
+    accumulator = NancovAccumulator(4)
+
+    # grow the window one row at a time
+    for i in range(X.shape[0]):
+      accumulator.append(X[i:i + 1, :])
+    num, den = accumulator.get_nancov()
+    expected_num, expected_den = nancov(X)
+    self.assertTrue(np.allclose(num, expected_num))
+    self.assertTrue(np.array_equal(den, expected_den))
+    # the empty row isn't counted
+    self.assertEqual(accumulator.num_obs, 29)
+
+    # slide the window, and select columns
+    accumulator.remove(X[:10, :])
+    columns = np.array([True, False, True, True])
+    num, den = accumulator.get_nancov(columns)
+    expected_num, expected_den = nancov(X[10:, :][:, columns])
+    self.assertTrue(np.allclose(num, expected_num))
+    self.assertTrue(np.array_equal(den, expected_den))
+    self.assertEqual(accumulator.num_obs, 20)
+
+    with self.assertRaises(Exception):
+      accumulator.remove(X)
+
   def test_log_likelihood(self):
     cov = np.eye(3)
     data = np.random.randn(100, 3)
     ll = log_likelihood(cov, data)
     self.assertTrue(-np.inf < ll < 0)
 
+  def test_scatter_likelihood(self):
+    cov = np.array([[2, 1, 0], [1, 2, 1], [0, 1, 2]])
+    for num_obs in (2, 3, 100):
+      with self.subTest(num_obs=num_obs):
+        data = np.random.randn(num_obs, 3)
+        likelihood = ScatterLikelihood(data)
+        expected = log_likelihood(cov, data)
+        actual = likelihood.get_log_likelihood(cov)
+        self.assertTrue(np.isclose(actual, expected))
+
+    # not positive definite, singular, and not finite
+    likelihood = ScatterLikelihood(np.random.randn(10, 2))
+    for cov in ([[1, 0], [0, -1]], [[1, 1], [1, 1]], [[1, np.nan], [0, 1]]):
+      with self.subTest(cov=cov):
+        ll = likelihood.get_log_likelihood(np.array(cov, dtype=float))
+        self.assertEqual(ll, -np.inf)
+
+  def test_scatter_likelihood_batch(self):
+    data = np.random.randn(20, 2)
+    likelihood = ScatterLikelihood(data)
+    covs = np.array([
+      [[2, 1], [1, 2]],
+      [[1, 0], [0, -1]],
+      [[1, 1], [1, 1]],
+      [[1, 0], [0, 1]],
+    ], dtype=float)
+    expected = [likelihood.get_log_likelihood(cov) for cov in covs]
+    actual = likelihood.get_log_likelihood_batch(covs)
+    self.assertEqual(list(actual[1:3]), [-np.inf, -np.inf])
+    self.assertTrue(np.allclose(actual, expected))
+
+    # all positive definite
+    actual = likelihood.get_log_likelihood_batch(covs[[0, 3]])
+    self.assertTrue(np.allclose(actual, [expected[0], expected[3]]))
+
   def test_posdef_max_likelihood_objective(self):
     X = np.zeros((2, 2)) * np.nan
 
@@ -70,15 +135,198 @@ class UnitTests(unittest.TestCase):
     shrinkage = MagicMock()
     shrinkage.get_alpha_bounds = MagicMock(return_value=(0, 1))
     shrinkage.get_cov = MagicMock(return_value=np.eye(3))
+    shrinkage.get_closed_form_alpha = MagicMock(return_value=None)
     cov = mle_cov(X, lambda *args: shrinkage)
     self.assertTrue(is_posdef(cov))
     self.assertTrue(-np.inf < log_likelihood(cov, X) < 0)
     self.assertTrue(shrinkage.get_alpha_bounds.called)
     self.assertTrue(shrinkage.get_cov.called)
 
+  def test_maximize_alpha_warm_start(self):
+    shrinkage = MagicMock()
+    shrinkage.get_alpha_bounds = MagicMock(return_value=(0, 1000))
+    objective = MagicMock(side_effect=lambda a: -(a - 123.4) ** 2)
+
+    alpha1 = maximize_alpha(shrinkage, objective)
+    cold_calls = objective.call_count
+    objective.reset_mock()
+    alpha2 = maximize_alpha(shrinkage, objective, prior_alpha=120)
+    warm_calls = objective.call_count
+
+    self.assertTrue(abs(alpha1 - 123.4) <= 1)
+    self.assertTrue(abs(alpha2 - 123.4) <= 1)
+    self.assertLess(warm_calls, cold_calls)
+
+    # a poor guess still finds the maximum
+    alpha3 = maximize_alpha(shrinkage, objective, prior_alpha=900)
+    self.assertTrue(abs(alpha3 - 123.4) <= 1)
+
+  def test_maximize_alpha_budget(self):
+    shrinkage = MagicMock()
+    shrinkage.get_alpha_bounds = MagicMock(return_value=(0, 1e9))
+    objective = MagicMock(side_effect=lambda a: -(a - 1234.5) ** 2)
+    alpha = maximize_alpha(shrinkage, objective)
+    self.assertLessEqual(objective.call_count, MAX_LIKELIHOOD_EVALUATIONS)
+    self.assertTrue(abs(alpha - 1234.5) <= ALPHA_REL_TOLERANCE * 1234.5)
+
+  def test_fit_shrinkage(self):
+    X = np.random.randn(100, 3)
+    X[:20, 0] = np.nan
+    shrinkage, alpha = fit_shrinkage(X, BlendDiagonal2)
+    self.assertIsInstance(shrinkage, BlendDiagonal2)
+    expected = mle_cov(X, BlendDiagonal2)
+    self.assertTrue(np.allclose(shrinkage.get_cov(alpha), expected))
+    shrinkage, alpha = fit_shrinkage(X, BlendDiagonal2, prior_alpha=alpha)
+    self.assertTrue(is_posdef(shrinkage.get_cov(alpha)))
+
+  def test_fit_shrinkage_from_nancov(self):
+    X = np.random.randn(100, 3)
+    X[:20, 0] = np.nan
+    shrinkage1, alpha1 = fit_shrinkage(X, BlendDiagonal2)
+    num, den = nancov(X)
+    shrinkage2, alpha2 = fit_shrinkage_from_nancov(
+        num, den, 100, BlendDiagonal2)
+    self.assertTrue(np.isclose(alpha1, alpha2))
+    cov1, cov2 = shrinkage1.get_cov(alpha1), shrinkage2.get_cov(alpha2)
+    self.assertTrue(np.allclose(cov1, cov2))
+
+    # the scatter matrix gives the same likelihood as the data
+    X0 = np.nan_to_num(X)
+    ll1 = ScatterLikelihood(X0).get_log_likelihood(cov1)
+    ll2 = ScatterLikelihood(num_obs=100, scatter=num).get_log_likelihood(cov1)
+    self.assertTrue(np.isclose(ll1, ll2))
+
+    with self.assertRaises(Exception):
+      fit_shrinkage_from_nancov(num, den, 1, BlendDiagonal2)
+
+  def test_get_cov_batch(self):
+    X = np.random.randn(20, 4)
+    X[X > 1.5] = np.nan
+    num, den = nancov(X)
+    classes = (
+      BlendDiagonal0, BlendDiagonal1, BlendDiagonal2, LowRankPlusDiagonal,
+      LedoitWolf, OracleApproximating,
+    )
+    for shrinkage_class in classes:
+      with self.subTest(shrinkage_class=shrinkage_class):
+        shrinkage = shrinkage_class(num, den, X.shape[0])
+        alphas = np.linspace(*shrinkage.get_alpha_bounds(), 5)
+        expected = [shrinkage.get_cov(alpha) for alpha in alphas]
+        actual = shrinkage.get_cov_batch(alphas)
+        self.assertEqual(actual.shape, (5, 4, 4))
+        self.assertTrue(np.allclose(actual, expected))
+
+  def test_fit_shrinkage_batch(self):
+    X = np.random.randn(100, 5)
+    X[:30, 0] = np.nan
+    shrinkage, alpha1 = fit_shrinkage(X, BlendDiagonal2)
+    shrinkage, alpha2 = fit_shrinkage(X, BlendDiagonal2, batch_size=4)
+    # both searches stop with an interval, around the maximum, narrower than 1
+    self.assertTrue(abs(alpha1 - alpha2) <= 2)
+    self.assertTrue(is_posdef(shrinkage.get_cov(alpha2)))
+
+  def test_covariance_cache_key(self):
+    X = np.random.randn(10, 3)
+    X[0, 0] = np.nan
+    num, den = nancov(X)
+    columns = (('s1', 'a'), ('s1', 'b'), ('s2', 'a'))
+    key = CovarianceCache.get_key(num, den, 10, columns, BlendDiagonal2)
+    self.assertEqual(
+        key,
+        CovarianceCache.get_key(
+            num.copy(), den.copy(), 10, columns, BlendDiagonal2))
+    different = [
+      (num * 2, den, 10, columns, BlendDiagonal2),
+      (num, den + 1, 10, columns, BlendDiagonal2),
+      (num, den, 11, columns, BlendDiagonal2),
+      (num, den, 10, columns[::-1], BlendDiagonal2),
+      (num, den, 10, (('s3', 'a'),) + columns[1:], BlendDiagonal2),
+      (num, den, 10, columns, BlendDiagonal1),
+    ]
+    for args in different:
+      self.assertNotEqual(key, CovarianceCache.get_key(*args))
+
+  def test_covariance_cache_in_memory(self):
+    cache = CovarianceCache()
+    self.assertIsNone(cache.get('key'))
+    cache.put('key', 1.5)
+    self.assertEqual(cache.get('key'), 1.5)
+    expected = {'hits': 1, 'loads': 0, 'misses': 1, 'evictions': 0}
+    self.assertEqual(cache.get_stats(), expected)
+
+  def test_covariance_cache_on_disk(self):
+    with tempfile.TemporaryDirectory() as directory:
+      CovarianceCache(directory).put('key', 1.5)
+      cache = CovarianceCache(directory)
+      self.assertEqual(cache.get('key'), 1.5)
+      self.assertEqual(cache.get('key'), 1.5)
+      self.assertIsNone(cache.get('other'))
+      expected = {'hits': 1, 'loads': 1, 'misses': 1, 'evictions': 0}
+      self.assertEqual(cache.get_stats(), expected)
+
+  def test_covariance_cache_eviction(self):
+    with tempfile.TemporaryDirectory() as directory:
+      cache = CovarianceCache(directory)
+      cache.put('a', 1.0)
+      size = os.path.getsize(cache.get_filename('a'))
+
+      # make the first entry the least recently used
+      cache = CovarianceCache(directory, max_size=2.5 * size)
+      os.utime(cache.get_filename('a'), (0, 0))
+      cache.put('b', 2.0)
+      cache.put('c', 3.0)
+      self.assertEqual(cache.get_stats()['evictions'], 1)
+      self.assertFalse(os.path.exists(cache.get_filename('a')))
+
+      # the remaining entries are still on disk
+      cache = CovarianceCache(directory, max_size=2.5 * size)
+      self.assertIsNone(cache.get('a'))
+      self.assertEqual(cache.get('b'), 2.0)
+      self.assertEqual(cache.get('c'), 3.0)
+
+  def test_covariance_cache_buckets(self):
+    with tempfile.TemporaryDirectory() as directory:
+      cache = CovarianceCache(directory)
+      cache.put('ab1', 1.0)
+      cache.put('ab2', 2.0)
+      cache.put('cd1', 3.0)
+      self.assertEqual(len(os.listdir(directory)), 2)
+
+      # overwriting an entry doesn't count its bucket twice
+      cache.put('ab1', 4.0)
+      total = sum(
+          os.path.getsize(os.path.join(directory, name))
+          for name in os.listdir(directory))
+      self.assertEqual(cache.size, total)
+
+      cache = CovarianceCache(directory)
+      self.assertEqual(cache.get('ab1'), 4.0)
+      self.assertEqual(cache.get('ab2'), 2.0)
+      self.assertEqual(cache.get('cd1'), 3.0)
+
+  def test_covariance_cache_eviction_is_rare(self):
+    with tempfile.TemporaryDirectory() as directory:
+      cache = CovarianceCache(directory, max_size=2 ** 12)
+      evict = MagicMock(side_effect=cache.evict)
+      cache.evict = evict
+      for i in range(1000):
+        cache.put('%03x' % i, float(i))
+      # the store stays within its limit...
+      self.assertLessEqual(cache.size, cache.max_size)
+      self.assertGreater(cache.get_stats()['evictions'], 0)
+      # ...without scanning the directory on every save
+      self.assertLess(evict.call_count, 100)
+
   def test_shrinkage_methods(self):
     num, den, obs = np.eye(2), np.ones((2, 2)), 10
-    for class_ in (BlendDiagonal0, BlendDiagonal1, BlendDiagonal2):
+    classes = (
+      BlendDiagonal0,
+      BlendDiagonal1,
+      BlendDiagonal2,
+      LedoitWolf,
+      OracleApproximating,
+    )
+    for class_ in classes:
       with self.subTest(class_=class_):
         instance = class_(num, den, obs)
         a, b = instance.get_alpha_bounds()
@@ -94,3 +342,83 @@ class UnitTests(unittest.TestCase):
         self.assertTrue(is_posdef(cov0))
         self.assertTrue(is_posdef(cov1))
         self.assertTrue(is_posdef(cov2))
+
+  def test_closed_form_shrinkage(self):
+    for class_ in (LedoitWolf, OracleApproximating):
+      with self.subTest(class_=class_):
+        # weakly correlated variables are shrunk more than strongly correlated
+        # variables
+        X = np.random.randn(50, 4)
+        weak = class_(*nancov(X), 50).get_closed_form_alpha()
+        X[:, 1:] = X[:, :1] + np.random.randn(50, 3) * 0.1
+        strong = class_(*nancov(X), 50).get_closed_form_alpha()
+        self.assertTrue(0 <= strong < weak <= 1)
+
+        # the alpha is found without maximizing likelihood
+        shrinkage, alpha = fit_shrinkage(X, class_)
+        self.assertEqual(alpha, strong)
+
+        # shrinkage is sufficient for positive definiteness, even if the
+        # empirical covariance matrix is indefinite
+        num = np.array([[1, 0.9, 0.9], [0.9, 1, -0.9], [0.9, -0.9, 1]])
+        instance = class_(num * 1000, np.ones((3, 3)) * 1000, 1000)
+        self.assertFalse(is_posdef(instance.get_cov(0)))
+        alpha = instance.get_closed_form_alpha()
+        self.assertTrue(is_posdef(instance.get_cov(alpha)))
+
+  def test_low_rank_plus_diagonal(self):
+    np.random.seed(0)
+    factors = np.random.randn(6, 2)
+    X = np.dot(np.random.randn(50, 2), factors.T) + np.random.randn(50, 6)
+    X[:10, 0] = np.nan
+    num, den = nancov(X)
+    instance = LowRankPlusDiagonal(num, den, X.shape[0])
+    a, b = instance.get_alpha_bounds()
+    self.assertTrue(a < b)
+
+    for alpha in (a, (a + b) / 2, b):
+      with self.subTest(alpha=alpha):
+        d, G = instance.get_factors(alpha)
+        self.assertEqual(d.shape, (6,))
+        self.assertEqual(G.shape, (6, LowRankPlusDiagonal.rank))
+        cov = instance.get_cov(alpha)
+        self.assertTrue(np.allclose(cov, np.diag(d) + np.dot(G, G.T)))
+        # variances are the same as those of the empirical covariance
+        self.assertTrue(np.allclose(np.diag(cov), np.diag(num / den)))
+
+    # fully shrunk covariance is diagonal
+    cov = instance.get_cov(b)
+    self.assertTrue(np.allclose(cov, np.diag(np.diag(cov))))
+
+  def test_low_rank_log_likelihood(self):
+    np.random.seed(0)
+    d = np.random.rand(5) + 0.5
+    G = np.random.randn(5, 2)
+    data = np.random.randn(20, 5)
+    ll = low_rank_log_likelihood(d, G, data)
+    expected = log_likelihood(np.diag(d) + np.dot(G, G.T), data)
+    self.assertTrue(np.isclose(ll, expected))
+
+    # a factor without columns leaves only the diagonal part
+    ll = low_rank_log_likelihood(d, np.zeros((5, 0)), data)
+    self.assertTrue(np.isclose(ll, log_likelihood(np.diag(d), data)))
+
+    # non-posdef diagonal
+    d[0] = 0
+    self.assertEqual(low_rank_log_likelihood(d, G, data), -np.inf)
+
+  def test_mle_low_rank_cov(self):
+    np.random.seed(0)
+    factors = np.random.randn(8, 2)
+    X = np.dot(np.random.randn(40, 2), factors.T) + np.random.randn(40, 8)
+    X[:5, 0] = X[-5:, 1] = np.nan
+    d, G = mle_low_rank_cov(X, LowRankPlusDiagonal)
+    cov = np.diag(d) + np.dot(G, G.T)
+    self.assertTrue(np.min(d) > 0)
+    self.assertTrue(is_posdef(cov))
+
+    # same result as the dense implementation
+    self.assertTrue(np.allclose(cov, mle_cov(X, LowRankPlusDiagonal)))
+
+    with self.assertRaises(Exception):
+      mle_low_rank_cov(X[:1, :], LowRankPlusDiagonal)
@@ -5,11 +5,34 @@ import unittest
 
 # third party
 import numpy as np
+import scipy.linalg
+import scipy.sparse
 
 # py3tester coverage target
 __test_target__ = 'delphi.nowcast.fusion.fusion'
 
 
+def get_random_statespaces(count=20):
+  """
+  Return a list of (H0, W0) pairs of random exact input and output weights,
+  where the inputs are among the outputs, as in `determine_statespace`.
+  """
+  fractions = lambda X: np.array([[Fraction(x) for x in row] for row in X])
+  np.random.seed(0)
+  statespaces = []
+  for i in range(count):
+    num_inputs, num_states = np.random.randint(1, 8, size=2)
+    num_outputs = 10
+    H0 = np.random.randint(0, 4, size=(num_inputs, num_states))
+    H0[:, 0] += 1
+    W0 = np.random.randint(0, 4, size=(num_outputs, num_states))
+    W0[:num_inputs, :] = H0
+    H0 = fractions(H0) / fractions(np.sum(H0, axis=1, keepdims=True))
+    W0 = fractions(W0)
+    statespaces.append((H0, W0))
+  return statespaces
+
+
 class UnitTests(unittest.TestCase):
   """Basic unit tests."""
 
@@ -25,6 +48,56 @@ class UnitTests(unittest.TestCase):
     self.assertTrue(np.allclose(x, np.ones((1, num_states))))
     self.assertTrue(np.allclose(P, np.linalg.inv(np.dot(H.T, H))))
 
+  def test_information_accumulator(self):
+    np.random.seed(0)
+    num_states = 3
+    sizes = (4, 2, 5)
+    blocks = []
+    for size in sizes:
+      z = np.random.randn(size)
+      X = np.random.randn(size * 2, size)
+      R = np.dot(X.T, X)
+      H = np.random.rand(size, num_states)
+      blocks.append((z, R, H))
+
+    def fuse_blocks(indices):
+      z = np.concatenate([blocks[i][0] for i in indices])
+      R = scipy.linalg.block_diag(*[blocks[i][1] for i in indices])
+      H = np.vstack([blocks[i][2] for i in indices])
+      return fuse(z, R, H)
+
+    def assertPosterior(accumulator, indices):
+      x, P = accumulator.get_posterior()
+      x_expected, P_expected = fuse_blocks(indices)
+      self.assertTrue(np.allclose(x, x_expected))
+      self.assertTrue(np.allclose(P, P_expected))
+      x, C = accumulator.get_posterior_factored()
+      self.assertTrue(np.allclose(x, x_expected))
+      self.assertTrue(np.allclose(np.dot(C, C.T), np.linalg.inv(P_expected)))
+
+    accumulator = InformationAccumulator(num_states)
+    for i, block in enumerate(blocks):
+      accumulator.absorb(i, *block)
+    self.assertEqual(accumulator.get_keys(), [0, 1, 2])
+    assertPosterior(accumulator, [0, 1, 2])
+
+    # remove a block
+    accumulator.retract(1)
+    self.assertEqual(accumulator.get_keys(), [0, 2])
+    assertPosterior(accumulator, [0, 2])
+
+    # replace a block
+    accumulator.absorb(0, *blocks[1])
+    self.assertEqual(accumulator.get_keys(), [2, 0])
+    assertPosterior(accumulator, [2, 1])
+
+    # invalid usage
+    with self.assertRaises(Exception):
+      accumulator.retract(1)
+    with self.assertRaises(Exception):
+      z, R, H = blocks[0]
+      accumulator.absorb(3, z, R, H[:, :2])
+
   def test_extract(self):
     num_states = 5
     num_outputs = 10
@@ -36,6 +109,160 @@ class UnitTests(unittest.TestCase):
     self.assertTrue(np.allclose(y, np.ones((1, num_outputs))))
     self.assertTrue(np.allclose(S, S_expected))
 
+  def test_fuse_factored(self):
+    np.random.seed(0)
+    num_states = 4
+    num_inputs = 9
+    z = np.random.randn(1, num_inputs)
+    X = np.random.randn(num_inputs * 2, num_inputs)
+    R = np.dot(X.T, X) / (num_inputs * 2)
+    H = np.random.rand(num_inputs, num_states)
+
+    # compare with the explicit formula
+    Ri = np.linalg.inv(R)
+    P_expected = np.linalg.inv(np.dot(np.dot(H.T, Ri), H))
+    x_expected = np.dot(np.dot(np.dot(z, Ri), H), P_expected)
+
+    x, C = fuse_factored(z, R, H)
+    self.assertEqual(x.shape, (1, num_states))
+    self.assertTrue(np.allclose(x, x_expected))
+    self.assertTrue(np.allclose(np.tril(C), C))
+    self.assertTrue(np.allclose(np.linalg.inv(np.dot(C, C.T)), P_expected))
+
+    x, P = fuse(z, R, H)
+    self.assertTrue(np.allclose(x, x_expected))
+    self.assertTrue(np.allclose(P, P_expected))
+
+    # a vector of measurements produces a vector of states
+    x, C = fuse_factored(z[0, :], R, H)
+    self.assertEqual(x.shape, (num_states,))
+    self.assertTrue(np.allclose(x, x_expected[0, :]))
+
+  def test_extract_variance(self):
+    np.random.seed(0)
+    num_states = 5
+    num_outputs = 10
+    x = np.random.randn(1, num_states)
+    X = np.random.randn(num_states * 2, num_states)
+    P = np.linalg.inv(np.dot(X.T, X))
+    C = np.linalg.cholesky(np.dot(X.T, X))
+    W = np.random.rand(num_outputs, num_states)
+
+    y_expected, S = extract(x, P, W)
+    y, variance = extract_variance(x, C, W)
+    self.assertTrue(np.allclose(y, y_expected))
+    self.assertEqual(variance.shape, (num_outputs,))
+    self.assertTrue(np.allclose(variance, np.diag(S)))
+
+  def test_fuse_low_rank(self):
+    np.random.seed(0)
+    num_states = 4
+    num_inputs = 9
+    z = np.random.randn(1, num_inputs)
+    d = np.random.rand(num_inputs) + 0.5
+    G = np.random.randn(num_inputs, 2)
+    R = np.diag(d) + np.dot(G, G.T)
+    H = np.random.rand(num_inputs, num_states)
+
+    x_expected, C_expected = fuse_factored(z, R, H)
+    x, C = fuse_low_rank(z, d, G, H)
+    self.assertEqual(x.shape, (1, num_states))
+    self.assertTrue(np.allclose(x, x_expected))
+    self.assertTrue(np.allclose(C, C_expected))
+
+    # a vector of measurements produces a vector of states
+    x, C = fuse_low_rank(z[0, :], d, G, H)
+    self.assertEqual(x.shape, (num_states,))
+    self.assertTrue(np.allclose(x, x_expected[0, :]))
+
+    # a factor without columns leaves only the diagonal part
+    x_expected, C_expected = fuse_factored(z, np.diag(d), H)
+    x, C = fuse_low_rank(z, d, np.zeros((num_inputs, 0)), H)
+    self.assertTrue(np.allclose(x, x_expected))
+    self.assertTrue(np.allclose(C, C_expected))
+
+  def test_sparse_inputs(self):
+    np.random.seed(0)
+    num_weeks = 3
+    num_states = 4
+    num_inputs = 9
+    num_outputs = 7
+    Z = np.random.randn(num_weeks, num_inputs)
+    Xs = np.random.randn(num_weeks, num_inputs * 2, num_inputs)
+    R = np.matmul(np.transpose(Xs, (0, 2, 1)), Xs)
+    d = np.random.rand(num_inputs) + 0.5
+    G = np.random.randn(num_inputs, 2)
+    H = np.random.rand(num_inputs, num_states) * (np.random.rand(9, 4) < 0.4)
+    H[:num_states, :] += np.eye(num_states)
+    W = np.random.rand(num_outputs, num_states) * (np.random.rand(7, 4) < 0.4)
+    Hs, Ws = scipy.sparse.csr_matrix(H), scipy.sparse.csr_matrix(W)
+
+    # each kernel gives the same result for dense and sparse matrices
+    pairs = (
+      (fuse(Z[0], R[0], H), fuse(Z[0], R[0], Hs)),
+      (fuse_factored(Z[0], R[0], H), fuse_factored(Z[0], R[0], Hs)),
+      (fuse_low_rank(Z[0], d, G, H), fuse_low_rank(Z[0], d, G, Hs)),
+      (fuse_batch(Z, R, H), fuse_batch(Z, R, Hs)),
+    )
+    x, P = pairs[0][0]
+    x, C = pairs[1][0]
+    X, Cs = pairs[3][0]
+    pairs += (
+      (extract(x, P, W), extract(x, P, Ws)),
+      (extract_variance(x, C, W), extract_variance(x, C, Ws)),
+      (extract_variance_batch(X, Cs, W), extract_variance_batch(X, Cs, Ws)),
+    )
+    for i, (dense, sparse) in enumerate(pairs):
+      with self.subTest(i=i):
+        for a, b in zip(dense, sparse):
+          self.assertFalse(scipy.sparse.issparse(b))
+          self.assertEqual(a.shape, b.shape)
+          self.assertTrue(np.allclose(a, b))
+
+    accumulator = InformationAccumulator(num_states)
+    accumulator.absorb('a', Z[0], R[0], Hs)
+    x, P = accumulator.get_posterior()
+    self.assertTrue(np.allclose(x, pairs[0][0][0]))
+    self.assertTrue(np.allclose(P, pairs[0][0][1]))
+
+  def test_solve_triangular_batch(self):
+    np.random.seed(0)
+    L = np.tril(np.random.rand(3, 4, 4)) + 2 * np.eye(4)
+    B = np.random.randn(3, 4, 2)
+    X = solve_triangular_batch(L, B)
+    self.assertTrue(np.allclose(np.matmul(L, X), B))
+    X = solve_triangular_batch(L, B, trans=1)
+    self.assertTrue(np.allclose(np.matmul(np.transpose(L, (0, 2, 1)), X), B))
+    self.assertEqual(solve_triangular_batch(L[:0], B[:0]).shape, (0, 4, 2))
+
+  def test_fuse_batch(self):
+    np.random.seed(0)
+    num_weeks = 6
+    num_states = 4
+    num_inputs = 9
+    num_outputs = 7
+    Z = np.random.randn(num_weeks, num_inputs)
+    Xs = np.random.randn(num_weeks, num_inputs * 2, num_inputs)
+    R = np.matmul(np.transpose(Xs, (0, 2, 1)), Xs)
+    H = np.random.rand(num_inputs, num_states)
+    W = np.random.rand(num_outputs, num_states)
+
+    X, C = fuse_batch(Z, R, H)
+    Y, V = extract_variance_batch(X, C, W)
+    self.assertEqual(X.shape, (num_weeks, num_states))
+    self.assertEqual(C.shape, (num_weeks, num_states, num_states))
+    self.assertEqual(Y.shape, (num_weeks, num_outputs))
+    self.assertEqual(V.shape, (num_weeks, num_outputs))
+
+    # each batch element matches the unbatched kernel
+    for i in range(num_weeks):
+      x, c = fuse_factored(Z[i], R[i], H)
+      y, v = extract_variance(x, c, W)
+      self.assertTrue(np.allclose(X[i], x))
+      self.assertTrue(np.allclose(C[i], c))
+      self.assertTrue(np.allclose(Y[i], y))
+      self.assertTrue(np.allclose(V[i], v))
+
   def test_eliminate(self):
     fractions = lambda X: np.array([[Fraction(x) for x in row] for row in X])
 
@@ -81,6 +308,69 @@ class UnitTests(unittest.TestCase):
     with self.assertRaises(Exception):
       matmul(X, Y)
 
+  def test_scale_to_integers(self):
+    X = np.array([
+      [Fraction(1, 2), Fraction(1, 3), Fraction(1, 6)],
+      [Fraction(0), Fraction(3, 4), Fraction(-1, 4)],
+      [Fraction(2), Fraction(0), Fraction(5)],
+    ])
+    Y, scales = scale_to_integers(X)
+    self.assertEqual(list(scales), [6, 4, 1])
+    self.assertEqual(Y.tolist(), [[3, 2, 1], [0, 3, -1], [2, 0, 5]])
+    for y in Y.flat:
+      self.assertIsInstance(y, int)
+
+  def test_eliminate_fraction_free(self):
+    fractions = lambda X: np.array([[Fraction(x) for x in row] for row in X])
+    integers = lambda X: np.array([[int(x) for x in row] for row in X])
+    np.random.seed(0)
+
+    for i in range(20):
+      num_r, num_c = np.random.randint(1, 8, size=2)
+      X = np.random.randint(-9, 10, size=(num_r, num_c))
+      if i % 2 == 0:
+        # make the matrix rank deficient
+        X[-1, :] = X[0, :] * 2
+      with self.subTest(X=X):
+        Y, d = eliminate_fraction_free(integers(X).astype(object))
+        for y in Y.flat:
+          self.assertIsInstance(y, int)
+        expected = eliminate(fractions(X))
+        actual = np.array([[Fraction(y, d) for y in row] for row in Y])
+        self.assertTrue(np.all(actual == expected))
+
+  def test_statespace_basis(self):
+    integers = lambda X: np.array([[int(x) for x in row] for row in X])
+    np.random.seed(0)
+
+    for i in range(20):
+      num_r, num_c = np.random.randint(2, 8, size=2)
+      X = integers(np.random.randint(-9, 10, size=(num_r, num_c)))
+      X = X.astype(object)
+      if i % 2 == 0:
+        # make the matrix rank deficient
+        X[-1, :] = X[0, :] * 2
+      with self.subTest(X=X):
+        # extending in steps, in any order, gives the canonical basis
+        expected, d = eliminate_fraction_free(X.copy())
+        expected = expected[np.any(expected != 0, axis=1), :]
+        basis = StatespaceBasis(num_c)
+        order = np.random.permutation(num_r)
+        for rows in (order[:1], order[1:]):
+          basis = basis.extend(X[rows, :])
+        self.assertEqual(basis.d, d)
+        self.assertTrue(np.all(basis.B == expected))
+        self.assertTrue(np.all(basis.contains(X)))
+
+        # rows within the span don't change the basis
+        self.assertIs(basis.extend(X[:1, :] * 3 - X[-1:, :]), basis)
+
+    # a vector outside of the span
+    basis = StatespaceBasis(3).extend(integers([[1, 1, 0]]).astype(object))
+    self.assertEqual(basis.columns, [0])
+    outside = integers([[1, 0, 0], [2, 2, 0]]).astype(object)
+    self.assertEqual(list(basis.contains(outside)), [False, True])
+
   def test_determine_statespace(self):
     # sample data from email "improvements to nowcasting"
     states = ('a', 'b', 'c', 'd', 'e', 'f')
@@ -122,6 +412,18 @@ class UnitTests(unittest.TestCase):
       self.assertTrue(np.allclose(np.sum(matrix.astype(np.float), axis=1), 1))
 
     def assertStatespace(sensors, expected_num_states, expected_outputs):
+      impls = (
+        determine_statespace,
+        determine_statespace_fraction_free,
+        determine_statespace_float,
+      )
+      for impl in impls:
+        with self.subTest(impl=impl.__name__):
+          assertStatespaceImpl(
+              impl, sensors, expected_num_states, expected_outputs)
+
+    def assertStatespaceImpl(
+        impl, sensors, expected_num_states, expected_outputs):
       num_inputs = len(sensors)
       num_states = len(states)
       num_outputs = len(regions)
@@ -131,7 +433,7 @@ class UnitTests(unittest.TestCase):
       self.assertEqual(W0.shape, (num_outputs, num_states))
       assertRowsSumToOne(H0)
       assertRowsSumToOne(W0)
-      H, W, actual_rows = determine_statespace(H0, W0)
+      H, W, actual_rows = impl(H0, W0)
       num_latent_states = H.shape[1]
       self.assertEqual(num_latent_states, expected_num_states)
       self.assertEqual(H.shape, (num_inputs, num_latent_states))
@@ -160,3 +462,40 @@ class UnitTests(unittest.TestCase):
     expected_outputs = regions
     with self.subTest(sensors=sensors):
       assertStatespace(sensors, expected_num_states, expected_outputs)
+
+  def test_determine_statespace_fraction_free(self):
+    for (H0, W0) in get_random_statespaces():
+      with self.subTest(H0=H0, W0=W0):
+        H1, W1, rows1 = determine_statespace(H0.copy(), W0.copy())
+        H2, W2, rows2 = determine_statespace_fraction_free(H0, W0)
+        self.assertEqual(H1.shape, H2.shape)
+        self.assertEqual(W1.shape, W2.shape)
+        self.assertTrue(np.all(H1 == H2))
+        self.assertTrue(np.all(W1 == W2))
+        self.assertEqual(list(rows1), list(rows2))
+
+  def test_determine_statespace_float(self):
+    for (H0, W0) in get_random_statespaces():
+      with self.subTest(H0=H0, W0=W0):
+        H1, W1, rows1 = determine_statespace(H0.copy(), W0.copy())
+        H2, W2, rows2 = determine_statespace_float(H0, W0)
+        self.assertEqual(list(rows1), list(rows2))
+        self.assertTrue(is_equivalent_statespace(H1, W1, H2, W2))
+        # the float basis reproduces the full-statespace inputs and outputs
+        H0f, W0f = H0.astype(np.float), W0[rows2, :].astype(np.float)
+        V = np.linalg.lstsq(H2, H0f, rcond=None)[0]
+        self.assertTrue(np.allclose(np.dot(H2, V), H0f))
+        self.assertTrue(np.allclose(np.dot(W2, V), W0f))
+
+  def test_is_equivalent_statespace(self):
+    np.random.seed(0)
+    H = np.random.rand(6, 3)
+    W = np.random.rand(4, 3)
+    B = np.random.rand(3, 3) + np.eye(3)
+
+    # a change of basis doesn't matter
+    self.assertTrue(is_equivalent_statespace(H, W, np.dot(H, B), np.dot(W, B)))
+
+    # different mappings and dimensions do matter
+    self.assertFalse(is_equivalent_statespace(H, W, H, W + 1))
+    self.assertFalse(is_equivalent_statespace(H, W, H[:, :2], W[:, :2]))
@@ -8,6 +8,9 @@ import numpy as np
 
 # first party
 from delphi.nowcast.fusion.covariance import BlendDiagonal2
+from delphi.nowcast.fusion.covariance import CovarianceCache
+from delphi.nowcast.fusion.covariance import LowRankPlusDiagonal
+from delphi.nowcast.fusion.covariance import nancov
 
 # py3tester coverage target
 __test_target__ = 'delphi.nowcast.fusion.nowcast'
@@ -241,6 +244,230 @@ class UnitTests(unittest.TestCase):
         # hhs2 is bounded by new jersey and new york (pr and vi are excluded)
         self.assertTrue(min(nj, ny) < hhs2 < max(nj, ny))
 
+  def test_compute_nowcast_batch(self):
+    input_locations = ('jfk', 'ny_minus_jfk')
+    noises = [
+      np.array([[11, -13], [-11, 13]]),
+      np.array([[11, -13], [-11, 13], [5, 7]]),
+      np.array([[1, 2], [3, 5], [8, 13]]),
+    ]
+    readings = [
+      np.array([17, 19]),
+      np.array([23, 29]),
+      np.array([31, 37]),
+    ]
+    ncs = Nowcast.compute_nowcast_batch(
+        input_locations, noises, readings, BlendDiagonal2)
+
+    self.assertEqual(len(ncs), len(readings))
+    for noise, reading, nc in zip(noises, readings, ncs):
+      expected = Nowcast.compute_nowcast(
+          input_locations, noise, reading, BlendDiagonal2)
+      self.assertEqual(len(nc), len(expected))
+      for row, expected_row in zip(nc, expected):
+        self.assertNowcast(row, *expected_row)
+
+  def test_compute_nowcast_batch_warm_start(self):
+    input_locations = ('jfk', 'ny_minus_jfk', 'nj')
+    np.random.seed(0)
+    noise = np.random.randn(60, 3)
+    noises = [noise[:50], noise[:55], noise]
+    readings = [np.random.randn(3) + 10 for i in range(3)]
+
+    for shrinkage in (BlendDiagonal2, LowRankPlusDiagonal):
+      with self.subTest(shrinkage=shrinkage):
+        args = (input_locations, noises, readings, shrinkage)
+        cold = Nowcast.compute_nowcast_batch(*args)
+        warm = Nowcast.compute_nowcast_batch(*args, warm_start=True)
+        for nc1, nc2 in zip(cold, warm):
+          self.assertEqual([row[0] for row in nc1], [row[0] for row in nc2])
+          for row1, row2 in zip(nc1, nc2):
+            self.assertTrue(np.isclose(row1[1], row2[1], rtol=1e-3))
+            self.assertTrue(np.isclose(row1[2], row2[2], rtol=1e-2))
+
+  def test_compute_nowcast_batch_noise_statistics(self):
+    input_locations = ('jfk', 'ny_minus_jfk', 'nj')
+    np.random.seed(0)
+    noises = [np.random.randn(20 + i, 3) for i in range(3)]
+    readings = [np.random.randn(3) + 10 for i in range(3)]
+    statistics = [nancov(noise) + (noise.shape[0],) for noise in noises]
+
+    args = (input_locations, noises, readings, BlendDiagonal2)
+    expected = Nowcast.compute_nowcast_batch(*args)
+    ncs = Nowcast.compute_nowcast_batch(*args, noise_statistics=statistics)
+    for nc, expected_nc in zip(ncs, expected):
+      self.assertEqual(len(nc), len(expected_nc))
+      for row, expected_row in zip(nc, expected_nc):
+        self.assertNowcast(row, *expected_row)
+
+  def test_compute_nowcast_batch_covariance_cache(self):
+    input_locations = ('jfk', 'ny_minus_jfk', 'nj')
+    np.random.seed(0)
+    noises = [np.random.randn(20 + i, 3) for i in range(3)]
+    readings = [np.random.randn(3) + 10 for i in range(3)]
+
+    for shrinkage in (BlendDiagonal2, LowRankPlusDiagonal):
+      with self.subTest(shrinkage=shrinkage):
+        args = (input_locations, noises, readings, shrinkage)
+        expected = Nowcast.compute_nowcast_batch(*args)
+        cache = CovarianceCache()
+        Nowcast.covariance_cache = cache
+        try:
+          first = Nowcast.compute_nowcast_batch(*args)
+          second = Nowcast.compute_nowcast_batch(*args)
+        finally:
+          Nowcast.covariance_cache = None
+        self.assertEqual(cache.get_stats()['misses'], 3)
+        self.assertEqual(cache.get_stats()['hits'], 3)
+        for ncs in (first, second):
+          for nc, expected_nc in zip(ncs, expected):
+            for row, expected_row in zip(nc, expected_nc):
+              self.assertNowcast(row, *expected_row)
+
+  def test_compute_nowcast_covariance_cache(self):
+    input_locations = ('jfk', 'ny_minus_jfk', 'nj')
+    np.random.seed(0)
+    noise = np.random.randn(20, 3)
+    reading = np.random.randn(3) + 10
+    sensors1 = tuple(('a', loc) for loc in input_locations)
+    sensors2 = tuple(('b', loc) for loc in input_locations)
+
+    args = (input_locations, noise, reading, BlendDiagonal2)
+    expected = Nowcast.compute_nowcast(*args)
+    cache = CovarianceCache()
+    Nowcast.covariance_cache = cache
+    try:
+      # the single-week path uses the cache, and distinguishes inputs by sensor
+      results = [
+        Nowcast.compute_nowcast(*args, input_columns=sensors1),
+        Nowcast.compute_nowcast(*args, input_columns=sensors1),
+        Nowcast.compute_nowcast(*args, input_columns=sensors2),
+      ]
+
+      # with statistics, the noise itself isn't needed
+      statistics = nancov(noise) + (noise.shape[0],)
+      method, alpha = Nowcast.fit_shrinkage(
+          sensors1, None, BlendDiagonal2, statistics=statistics)
+    finally:
+      Nowcast.covariance_cache = None
+    self.assertEqual(cache.get_stats()['misses'], 2)
+    self.assertEqual(cache.get_stats()['hits'], 2)
+    self.assertIsInstance(method, BlendDiagonal2)
+    for nc in results:
+      for row, expected_row in zip(nc, expected):
+        self.assertNowcast(row, *expected_row)
+
+  def test_compute_nowcast_output_subset(self):
+    input_locations = ('jfk', 'ny_minus_jfk')
+    A, B, C, D = 11, 13, 17, 19
+    noise = np.array([
+      [A, -B],
+      [-A, B],
+    ])
+    reading = np.array([C, D])
+    full = Nowcast.compute_nowcast(
+        input_locations, noise, reading, BlendDiagonal2)
+
+    # only requested locations, in statespace order, which can be determined
+    nc = Nowcast.compute_nowcast(
+        input_locations,
+        noise,
+        reading,
+        BlendDiagonal2,
+        output_locations=('jfk', 'nat', 'ny'))
+    self.assertEqual(len(nc), 2)
+    self.assertNowcast(nc[0], *full[0])
+    self.assertNowcast(nc[1], *full[2])
+
+    ncs = Nowcast.compute_nowcast_batch(
+        input_locations,
+        [noise, noise],
+        [reading, reading],
+        BlendDiagonal2,
+        output_locations=('ny',))
+    for nc in ncs:
+      self.assertEqual(len(nc), 1)
+      self.assertNowcast(nc[0], *full[0])
+
+    # nothing requested can be determined
+    nc = Nowcast.compute_nowcast(
+        input_locations,
+        noise,
+        reading,
+        BlendDiagonal2,
+        output_locations=('nat',))
+    self.assertEqual(nc, ())
+
+  def test_compute_nowcast_low_rank(self):
+    input_locations = ('jfk', 'ny_minus_jfk', 'jfk')
+    np.random.seed(0)
+    noises = [np.random.randn(10, 3) for i in range(3)]
+    readings = [np.random.randn(3) + 10 for i in range(3)]
+
+    ncs = Nowcast.compute_nowcast_batch(
+        input_locations, noises, readings, LowRankPlusDiagonal)
+    for noise, reading, nc in zip(noises, readings, ncs):
+      expected = Nowcast.compute_nowcast(
+          input_locations, noise, reading, LowRankPlusDiagonal)
+      self.assertEqual(len(nc), 3)
+      for row, expected_row in zip(nc, expected):
+        self.assertNowcast(row, *expected_row)
+        self.assertTrue(np.isfinite(row[1]))
+        self.assertTrue(row[2] > 0)
+
+  def test_compute_nowcast_low_rank_single_input(self):
+    input_locations = ('nj',)
+    np.random.seed(0)
+    noises = [np.random.randn(10, 1) for i in range(3)]
+    readings = [np.random.randn(1) + 10 for i in range(3)]
+
+    ncs = Nowcast.compute_nowcast_batch(
+        input_locations, noises, readings, LowRankPlusDiagonal)
+    for noise, reading, nc in zip(noises, readings, ncs):
+      expected = Nowcast.compute_nowcast(
+          input_locations, noise, reading, LowRankPlusDiagonal)
+      self.assertEqual(len(nc), 1)
+      self.assertNowcast(nc[0], *expected[0])
+      stdev = np.sqrt(np.mean(np.square(noise)))
+      self.assertNowcast(expected[0], 'nj', reading[0], stdev)
+
+  def test_batch_nowcast_matches_weekly(self):
+    nowcaster, test_weeks = get_scenario()
+    # a warm start, which can change shrinkage slightly, is off by default
+    self.assertFalse(nowcaster.warm_start)
+    ncs = nowcaster.batch_nowcast(test_weeks)
+    inputs, noise, readings = nowcaster.get_sensor_data_for_all_weeks(
+        test_weeks)
+
+    for week, reading, nc in zip(test_weeks, readings, ncs):
+      with self.subTest(week=week):
+        exclude_locations = ('vi', 'pr')
+        l, n, r = nowcaster.get_sensor_data_for_week(
+            inputs, noise, week, reading, exclude_locations)
+        expected = Nowcast.compute_nowcast(
+            l,
+            n,
+            r,
+            BlendDiagonal2,
+            season=Nowcast.get_season(week),
+            exclude_locations=exclude_locations)
+        self.assertEqual(len(nc), len(expected))
+        for row, expected_row in zip(nc, expected):
+          self.assertNowcast(row, *expected_row)
+
+  def test_batch_nowcast_output_subset(self):
+    nowcaster, test_weeks = get_scenario()
+    nowcaster.output_locations = ('ny', 'hhs2')
+    ncs = nowcaster.batch_nowcast(test_weeks)
+    self.assertEqual(len(ncs), len(test_weeks))
+    for nc in ncs:
+      self.assertEqual([l for l, v, s in nc], ['hhs2', 'ny'])
+
+  def test_precompute_statespaces(self):
+    nowcaster, test_weeks = get_scenario()
+    # weeks 202022 and 202023 have the same inputs
+    self.assertEqual(nowcaster.precompute_statespaces(test_weeks), 2)
+
   def test_get_season_early(self):
     self.assertEqual(Nowcast.get_season(201740), 2017)
 
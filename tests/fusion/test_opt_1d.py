@@ -4,6 +4,9 @@
 import math
 import unittest
 
+# third party
+import numpy as np
+
 # py3tester coverage target
 __test_target__ = 'delphi.nowcast.fusion.opt_1d'
 
@@ -39,3 +42,113 @@ class UnitTests(unittest.TestCase):
     x, y = maximize(0, math.pi, lambda x: x + x ** 2 - x ** 4, UnitTests.stop)
     self.assertApprox(x, 0.88465)
     self.assertApprox(y, 1.05478)
+
+  def test_stopping_criteria(self):
+    """stop on any of several criteria, one of which is required"""
+    objective = lambda x: -(x - 0.3) ** 2
+    x, y = maximize(0, 1, objective, tolerance=1e-6)
+    self.assertApprox(x, 0.3)
+
+    x, y = maximize(0, 1000, objective, rel_tolerance=1e-6)
+    self.assertApprox(x, 0.3)
+
+    # the budget is never exceeded, and counts earlier evaluations
+    for budget in (4, 5, 10):
+      with self.subTest(budget=budget):
+        counter = MemoizedObjective(objective)
+        maximize(0, 1, counter, max_evaluations=budget)
+        self.assertLessEqual(counter.evaluations, budget)
+        maximize(0, 1, counter, max_evaluations=budget + 1)
+        self.assertLessEqual(counter.evaluations, budget + 1)
+
+    with self.assertRaises(Exception):
+      maximize(0, 1, objective)
+    with self.assertRaises(Exception):
+      maximize(0, 1, objective, max_evaluations=3)
+
+  def test_log_scale(self):
+    """search over a logarithmic scale, which is finer near the lower bound"""
+    objective = lambda x: -(math.log(x) - math.log(2)) ** 2
+    x, y = maximize(1, 1e6, objective, UnitTests.stop, log_scale=True)
+    self.assertApprox(x, 2)
+
+    # far fewer evaluations are needed for the same relative precision
+    counts = []
+    for log_scale in (False, True):
+      counter = MemoizedObjective(objective)
+      x, y = maximize(
+          1, 1e6, counter, rel_tolerance=1e-3, log_scale=log_scale)
+      self.assertTrue(abs(x - 2) <= 2e-3 * x)
+      counts.append(counter.evaluations)
+    self.assertLess(counts[1], counts[0])
+
+    # the bounds are evaluated exactly
+    points = []
+    def objective(x):
+      points.append(x)
+      return x
+    x, y = maximize(3, 7, objective, max_evaluations=4, log_scale=True)
+    self.assertEqual(points[0], 3)
+    self.assertEqual(points[-1], 7)
+    self.assertEqual(x, 7)
+
+  def test_memoized_objective(self):
+    """remember values, and count evaluations and repeated points"""
+    calls = []
+    def objective(x):
+      calls.append(x)
+      return -x * x
+    counter = MemoizedObjective(objective)
+    self.assertEqual(counter(2), -4)
+    self.assertEqual(counter(2), -4)
+    self.assertEqual(counter(3), -9)
+    self.assertEqual(calls, [2, 3])
+    self.assertEqual(counter.get_stats(), {'evaluations': 2, 'hits': 1})
+
+    # a point is never evaluated twice, even in degenerate intervals
+    counter = MemoizedObjective(objective)
+    maximize(1, 1, counter, max_evaluations=10)
+    self.assertEqual(counter.evaluations, 1)
+
+  def test_maximize_batch(self):
+    """maximize the same functions, evaluating points in batches"""
+    cases = (
+      (lambda x: x, 0, 1, 1, 1),
+      (lambda x: -x * x, -1, 1, 0, 0),
+      (np.cos, 0, math.pi, 0, 1),
+      (lambda x: x + x ** 2 - x ** 4, 0, math.pi, 0.88465, 1.05478),
+    )
+    for objective, low, high, expected_x, expected_y in cases:
+      for batch_size in (2, 3, 8):
+        with self.subTest(expected_x=expected_x, batch_size=batch_size):
+          sizes = []
+          def batch_objective(points):
+            sizes.append(len(points))
+            return objective(points)
+          args = (low, high, batch_objective, UnitTests.stop, batch_size)
+          x, y = maximize_batch(*args)
+          self.assertApprox(x, expected_x)
+          self.assertApprox(y, expected_y)
+          self.assertEqual(sizes[0], batch_size + 2)
+          self.assertEqual(set(sizes[1:]), {batch_size})
+
+    with self.assertRaises(Exception):
+      maximize_batch(0, 1, lambda x: x, UnitTests.stop, 1)
+
+  def test_find_bracket(self):
+    """find an interval containing the maximum of `y = -(x - 10)^2`"""
+    objective = lambda x: -(x - 10) ** 2
+    for guess in (-100, 0, 9, 10, 11, 30, 100):
+      with self.subTest(guess=guess):
+        low, high = find_bracket(-100, 100, guess, 1, objective)
+        self.assertTrue(-100 <= low <= 10 <= high <= 100)
+
+    # narrow around a good guess
+    self.assertEqual(find_bracket(-100, 100, 10, 1, objective), (9, 11))
+
+    # maximum on the boundary
+    low, high = find_bracket(0, 5, 2, 1, objective)
+    self.assertEqual(high, 5)
+
+    # no direction to search
+    self.assertEqual(find_bracket(0, 5, 2, 1, lambda x: 0), (0, 5))
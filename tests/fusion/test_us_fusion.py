@@ -2,7 +2,12 @@
 
 # standard library
 from fractions import Fraction
+import tempfile
 import unittest
+from unittest.mock import MagicMock
+
+# third party
+import scipy.sparse
 
 # first party
 from delphi.utils.geo.locations import Locations
@@ -44,6 +49,14 @@ class UnitTests(unittest.TestCase):
     self.assertEqual(W.shape, (len(regions), len(atoms)))
     self.assertTrue(np.allclose(np.sum(W, axis=1), 1))
 
+    # weights are exact fractions of each location's total population
+    P = UsFusion.get_population_array(regions, None, atoms)
+    W = UsFusion.get_weight_matrix(regions, None, atoms)
+    for (r, c), weight in np.ndenumerate(W):
+      self.assertIsInstance(weight, Fraction)
+      self.assertIsInstance(weight.denominator, int)
+      self.assertEqual(weight, Fraction(int(P[r, c]), int(np.sum(P[r, :]))))
+
     # single atom, matching
     W = UsFusion.get_weight_matrix(['pa'], None, ['pa']).astype(np.float)
     self.assertEqual(W.shape, (1, 1))
@@ -53,6 +66,72 @@ class UnitTests(unittest.TestCase):
     with self.assertRaises(Exception):
       UsFusion.get_weight_matrix(['pa'], None, ['ga']).astype(np.float)
 
+  def test_get_membership_matrix(self):
+    locations = ['nat', 'hhs1', 'pa']
+    atoms = Locations.atom_list
+    M = UsFusion.get_membership_matrix(locations, atoms)
+    self.assertEqual(M.shape, (len(locations), len(atoms)))
+    self.assertEqual(M.dtype, bool)
+    for location, row in zip(locations, M):
+      expected = [atom in Locations.region_map[location] for atom in atoms]
+      self.assertEqual(list(row), expected)
+
+  def test_get_population_array(self):
+    locations = Locations.region_list
+    atoms = Locations.atom_list
+    for season in (None, 2016):
+      with self.subTest(season=season):
+        P = UsFusion.get_population_array(locations, season, atoms)
+        M = UsFusion.get_membership_matrix(locations, atoms)
+        populations = UsFusion.get_atom_populations(season, atoms)
+        self.assertEqual(P.shape, (len(locations), len(atoms)))
+        self.assertTrue(np.array_equal(P, M * populations))
+        self.assertTrue(np.all(P[M] > 0))
+
+    # single atom, non-matching
+    with self.assertRaises(Exception):
+      UsFusion.get_population_array(['pa'], None, ['ga'])
+
+  def test_get_sparse_weight_matrix(self):
+    locations = Locations.region_list
+    atoms = Locations.atom_list
+    for season in (None, 2016):
+      with self.subTest(season=season):
+        pop = UsFusion.get_population_matrix(locations, season, atoms)
+        W1 = UsFusion.get_weights_from_populations(pop)
+        W2 = UsFusion.get_sparse_weight_matrix(locations, season, atoms)
+        W3 = UsFusion.get_weight_matrix(locations, season, atoms)
+        self.assertTrue(scipy.sparse.issparse(pop))
+        self.assertTrue(scipy.sparse.issparse(W1))
+        self.assertEqual(W1.shape, (len(locations), len(atoms)))
+        self.assertEqual(W1.nnz, np.sum(W3 != 0))
+        # floats are exactly those nearest to the fractions
+        self.assertTrue(np.array_equal(W1.toarray(), W3.astype(np.float)))
+        self.assertTrue(np.array_equal(W2.toarray(), W3.astype(np.float)))
+
+    # single atom, non-matching
+    with self.assertRaises(Exception):
+      UsFusion.get_population_matrix(['pa'], None, ['ga'])
+
+  def test_determine_statespace_sparse(self):
+    cases = (
+      Locations.region_list,
+      Locations.nat_list + Locations.hhs_list + Locations.cen_list,
+      ['hhs2', 'nj', 'ny_minus_jfk', 'jfk'],
+    )
+    for inputs in cases:
+      for method in UsFusion.METHODS:
+        with self.subTest(inputs=inputs, method=method):
+          args = (tuple(inputs), None, (), method)
+          H1, W1, outputs1 = UsFusion.determine_statespace(*args, False)
+          H2, W2, outputs2 = UsFusion.determine_statespace(*args, True)
+          self.assertFalse(scipy.sparse.issparse(H1))
+          self.assertTrue(scipy.sparse.issparse(H2))
+          self.assertTrue(scipy.sparse.issparse(W2))
+          self.assertEqual(outputs1, outputs2)
+          self.assertTrue(np.array_equal(H1, H2.toarray()))
+          self.assertTrue(np.array_equal(W1, W2.toarray()))
+
   def test_determine_statespace(self):
     # typical invocation, uncached
     inputs = tuple(Locations.region_list * 3)
@@ -130,3 +209,128 @@ class UnitTests(unittest.TestCase):
     H, W, outputs = UsFusion.determine_statespace(tuple(inputs))
     self.assertEqual(set(outputs), set(expected_outputs))
     self.assertEqual(H.shape[1], 4)
+
+  def test_determine_statespace_methods(self):
+    cases = (
+      Locations.nat_list + Locations.hhs_list + Locations.cen_list,
+      ['hhs2', 'nj', 'ny_minus_jfk', 'jfk'],
+      ['nj', 'ny', 'pr', 'vi'],
+      ['nat', 'hhs1', 'ma', 'cen9', 'ca', 'or', 'wa'],
+    )
+    for inputs in cases:
+      with self.subTest(inputs=inputs):
+        args = (tuple(inputs), 2016, ())
+        H1, W1, outputs1 = UsFusion.determine_statespace(*args, 'exact')
+        H2, W2, outputs2 = UsFusion.determine_statespace(*args, 'float')
+        H3, W3, outputs3 = UsFusion.determine_statespace(*args, 'verify')
+        self.assertEqual(outputs1, outputs2)
+        self.assertEqual(outputs1, outputs3)
+        self.assertTrue(np.allclose(H2, H3))
+        self.assertTrue(np.allclose(W2, W3))
+        self.assertTrue(fusion.is_equivalent_statespace(H1, W1, H2, W2))
+
+    with self.assertRaises(Exception):
+      UsFusion.determine_statespace(('nat',), method='magic')
+
+  def test_statespace_cache_in_memory(self):
+    cache = StatespaceCache()
+    compute = MagicMock(return_value='statespace')
+    key = (('nat',), 2016, (), 'exact', False)
+    self.assertEqual(cache.get(key, compute), 'statespace')
+    self.assertEqual(cache.get(key, compute), 'statespace')
+    self.assertEqual(compute.call_count, 1)
+    self.assertEqual(cache.get_stats(), {'hits': 1, 'loads': 0, 'misses': 1})
+
+  def test_statespace_cache_eviction(self):
+    cache = StatespaceCache(max_entries=2)
+    compute = MagicMock(side_effect=lambda: 'statespace')
+    keys = [((loc,), 2016, (), 'exact', False) for loc in ('nat', 'nj', 'vi')]
+    cache.get(keys[0], compute)
+    cache.get(keys[1], compute)
+    cache.get(keys[0], compute)
+    cache.get(keys[2], compute)
+    self.assertEqual(len(cache.statespaces), 2)
+
+    # the least recently used statespace was forgotten
+    cache.get(keys[0], compute)
+    self.assertEqual(compute.call_count, 3)
+    cache.get(keys[1], compute)
+    self.assertEqual(compute.call_count, 4)
+
+  def test_statespace_cache_on_disk(self):
+    with tempfile.TemporaryDirectory() as directory:
+      key1 = (('nat',), 2016, (), 'exact', False)
+      key2 = (('nat',), None, (), 'exact', False)
+      compute = MagicMock(return_value=(np.eye(2), np.ones((3, 2)), ['nat']))
+
+      cache = StatespaceCache(directory)
+      cache.get(key1, compute)
+      cache.get(key2, compute)
+      self.assertEqual(compute.call_count, 2)
+
+      # a new cache loads the statespace with a season from disk
+      cache = StatespaceCache(directory)
+      H, W, outputs = cache.get(key1, compute)
+      self.assertEqual(compute.call_count, 2)
+      self.assertTrue(np.array_equal(H, np.eye(2)))
+      self.assertEqual(outputs, ['nat'])
+
+      # statespace without a season isn't persisted
+      cache.get(key2, compute)
+      self.assertEqual(compute.call_count, 3)
+      self.assertEqual(cache.get_stats(), {'hits': 0, 'loads': 1, 'misses': 1})
+
+  def test_determine_statespace_uses_cache(self):
+    cache = UsFusion.statespace_cache
+    try:
+      UsFusion.statespace_cache = StatespaceCache()
+      inputs = ('hhs2', 'nj', 'ny_minus_jfk', 'jfk')
+      result1 = UsFusion.determine_statespace(inputs, season=2016)
+      result2 = UsFusion.determine_statespace(inputs, season=2016)
+      result3 = UsFusion.determine_statespace(inputs, season=2016, sparse=True)
+      self.assertIs(result1, result2)
+      self.assertIsNot(result1, result3)
+      stats = UsFusion.statespace_cache.get_stats()
+      self.assertEqual(stats, {'hits': 1, 'loads': 0, 'misses': 2})
+    finally:
+      UsFusion.statespace_cache = cache
+
+  def test_incremental_statespace(self):
+    atoms = Locations.atom_list
+    locations = Locations.region_list
+    get_pop = lambda locs: UsFusion.get_population_matrix(locs, 2016, atoms)
+    P = get_pop(locations).toarray().astype(object)
+
+    base = ('nat', 'hhs1', 'hhs3', 'hhs4', 'hhs5', 'hhs6', 'nj', 'jfk')
+    weeks = (
+      base,
+      base + ('pr',),
+      base + ('pr', 'vi'),
+      base + ('vi',),
+      base,
+      ('nat', 'hhs2', 'vi'),
+    )
+
+    # same result as from scratch, for each week in turn
+    engine = IncrementalStatespace()
+    for inputs in weeks:
+      with self.subTest(inputs=inputs):
+        H0 = get_pop(inputs).toarray().astype(object)
+        expected_columns, expected_rows = fusion.find_statespace(H0, P)
+        columns, rows = engine.find_statespace(inputs, 2016, (), locations, P)
+        self.assertEqual(columns, expected_columns)
+        self.assertEqual(list(rows), list(expected_rows))
+
+    # the population matrix may also be sparse
+    sparse_P = get_pop(locations)
+    columns, rows = IncrementalStatespace().find_statespace(
+        weeks[-1], 2016, (), locations, sparse_P)
+    self.assertEqual(columns, expected_columns)
+    self.assertEqual(list(rows), list(expected_rows))
+
+    # only the first and last weeks have no known subset
+    stats = {'reused': 1, 'extended': 3, 'full': 2}
+    self.assertEqual(engine.get_stats(), stats)
+
+    with self.assertRaises(Exception):
+      engine.find_statespace(('nat',), 2016, (), ['hhs1'], P[:1, :])
@@ -1,12 +1,61 @@
 """Unit tests for arch.py."""
 
 # standard library
+import os
+import tempfile
 import unittest
+from unittest.mock import MagicMock, patch
+
+# third party
+import numpy as np
+
+# first party
+from delphi.nowcast.util.synthetic_data import get_curves
 
 # py3tester coverage target
 __test_target__ = 'delphi.nowcast.sensors.arch'
 
 
+def check(response):
+  """Return the rows of an Epidata response, like `Epidata.check`."""
+  if response['result'] != 1:
+    raise Exception('request failed (code %d)' % response['result'])
+  return response['epidata']
+
+
+def get_epidata(failing=()):
+  """
+  Return a mock Epidata which serves four complete seasons (2010--2013) and
+  the start of the 2014 season, through 2014w50, in every region. Regions
+  are distinguished by the scale of their wILI. No issues are available.
+  Requests for `failing` regions raise an Exception.
+  """
+  curves = get_curves()
+  curves.append(1.2 * curves[1])
+  epiweeks = list(EW.range_epiweeks(201030, 201450, inclusive=True))
+
+  def fluview(region, weeks, issues=None):
+    if region in failing:
+      raise Exception('no data for %s' % region)
+    if issues is not None:
+      return {'result': -2}
+    scale = 1 + 0.5 * len(region)
+    rows = []
+    for epiweek in epiweeks:
+      y, w = EW.split_epiweek(epiweek)
+      if w < 30:
+        y -= 1
+      i = EW.delta_epiweeks(EW.join_epiweek(y, 30), epiweek)
+      value = scale * curves[y - 2010][min(i, 51)]
+      rows.append({'epiweek': epiweek, 'wili': value})
+    return {'result': 1, 'epidata': rows}
+
+  epidata = MagicMock()
+  epidata.check = check
+  epidata.fluview = fluview
+  return epidata
+
+
 class UnitTests(unittest.TestCase):
   """Basic unit tests."""
 
@@ -14,4 +63,181 @@ class UnitTests(unittest.TestCase):
     """Confirm that the target is syntactically valid."""
     self.assertTrue(True)
 
+  def test_archetype_cache_in_memory(self):
+    """Archetypes are memoized by region and training seasons."""
+    cache = ArchetypeCache()
+    curves = get_curves()
+    years = (2010, 2011, 2012, 2013)
+    model1 = cache.get('nat', years, curves)
+    model2 = cache.get('nat', years, curves)
+    model3 = cache.get('nat', years[:-1], curves[:-1])
+    model4 = cache.get('hhs1', years, curves)
+    self.assertIsInstance(model1, Archetype)
+    self.assertIs(model1, model2)
+    self.assertIsNot(model1, model3)
+    self.assertIsNot(model1, model4)
+
+  def test_archetype_cache_in_memory_is_validated(self):
+    """Stale or outdated in-memory Archetypes are rebuilt."""
+    cache = ArchetypeCache()
+    curves = get_curves()
+    years = (2010, 2011, 2012, 2013)
+    model1 = cache.get('nat', years, curves)
+
+    # revised training data invalidates the memoized Archetype
+    revised = [c * 2 for c in curves]
+    model2 = cache.get('nat', years, revised)
+    self.assertIsNot(model1, model2)
+    self.assertTrue(np.allclose(model2.curves, revised))
+
+    # so does a change in Archetype construction
+    with patch.object(ArchetypeCache, 'VERSION', ArchetypeCache.VERSION + 1):
+      model3 = cache.get('nat', years, revised)
+    self.assertIsNot(model2, model3)
+
+  def test_archetype_cache_on_disk(self):
+    """Archetypes are shared across caches through the filesystem."""
+    curves = get_curves()
+    years = (2010, 2011, 2012, 2013)
+    with tempfile.TemporaryDirectory() as directory:
+      model1 = ArchetypeCache(directory).get('nat', years, curves)
+      self.assertTrue(os.path.isfile(
+          ArchetypeCache(directory).get_filename('nat', years)))
+
+      # a new cache loads the stored Archetype
+      model2 = ArchetypeCache(directory).get('nat', years, curves)
+      self.assertIsNot(model1, model2)
+      self.assertTrue(np.allclose(model1.mean, model2.mean))
+      self.assertTrue(np.allclose(model1.holiday, model2.holiday))
+
+      # revised training data invalidates the stored Archetype
+      revised = [c * 2 for c in curves]
+      model3 = ArchetypeCache(directory).get('nat', years, revised)
+      self.assertTrue(np.allclose(model3.curves, revised))
+
+  def test_get_partial_trajectory(self):
+    """Partial trajectories are built from data downloaded once per season."""
+    stable = [{'epiweek': 201730 + i, 'wili': 1} for i in range(10)]
+    unstable = [
+      {'epiweek': 201730 + i, 'issue': 201730 + j, 'wili': 2}
+      for j in range(10) for i in range(j + 1)
+    ]
+    epidata = MagicMock()
+    epidata.check = check
+    epidata.fluview = lambda *args, issues=None: {
+      'result': 1,
+      'epidata': unstable if issues else stable,
+    }
+
+    with patch('delphi.nowcast.sensors.arch.Epidata', epidata):
+      arch = ARCH('nat')
+      curve = arch._get_partial_trajectory(201735, valid=True)
+      self.assertTrue(np.allclose(curve, [2] * 6))
+
+      # stable wILI is used for old weeks when unstable wILI is missing
+      unstable[:] = [row for row in unstable if row['epiweek'] != 201730]
+      arch = ARCH('nat')
+      curve = arch._get_partial_trajectory(201738, valid=True)
+      self.assertTrue(np.allclose(curve, [1] + [2] * 8))
+
+      # but only when at least 5 weeks old
+      with self.assertRaises(Exception):
+        arch._get_partial_trajectory(201734, valid=True)
+      curve = arch._get_partial_trajectory(201734, valid=False)
+      self.assertTrue(np.allclose(curve, [1] + [2] * 4))
+
+  def test_get_season_data_retries_failures(self):
+    """Failed downloads of issues are raised and retried, not cached."""
+    stable = [{'epiweek': 201730 + i, 'wili': 1} for i in range(10)]
+    unstable = [{'epiweek': 201730, 'issue': 201730, 'wili': 2}]
+    responses = [
+      {'result': 1, 'epidata': stable},
+      {'result': -1, 'message': 'transient failure'},
+      {'result': 1, 'epidata': unstable},
+    ]
+    epidata = MagicMock()
+    epidata.check = check
+    epidata.fluview = MagicMock(side_effect=responses)
+
+    with patch('delphi.nowcast.sensors.arch.Epidata', epidata):
+      arch = ARCH('nat')
+      with self.assertRaises(Exception):
+        arch._get_season_data(2017)
+      epiweeks, stable, issues = arch._get_season_data(2017)
+      self.assertEqual(list(issues.keys()), [201730])
+
+      # successful downloads are cached
+      arch._get_season_data(2017)
+      self.assertEqual(epidata.fluview.call_count, 3)
+
+  def test_search_grid(self):
+    """The vectorized grid search matches a brute-force scan of the grid."""
+    curves = get_curves()
+    models = [Archetype(curves), Archetype(curves[:3])]
+    partials = [np.array(curves[3][:20]), 1.5 * np.array(curves[0][:20])]
+    guesses = ARCH._search_grid(models, partials)
+    shifts, scales = ARCH._get_bins()
+    for (model, partial, guess) in zip(models, partials, guesses):
+      test, weights = ARCH._get_target(model, partial)
+      best, best_score = None, np.inf
+      for shift in shifts:
+        for scale in scales:
+          instance = model.instance(scale, shift, True)
+          score = np.mean(np.square(weights * (test - instance)))
+          if score < best_score:
+            best, best_score = (shift, scale), score
+      self.assertTrue(np.allclose(guess, best))
+
+  def test_predict_range(self):
+    """Predicting a range matches predicting one week at a time."""
+    with patch('delphi.nowcast.sensors.arch.Epidata', get_epidata()), \
+        patch.object(ARCH, 'archetype_cache', ArchetypeCache()):
+      predictions, reasons = ARCH('nat').predict_range(
+          201449, 201451, valid=False)
+      arch = ARCH('nat')
+      for (n, epiweek) in enumerate((201449, 201450)):
+        expected = arch.predict(epiweek, valid=False)
+        self.assertTrue(np.isclose(predictions[n], expected))
+        self.assertIsNone(reasons[n])
+      # data for the last week isn't available
+      self.assertTrue(np.isnan(predictions[2]))
+      self.assertIsInstance(reasons[2], Exception)
+
+  def test_arch_batch_predict(self):
+    """Batched predictions match single-region predictions."""
+    with patch('delphi.nowcast.sensors.arch.Epidata', get_epidata()), \
+        patch.object(ARCH, 'archetype_cache', ArchetypeCache()):
+      regions = ['nat', 'hhs1', 'ca']
+      predictions, reasons = ARCHBatch(regions).predict(201448, valid=False)
+      for (region, prediction, reason) in zip(regions, predictions, reasons):
+        expected = ARCH(region).predict(201448, valid=False)
+        self.assertTrue(np.isclose(prediction, expected))
+        self.assertIsNone(reason)
+
+  def test_arch_batch_predict_range(self):
+    """Batched ranges match single-region ranges, with reasons for gaps."""
+    epidata = get_epidata(failing=('bad',))
+    with patch('delphi.nowcast.sensors.arch.Epidata', epidata), \
+        patch.object(ARCH, 'archetype_cache', ArchetypeCache()):
+      regions = ['nat', 'bad', 'hhs1']
+      batch = ARCHBatch(regions)
+      predictions, reasons = batch.predict_range(201449, 201451, valid=False)
+      self.assertEqual(predictions.shape, (3, 3))
+
+      # the failing region has no predictions, and its failure as the reason
+      self.assertTrue(np.all(np.isnan(predictions[:, 1])))
+      for week_reasons in reasons:
+        self.assertIs(week_reasons[1], batch.failures[1])
+
+      # the other regions match predictions made one week at a time
+      for i in (0, 2):
+        arch = ARCH(regions[i])
+        for (n, epiweek) in enumerate((201449, 201450)):
+          expected = arch.predict(epiweek, valid=False)
+          self.assertTrue(np.isclose(predictions[n, i], expected))
+          self.assertIsNone(reasons[n][i])
+        # data for the last week isn't available
+        self.assertTrue(np.isnan(predictions[2, i]))
+        self.assertIsInstance(reasons[2][i], Exception)
+
   # TODO: finish writing tests
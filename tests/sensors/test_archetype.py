@@ -3,6 +3,12 @@
 # standard library
 import unittest
 
+# third party
+import numpy as np
+
+# first party
+from delphi.nowcast.util.synthetic_data import get_curves
+
 # py3tester coverage target
 __test_target__ = 'delphi.nowcast.sensors.archetype'
 
@@ -14,4 +20,42 @@ class UnitTests(unittest.TestCase):
     """Confirm that the target is syntactically valid."""
     self.assertTrue(True)
 
+  def test_rotations(self):
+    """Batched rotations match individual rotations."""
+    model = Archetype(get_curves())
+    shifts = [-10, -2.5, 0, 0.25, 7]
+    rotated = model.rotations(model.mean, shifts)
+    self.assertEqual(rotated.shape, (len(shifts), 52))
+    for (row, shift) in zip(rotated, shifts):
+      self.assertTrue(np.allclose(row, model.rotate(model.mean, shift)))
+
+  def test_rotations_of_many_curves(self):
+    """Each row of a matrix of curves is rotated by its own shift."""
+    model = Archetype(get_curves())
+    curves = np.array(get_curves())
+    shifts = [-3, 0.5, 2, 10.75]
+    rotated = model.rotations(curves, shifts)
+    self.assertEqual(rotated.shape, curves.shape)
+    for (row, curve, shift) in zip(rotated, curves, shifts):
+      self.assertTrue(np.allclose(row, model.rotate(curve, shift)))
+
+  def test_smooth(self):
+    """Smoothing is a circular convolution, for one curve or many."""
+    model = Archetype(get_curves())
+    curves = np.array(get_curves())
+    extend = len(model.kernel) // 2
+    for curve, smoothed in zip(curves, model.smooth(curves)):
+      padded = np.concatenate((curve[-extend:], curve, curve[:extend]))
+      expected = np.convolve(padded, model.kernel, 'valid')
+      self.assertTrue(np.allclose(smoothed, expected))
+      self.assertTrue(np.allclose(model.smooth(curve), expected))
+
+  def test_aligned_curves(self):
+    """Smoothed curves are aligned to peak on the same week."""
+    model = Archetype(get_curves())
+    self.assertEqual(model.curves_nh_sm_al.shape, (4, 52))
+    peaks = np.argmax(model.curves_nh_sm_al, axis=1)
+    self.assertTrue(np.all(peaks == 25))
+    self.assertTrue(np.all(model.holiday <= 1))
+
   # TODO: finish writing tests
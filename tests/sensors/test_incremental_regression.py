@@ -0,0 +1,55 @@
+"""Unit tests for incremental_regression.py."""
+
+# standard library
+import unittest
+from unittest.mock import MagicMock, patch
+
+# third party
+import numpy as np
+
+# first party
+from delphi.nowcast.sensors.ar3 import AR3
+from delphi.nowcast.sensors.sar3 import SAR3
+from delphi.nowcast.util.synthetic_data import get_fluview
+import delphi.utils.epiweek as EW
+
+# py3tester coverage target
+__test_target__ = 'delphi.nowcast.sensors.incremental_regression'
+
+
+class UnitTests(unittest.TestCase):
+  """Basic unit tests."""
+
+  def test_predict_range(self):
+    """Incremental training matches training from scratch on every week."""
+
+    # unstable wILI is missing on 201335, and there's no data after 201430
+    epiweeks = list(EW.range_epiweeks(201030, 201430, inclusive=True))
+    epidata = MagicMock()
+    epidata.range = lambda first, last: {'from': first, 'to': last}
+    epidata.check = lambda response: response
+    epidata.fluview = get_fluview(epiweeks, missing=[(201335, 0)])
+    targets = (
+      ('delphi.nowcast.sensors.ar3.Epidata', AR3),
+      ('delphi.nowcast.sensors.sar3.Epidata', SAR3),
+    )
+
+    for (target, class_) in targets:
+      for (first, last) in ((201330, 201340), (201428, 201432)):
+        with self.subTest(sensor=class_.__name__, first=first), \
+            patch(target, epidata):
+          predictions, reasons = class_('nat').predict_range(first, last)
+          weeks = list(EW.range_epiweeks(first, last, inclusive=True))
+          self.assertEqual(len(predictions), len(weeks))
+          self.assertEqual(len(reasons), len(weeks))
+          for (epiweek, prediction, reason) in zip(weeks, predictions, reasons):
+            try:
+              expected = class_('nat').predict(epiweek)
+            except Exception:
+              expected = None
+            if expected is None:
+              self.assertTrue(np.isnan(prediction))
+              self.assertIsInstance(reason, Exception)
+            else:
+              self.assertTrue(np.isclose(prediction, expected))
+              self.assertIsNone(reason)
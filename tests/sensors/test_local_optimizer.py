@@ -0,0 +1,82 @@
+"""Unit tests for local_optimizer.py."""
+
+# standard library
+import unittest
+from unittest.mock import MagicMock
+
+# third party
+import numpy as np
+
+# py3tester coverage target
+__test_target__ = 'delphi.nowcast.sensors.local_optimizer'
+
+
+def rosenbrock(point):
+  """The Rosenbrock function, which has a minimum of 0 at (1, 1)."""
+  x, y = point
+  return (1 - x) ** 2 + 100 * (y - x ** 2) ** 2
+
+
+def batch_rosenbrock(points):
+  """The Rosenbrock function, evaluated at each row of the given matrix."""
+  x, y = points[:, 0], points[:, 1]
+  return (1 - x) ** 2 + 100 * (y - x ** 2) ** 2
+
+
+class UnitTests(unittest.TestCase):
+  """Basic unit tests."""
+
+  def test_paraboloid(self):
+    """minimize `sum((x - c)^2)` in four dimensions"""
+    center = np.array([1, 2, 3, 4])
+    objective = lambda x: np.sum(np.square(x - center))
+    optimizer = NelderMead(tolerance=1e-12)
+    x, y = optimizer.minimize(objective, np.zeros(4), 0.5)
+    self.assertTrue(np.allclose(x, center, atol=1e-4))
+    self.assertTrue(np.isclose(y, 0))
+
+  def test_rosenbrock(self):
+    """minimize the Rosenbrock function from a standard starting point"""
+    optimizer = NelderMead(max_iterations=2000, tolerance=1e-14)
+    x, y = optimizer.minimize(rosenbrock, (-1.2, 1), 0.1)
+    self.assertTrue(np.allclose(x, (1, 1), atol=1e-4))
+    self.assertTrue(np.isclose(y, 0))
+
+  def test_vectorized_path_is_identical(self):
+    """Batch evaluation changes the number of calls, not the result."""
+    objective = MagicMock(side_effect=rosenbrock)
+    batch_objective = MagicMock(side_effect=batch_rosenbrock)
+    sequential = NelderMead(max_iterations=200, vectorized=False)
+    vectorized = NelderMead(max_iterations=200, vectorized=True)
+
+    x1, y1 = sequential.minimize(objective, (-1.2, 1), 0.1, batch_objective)
+    self.assertFalse(batch_objective.called)
+    self.assertTrue(objective.called)
+
+    objective.reset_mock()
+    x2, y2 = vectorized.minimize(objective, (-1.2, 1), 0.1, batch_objective)
+    self.assertFalse(objective.called)
+    self.assertTrue(batch_objective.called)
+
+    self.assertTrue(np.array_equal(x1, x2))
+    self.assertEqual(y1, y2)
+
+  def test_evaluation_budget(self):
+    """The number of evaluations never exceeds the budget."""
+    for vectorized in (False, True):
+      with self.subTest(vectorized=vectorized):
+        objective = MagicMock(side_effect=rosenbrock)
+        batch_objective = MagicMock(side_effect=batch_rosenbrock)
+        optimizer = NelderMead(max_evaluations=20, vectorized=vectorized)
+        optimizer.minimize(objective, (-1.2, 1), 0.1, batch_objective)
+        calls = batch_objective.call_args_list
+        num_batched = sum(len(args[0]) for (args, kwargs) in calls)
+        self.assertLessEqual(objective.call_count + num_batched, 20)
+
+  def test_deterministic(self):
+    """Repeated runs produce exactly the same result."""
+    optimizer = NelderMead(max_iterations=50)
+    x1, y1 = optimizer.minimize(rosenbrock, (-1.2, 1), 0.1)
+    x2, y2 = optimizer.minimize(rosenbrock, (-1.2, 1), 0.1)
+    self.assertTrue(np.array_equal(x1, x2))
+    self.assertEqual(y1, y2)
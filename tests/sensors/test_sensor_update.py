@@ -3,7 +3,10 @@
 # standard library
 import argparse
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+
+# third party
+import numpy as np
 
 # first party
 from delphi.utils.geo.locations import Locations
@@ -98,6 +101,46 @@ class UnitTests(unittest.TestCase):
     self.assertIn('sar3', impls)
     self.assertTrue(callable(impls['sar3']))
 
+  def test_get_sensor_range_implementations(self):
+    """Get a map of sensor range implementations."""
+    impls = SensorGetter.get_sensor_range_implementations()
+    self.assertIsInstance(impls, dict)
+    self.assertIn('sar3', impls)
+    self.assertTrue(callable(impls['sar3']))
+
+  def test_update_range(self):
+    """Update a range of sensor readings, some of which are unavailable."""
+
+    database = MagicMock()
+    valid, name, location = True, 'name', 'loc'
+    values, reasons = np.array([1, np.nan, 3]), [None, Exception(), None]
+    impl = MagicMock(return_value=(values, reasons))
+    range_implementations = {name: impl}
+    sensor_update = SensorUpdate(valid, None, {}, None, range_implementations)
+
+    sensor_update.update_range(database, 201820, 201822, name, location)
+
+    self.assertEqual(impl.call_count, 1)
+    args, kwargs = impl.call_args
+    self.assertEqual(args, (location, 201819, 201821, valid))
+
+    self.assertEqual(database.insert.call_count, 2)
+    args = [a for a, k in database.insert.call_args_list]
+    self.assertEqual(args[0], (name, location, 201820, 1))
+    self.assertEqual(args[1], (name, location, 201822, 3))
+
+  def test_update_range_tolerates_sensor_failure(self):
+    """Suppress failure to read a range of sensor readings."""
+
+    database = MagicMock()
+    impl = MagicMock(side_effect=Exception)
+    sensor_update = SensorUpdate(True, None, {}, None, {'name': impl})
+
+    sensor_update.update_range(database, 201820, 201822, 'name', 'loc')
+
+    self.assertEqual(impl.call_count, 1)
+    self.assertEqual(database.insert.call_count, 0)
+
   def test_update_single(self):
     """Update a single sensor reading."""
 
@@ -270,4 +313,121 @@ class UnitTests(unittest.TestCase):
     self.assertEqual(args[1], ('s', 'ar', 201820, 2))
     self.assertEqual(args[2], ('s', 'az', 201820, 3))
 
+  def test_update_with_range_implementation(self):
+    """Bulk update sensor readings, backfilling a range of weeks at once."""
+
+    database = MagicMock()
+    database.__enter__.return_value = database
+
+    impl = MagicMock(return_value=0)
+    range_impl = MagicMock(return_value=(np.array([1, 2]), [None, None]))
+    implementations = {'s': impl}
+    range_implementations = {'s': range_impl}
+
+    sensors = [('s', 'ar')]
+
+    sensor_update = SensorUpdate(
+        True, database, implementations, None, range_implementations)
+    sensor_update.update(sensors, 201820, 201821)
+
+    self.assertEqual(impl.call_count, 0)
+    self.assertEqual(range_impl.call_count, 1)
+    args, kwargs = range_impl.call_args
+    self.assertEqual(args, ('ar', 201819, 201820, True))
+
+    self.assertEqual(database.insert.call_count, 2)
+    args = [a for a, k in database.insert.call_args_list]
+    self.assertEqual(args[0], ('s', 'ar', 201820, 1))
+    self.assertEqual(args[1], ('s', 'ar', 201821, 2))
+
+  def test_update_with_bulk_implementation(self):
+    """Bulk update sensor readings in many locations at once."""
+
+    database = MagicMock()
+    database.__enter__.return_value = database
+    database.get_most_recent_epiweek.side_effect = lambda name, loc: {
+      'ma': 201820,
+      'me': 201821,
+    }[loc]
+
+    impl = MagicMock(return_value=0)
+    values = np.array([[1, np.nan], [3, 4]])
+    reasons = [[None, Exception()], [None, None]]
+    bulk_impl = MagicMock(return_value=(values, reasons))
+    implementations = {'s': impl}
+    bulk_implementations = {'s': bulk_impl}
+
+    sensors = [('s', 'hhs1')]
+
+    sensor_update = SensorUpdate(
+        True, database, implementations, None, None, bulk_implementations)
+    with patch(
+        __test_target__ + '.get_location_list', return_value=['ma', 'me']):
+      sensor_update.update(sensors, None, 201821)
+
+    self.assertEqual(impl.call_count, 0)
+    self.assertEqual(bulk_impl.call_count, 1)
+    args, kwargs = bulk_impl.call_args
+    self.assertEqual(args, (['ma', 'me'], 201819, 201820, True))
+
+    # 'me' on 201820 is neither requested nor available
+    self.assertEqual(database.insert.call_count, 3)
+    args = [a for a, k in database.insert.call_args_list]
+    self.assertEqual(args[0], ('s', 'ma', 201820, 1))
+    self.assertEqual(args[1], ('s', 'ma', 201821, 3))
+    self.assertEqual(args[2], ('s', 'me', 201821, 4))
+
+  def test_update_bulk(self):
+    """Skip weeks before each location's own first week."""
+
+    database = MagicMock()
+    database.get_most_recent_epiweek.side_effect = lambda name, loc: {
+      'ma': 201820,
+      'me': 201822,
+    }[loc]
+    values = np.array([[1, 2], [3, 4], [5, np.nan]])
+    reasons = [[None, None], [None, None], [None, Exception()]]
+    bulk_impl = MagicMock(return_value=(values, reasons))
+    sensor_update = SensorUpdate(True, None, {}, None, None, {'s': bulk_impl})
+
+    sensor_update.update_bulk(database, None, 201822, 's', ['ma', 'me'])
+
+    # predictions start on the earliest first week of any location
+    self.assertEqual(bulk_impl.call_count, 1)
+    args, kwargs = bulk_impl.call_args
+    self.assertEqual(args, (['ma', 'me'], 201819, 201821, True))
+
+    # 'me' is skipped on 201820 and 201821, and unavailable on 201822
+    args = [a for a, k in database.insert.call_args_list]
+    self.assertEqual(args, [
+      ('s', 'ma', 201820, 1),
+      ('s', 'ma', 201821, 3),
+      ('s', 'ma', 201822, 5),
+    ])
+
+  def test_update_bulk_tolerates_sensor_failure(self):
+    """Suppress failure to read sensor readings in many locations."""
+
+    database = MagicMock()
+    bulk_impl = MagicMock(side_effect=Exception)
+    sensor_update = SensorUpdate(True, None, {}, None, None, {'s': bulk_impl})
+
+    sensor_update.update_bulk(database, 201820, 201822, 's', ['ma', 'me'])
+
+    self.assertEqual(bulk_impl.call_count, 1)
+    self.assertEqual(database.insert.call_count, 0)
+
+  def test_update_bulk_up_to_date(self):
+    """Don't compute anything when all locations are up to date."""
+
+    database = MagicMock()
+    database.get_most_recent_epiweek.return_value = 201823
+    bulk_impl = MagicMock()
+    sensor_update = SensorUpdate(True, None, {}, None, None, {'s': bulk_impl})
+
+    sensor_update.update_bulk(database, None, 201822, 's', ['ma', 'me'])
+
+    self.assertEqual(bulk_impl.call_count, 0)
+    self.assertEqual(database.insert.call_count, 0)
+
   # TODO: more tests
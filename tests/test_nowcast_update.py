@@ -84,6 +84,27 @@ class UnitTests(unittest.TestCase):
     self.assertIn((201812, 'vi'), epiweek_location_pairs)
     self.assertIn((201813, 'vi'), epiweek_location_pairs)
 
+  def test_warmup(self):
+    """Precompute statespace without nowcasting."""
+
+    database = MagicMock()
+    data_source = MagicMock(
+        get_truth_locations=lambda *a: ['nat', 'vi'],
+        get_sensor_locations=lambda *a: ['nat', 'vi'],
+        get_missing_locations=lambda *a: (),
+        get_sensors=lambda *a: ['epic', 'sar3'],
+        get_most_recent_issue=lambda *a: 201813,
+        get_weeks=lambda *a: list(range_epiweeks(201713, 201814)),
+        get_truth_value=lambda *a: random.random(),
+        get_sensor_value=lambda *a: random.random(),
+        prefetch=MagicMock())
+
+    NowcastUpdate(database, data_source).warmup(None, None)
+
+    data_source.prefetch.assert_called_once_with(201814)
+    self.assertFalse(database.insert.called)
+    self.assertFalse(database.__enter__.called)
+
   def test_get_update_range(self):
     """Get the range of epiweeks to be updated."""
 
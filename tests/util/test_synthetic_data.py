@@ -0,0 +1,31 @@
+"""Unit tests for synthetic_data.py."""
+
+# standard library
+import unittest
+
+# third party
+import numpy as np
+
+# py3tester coverage target
+__test_target__ = 'delphi.nowcast.util.synthetic_data'
+
+
+class UnitTests(unittest.TestCase):
+  """Basic unit tests."""
+
+  def test_get_curves(self):
+    """Seasons are full years of positive wILI, peaking mid-season."""
+    curves = get_curves()
+    self.assertEqual(np.shape(curves), (4, 52))
+    self.assertTrue(np.all(np.array(curves) > 0))
+    peaks = np.argmax(curves, axis=1)
+    self.assertTrue(np.all((15 <= peaks) & (peaks < 35)))
+
+  def test_get_fluview(self):
+    """Rows are served for every epiweek and lag, except missing ones."""
+    fluview = get_fluview([201801, 201802], missing=[(201802, 0)])
+    rows = fluview('nat', None, lag=0)
+    self.assertEqual([row['epiweek'] for row in rows], [201801])
+    rows = fluview('nat', None)
+    self.assertEqual([row['epiweek'] for row in rows], [201801, 201802])
+    self.assertTrue(all(row['lag'] == 52 for row in rows))